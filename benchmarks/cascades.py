@@ -0,0 +1,150 @@
+"""级联删除的基准测试
+
+生成一篇带大量嵌套评论的文章，分别测量逐条加载删除（原来 ORM 的 cascade='all, delete-orphan'）
+和由外键的 ON DELETE CASCADE 删除时，删除文章和删除一个大讨论串的根评论的耗时、SQL 数量和内存峰值。
+会删除并重建 --database 指定数据库中的所有表，不要指向正在使用的数据库。
+
+用法：
+
+    $ python benchmarks/cascades.py --database sqlite:////tmp/bluelog_bench.db --comments 100000
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import click
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, basedir)
+load_dotenv(os.path.join(basedir, '.env'))
+
+from bluelog import create_app  # noqa: E402
+from bluelog.extensions import db  # noqa: E402
+from bluelog.models import Category, Comment, Post, _delete_replies  # noqa: E402
+
+BATCH_SIZE = 10000
+
+
+def forge(post_id, comments, root_ratio):
+    """用批量 INSERT 生成一篇文章和它的嵌套评论
+
+    约 root_ratio 的评论是根评论，其余回复之前随机的一条评论，讨论串的大小和嵌套深度都不均匀。
+
+    Returns:
+        评论最多的讨论串的根评论 id 和讨论串的大小
+    """
+    start = datetime(2020, 1, 1)
+    first = db.session.query(db.func.max(Comment.id)).scalar() or 0
+    db.session.execute(Post.__table__.insert(), [dict(
+        id=post_id, title='post-%d' % post_id, body='body', can_comment=True, category_id=1,
+        comment_count=comments, reviewed_comment_count=comments, timestamp=start)])
+    threads = []
+    sizes = {}
+    rows = []
+    for i in range(first + 1, first + comments + 1):
+        if not threads or random.random() < root_ratio:
+            replied_id = thread_id = None
+            sizes[i] = 1
+        else:
+            replied_id, parent_thread = random.choice(threads)
+            thread_id = parent_thread or replied_id
+            sizes[thread_id] += 1
+        threads.append((i, thread_id))
+        rows.append(dict(id=i, author='author', email='author@example.com', body='comment body',
+                         from_admin=False, reviewed=True, post_id=post_id, replied_id=replied_id,
+                         thread_id=thread_id, timestamp=start + timedelta(seconds=i)))
+        if len(rows) == BATCH_SIZE:
+            db.session.execute(Comment.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Comment.__table__.insert(), rows)
+    db.session.commit()
+    return max(sizes.items(), key=lambda item: item[1])
+
+
+class Stats(object):
+    """统计一段代码执行的 SQL 数量、耗时和 Python 内存峰值"""
+
+    def __init__(self):
+        self.queries = 0
+
+    def _count(self, *args):
+        self.queries += 1
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+        tracemalloc.start()
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.begin
+        self.peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+
+
+def delete(obj, load_replies):
+    """删除文章或评论
+
+    load_replies 为 True 时先把所有评论和回复加载到会话中，由 ORM 逐条删除，与原来的
+    cascade='all, delete-orphan' 相同；为 False 时由数据库和 _delete_replies 删除。
+    """
+    if load_replies:
+        query = Comment.query.options(selectinload(Comment.replies))
+        if isinstance(obj, Post):
+            query.filter_by(post_id=obj.id).all()
+            obj.comments
+        else:
+            query.filter_by(thread_id=obj.id).all()
+            obj.replies
+    db.session.delete(obj)
+    db.session.commit()
+
+
+def measure(label, model, id, load_replies):
+    obj = model.query.get(id)
+    with Stats() as stats:
+        delete(obj, load_replies)
+    db.session.remove()
+    click.echo('%-34s %9.2f s %9d queries %9.1f MiB' % (label, stats.seconds, stats.queries,
+                                                         stats.peak))
+
+
+@click.command()
+@click.option('--database', required=True, help='Database URI, all tables will be dropped.')
+@click.option('--comments', default=100000, help='Quantity of comments on the post, default is 100000.')
+@click.option('--root-ratio', default=0.1, help='Ratio of root comments, default is 0.1.')
+@click.option('--seed', default=42, help='Random seed, default is 42.')
+def main(database, comments, root_ratio, seed):
+    """Compare deleting a post and a thread with ORM cascades and database cascades."""
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app.config['SQLALCHEMY_RECORD_QUERIES'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(Category.__table__.insert(), [dict(id=1, name='Default')])
+        db.session.commit()
+        click.echo('%-34s %11s %17s %14s' % ('', 'time', 'SQL', 'peak memory'))
+        for load_replies in (True, False):
+            label = 'orm cascade' if load_replies else 'database cascade'
+            if load_replies:  # 回复都在会话中，由 ORM 删除
+                event.remove(Comment, 'before_delete', _delete_replies)
+            random.seed(seed)
+            root, size = forge(1, comments, root_ratio)
+            measure('%s: thread of %d' % (label, size), Comment, root, load_replies)
+            measure('%s: post' % label, Post, 1, load_replies)
+            if load_replies:
+                event.listen(Comment, 'before_delete', _delete_replies)
+            assert Comment.query.count() == 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""复合索引的基准测试
+
+在伪造的数据集上分别测量没有复合索引和有复合索引时热点查询的执行计划与延迟。
+会删除并重建 --database 指定数据库中的所有表，不要指向正在使用的数据库。
+
+用法：
+
+    $ python benchmarks/indexes.py --database sqlite:////tmp/bluelog_bench.db --comments 1000000
+"""
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import click
+from dotenv import load_dotenv
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, basedir)
+load_dotenv(os.path.join(basedir, '.env'))
+
+from bluelog import create_app  # noqa: E402
+from bluelog.extensions import db  # noqa: E402
+from bluelog.models import Category, Comment, Post  # noqa: E402
+
+BATCH_SIZE = 10000
+
+
+def forge(categories, posts, comments):
+    """用批量 INSERT 生成测试数据
+
+    评论集中在少数文章上（id 越小的文章评论越多），约 10% 未审核，约 5% 来自管理员。
+    """
+    start = datetime(2020, 1, 1)
+    db.session.execute(Category.__table__.insert(),
+                       [dict(id=i, name='category-%d' % i) for i in range(1, categories + 1)])
+    rows = []
+    for i in range(1, posts + 1):
+        rows.append(dict(id=i, title='post-%d' % i, body='body', can_comment=True,
+                         comment_count=0, reviewed_comment_count=0,
+                         category_id=random.randint(1, categories),
+                         timestamp=start + timedelta(minutes=random.randint(0, 500000))))
+        if len(rows) == BATCH_SIZE:
+            db.session.execute(Post.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Post.__table__.insert(), rows)
+
+    rows = []
+    for i in range(1, comments + 1):
+        rows.append(dict(id=i, author='author', email='author@example.com', site=None,
+                         body='comment body', from_admin=random.random() < 0.05,
+                         reviewed=random.random() > 0.1,
+                         post_id=int(posts * random.random() ** 3) + 1,
+                         timestamp=start + timedelta(seconds=random.randint(0, 30000000))))
+        if len(rows) == BATCH_SIZE:
+            db.session.execute(Comment.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Comment.__table__.insert(), rows)
+    db.session.commit()
+
+
+def composite_indexes():
+    """模型中声明的复合索引"""
+    return [index for model in (Post, Comment) for index in model.__table__.indexes
+            if len(index.columns) > 1]
+
+
+def hot_queries():
+    """与视图中查询形状相同的热点查询"""
+    hot_post = 1
+    hot_category = db.session.query(Post.category_id).filter_by(id=hot_post).scalar()
+    return [
+        ('index page 50', Post.query.order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(10).offset(490)),
+        ('category page 1', Post.query.filter_by(category_id=hot_category).order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(10)),
+        ('post comments', Comment.query.filter_by(post_id=hot_post, reviewed=True).order_by(
+            Comment.timestamp.asc(), Comment.id.asc()).limit(15)),
+        ('post comments count', Comment.query.filter_by(post_id=hot_post, reviewed=True)),
+        ('unread comments', Comment.query.filter_by(reviewed=False).order_by(
+            Comment.timestamp.desc(), Comment.id.desc()).limit(15)),
+        ('unread comments count', Comment.query.filter_by(reviewed=False)),
+        ('admin comments', Comment.query.filter_by(from_admin=True).order_by(
+            Comment.timestamp.desc(), Comment.id.desc()).limit(15)),
+    ]
+
+
+def explain(query):
+    """返回查询的执行计划"""
+    statement = query.statement.compile(dialect=db.engine.dialect,
+                                        compile_kwargs={'literal_binds': True})
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    return [' | '.join(str(value) for value in row)
+            for row in db.session.execute(prefix + str(statement))]
+
+
+def measure(label, repeat):
+    """测量每个热点查询的执行计划和延迟中位数"""
+    click.echo('\n== %s ==' % label)
+    for name, query in hot_queries():
+        run = query.count if name.endswith('count') else query.all
+        timings = []
+        for i in range(repeat):
+            begin = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - begin) * 1000)
+        click.echo('%-24s %9.2f ms' % (name, statistics.median(timings)))
+        for line in explain(query.order_by(None) if name.endswith('count') else query):
+            click.echo('    %s' % line)
+
+
+@click.command()
+@click.option('--database', required=True, help='Database URI, all tables will be dropped.')
+@click.option('--categories', default=20, help='Quantity of categories, default is 20.')
+@click.option('--posts', default=10000, help='Quantity of posts, default is 10000.')
+@click.option('--comments', default=1000000, help='Quantity of comments, default is 1000000.')
+@click.option('--repeat', default=20, help='Runs per query, default is 20.')
+@click.option('--seed', default=42, help='Random seed, default is 42.')
+def main(database, categories, posts, comments, repeat, seed):
+    """Compare hot query plans and latencies without and with composite indexes."""
+    random.seed(seed)
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app.config['SQLALCHEMY_RECORD_QUERIES'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        indexes = composite_indexes()
+        for index in indexes:
+            index.drop(db.engine)
+
+        click.echo('Forging %d categories, %d posts, %d comments...' % (categories, posts, comments))
+        begin = time.perf_counter()
+        forge(categories, posts, comments)
+        click.echo('Done in %.1fs.' % (time.perf_counter() - begin))
+
+        measure('without composite indexes', repeat)
+        for index in indexes:
+            index.create(db.engine)
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute('ANALYZE')
+        else:
+            db.session.execute('ANALYZE TABLE post, comment')
+        db.session.commit()
+        measure('with composite indexes', repeat)
+
+
+if __name__ == '__main__':
+    main()
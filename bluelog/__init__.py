@@ -1,22 +1,37 @@
 import logging
 import os
+import time
 from logging.handlers import RotatingFileHandler
 
 import click
-from flask import Flask, render_template
+from flask import Flask, render_template, request
 from flask_login import current_user
+from flask_sqlalchemy import get_debug_queries
 from flask_wtf.csrf import CSRFError
 import jwt
 
 from bluelog.apis.v1 import api_v1
+from bluelog.assets import assets
 from bluelog.blueprints.admin import admin_bp
 from bluelog.blueprints.auth import auth_bp
 from bluelog.blueprints.blog import blog_bp
+from bluelog.blueprints.feeds import feeds_bp
+from bluelog.caching import (get_admin, get_archives, get_categories,
+                             get_category_counts, get_links, merge_cached,
+                             site_cache)
+from bluelog.comment_buffer import comment_buffer
+from bluelog.compression import compress
+from bluelog.counts import count_cache, count_comments
+from bluelog.dependencies import affected_pages  # noqa: F401 注册页面依赖的跟踪
+from bluelog.emails import mail_queue
 from bluelog.extensions import (bootstrap, ckeditor, csrf, db, login_manager,
                                 mail, migrate, moment)
-from bluelog.models import Admin, Category, Comment, Link
+from bluelog.models import Admin, ArchiveMonth, Category, Post
+from bluelog.notifications import notifier
+from bluelog.page_cache import page_cache
+from bluelog.related import related_updater
 from bluelog.settings import config
-from bluelog.utils import jwt_authentication, test_before_request1, test_before_request2
+from bluelog.utils import QueryBudgetExceeded, jwt_authentication
 
 
 def create_app(config_name=None):
@@ -34,6 +49,7 @@ def create_app(config_name=None):
 
     app = Flask('bluelog')
     app.config.from_object(config[config_name])
+    app.config['BLUELOG_CONFIG_NAME'] = config_name  # 子进程（例如 flask freeze）用它创建相同配置的 app
 
     app.before_request(jwt_authentication)  # 添加请求钩子
 
@@ -44,6 +60,7 @@ def create_app(config_name=None):
     register_errors(app)  # 注册错误处理函数
     register_shell_context(app)  # 注册 shell 上下文处理函数
     register_template_context(app)  # 注册模板上下文处理函数
+    register_query_budget(app)  # 注册查询数量预算检查
     return app
 
 
@@ -72,7 +89,9 @@ def register_logger(app):
 def register_extensions(app):
     """初始化扩展
 
-    初始化 bootstrap, ckeditor, csrf, db, login_manager, mail, moment, migrate
+    初始化 bootstrap, ckeditor, csrf, db, login_manager, mail, moment, migrate,
+    site_cache, page_cache, count_cache, assets, compress, mail_queue, notifier,
+    comment_buffer, related_updater
 
     Args:
         app:Flask 对象
@@ -84,19 +103,29 @@ def register_extensions(app):
     db.init_app(app,)  # 取消 api_v1 蓝本的 csrf 保护
     login_manager.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
+    notifier.init_app(app)
+    comment_buffer.init_app(app)
+    related_updater.init_app(app)
     moment.init_app(app)
     migrate.init_app(app, db)
+    site_cache.init_app(app)
+    page_cache.init_app(app)
+    count_cache.init_app(app)
+    assets.init_app(app)
+    compress.init_app(app)
 
 
 def register_blueprints(app):
     """注册蓝图
 
-    注册 blog_bp, admin, auth_bp
+    注册 blog_bp, feeds_bp, admin, auth_bp
 
     Args:
         app:Flask 对象
     """
     app.register_blueprint(blog_bp)
+    app.register_blueprint(feeds_bp)
     app.register_blueprint(admin_bp, url_prefix='/admin')
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(api_v1, url_prefix='/api/v1')
@@ -121,9 +150,13 @@ def register_shell_context(app):
         使用 shell_context_processor 装饰器传入数据库对象
 
         Returns:
-            以{ 'db': db }传回数据库对象db
+            以{ 'db': db, 'page_cache': page_cache, 'mail_queue': mail_queue,
+            'comment_buffer': comment_buffer, 'related_updater': related_updater }
+            传回数据库对象db、页面缓存（可查看命中计数）、邮件队列（可查看发送和丢弃计数）、
+            评论缓冲区（可查看写入延迟）和相关文章的后台更新（可查看更新和丢弃计数）
         """
-        return dict(db=db)
+        return dict(db=db, page_cache=page_cache, mail_queue=mail_queue,
+                    comment_buffer=comment_buffer, related_updater=related_updater)
 
 
 def register_template_context(app):
@@ -139,35 +172,80 @@ def register_template_context(app):
     def make_template_content():
         """"为模板传入所需的上下文对象
 
-        传入 admin, categories, links, unread_comments 数据库查询对象
+        传入 admin, categories, category_counts, links, archives, unread_comments 数据库查询对象。
+        admin, categories, links 从进程级缓存中获取，并 merge 到当前会话中；
+        category_counts 为缓存的各分类文章数，archives 为缓存的归档月份，只包含数值，不需要 merge；
+        unread_comments 从计数缓存中获取。
 
         Returns:
             以
             {
             'admin': admin,
             'categories': categories,
+            'category_counts': category_counts,
             'links': links,
+            'archives': archives,
             'unread_comments': unread_comments
             }
             形式传回
             admin数据库查询对象
             categories数据库查询对象
+            category_counts分类 id 到文章数的字典
             links数据库查询对象
+            archives归档月份列表
             unread_coments数据库查询对象。
         """
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        links = Link.query.order_by(Link.name).all()
+        admin = merge_cached(get_admin())
+        categories = merge_cached(get_categories())
+        links = merge_cached(get_links())
+        category_counts = get_category_counts()
+        archives = get_archives()
         if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(reviewed=False).count()
+            unread_comments = count_comments('unread')
         else:
             unread_comments = None
         return dict(admin=admin,
                     categories=categories,
+                    category_counts=category_counts,
                     links=links,
+                    archives=archives,
                     unread_comments=unread_comments)
 
 
+def register_query_budget(app):
+    """注册每个请求的 SQL 查询数量检查
+
+    请求结束后统计 Flask-SQLAlchemy 记录的查询数量，超出 BLUELOG_QUERY_BUDGET
+    （或 BLUELOG_QUERY_BUDGETS 中端点的单独设置）时记录警告日志，严格模式下抛出
+    QueryBudgetExceeded，用于在开发和测试中发现 N+1 查询。
+
+    Args:
+        app:Flask 对象
+    """
+    @app.after_request
+    def check_query_budget(response):
+        """检查当前请求的查询数量
+
+        Args:
+            response:响应对象
+        Returns:
+            原响应对象
+        """
+        budget = app.config['BLUELOG_QUERY_BUDGETS'].get(
+            request.endpoint, app.config['BLUELOG_QUERY_BUDGET'])
+        if budget is None:
+            return response
+        queries = get_debug_queries()
+        if len(queries) > budget:
+            message = '%s issued %d SQL queries, budget is %d' % (
+                request.endpoint, len(queries), budget)
+            if app.config['BLUELOG_QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(message)
+            app.logger.warning('%s:\n%s', message,
+                               '\n'.join(query.statement for query in queries))
+        return response
+
+
 def register_errors(app):
     """注册错误处理函数
 
@@ -297,6 +375,177 @@ def register_commands(app):
         db.session.commit()
         click.echo('Done.')
 
+    @app.cli.command()
+    def recount():
+        """Recalculate the comment counters of posts and the monthly archive.
+
+        重新计算文章的评论总数和已审核评论数，以及归档中每个月的文章数
+        """
+        click.echo('Recounting comments...')
+        count = Post.recount_comments()
+        click.echo('Updated %d posts.' % count)
+        click.echo('Recounting the archive...')
+        count = ArchiveMonth.rebuild()
+        click.echo('Updated %d months.' % count)
+
+    @app.cli.command()
+    @click.option('--all', 'all_posts', is_flag=True, help='Rebuild excerpts of all posts.')
+    @click.option('--batch', default=500, help='Posts per transaction, default is 500.')
+    def excerpts(all_posts, batch):
+        """Backfill excerpts, word counts and reading times of posts.
+
+        为没有摘要的文章生成摘要、字数和阅读时间，按 id 分批处理，每批提交一次
+
+        Args:
+            all_posts:为 True 时重新生成所有文章的摘要
+            batch:每批处理的文章数量
+        """
+        query = Post.query
+        if not all_posts:
+            query = query.filter(Post.excerpt.is_(None))
+        last_id = 0
+        count = 0
+        while True:
+            posts = query.filter(Post.id > last_id).order_by(Post.id).limit(batch).all()
+            if not posts:
+                break
+            for post in posts:
+                post.set_body(post.body)
+            last_id = posts[-1].id
+            count += len(posts)
+            db.session.commit()
+            click.echo('Updated %d posts...' % count)
+        click.echo('Done.')
+
+    @app.cli.command()
+    @click.option('--batch', default=500, help='Posts per transaction, default is 500.')
+    def reindex(batch):
+        """Rebuild the full-text search index.
+
+        清空搜索索引后按 id 分批重新建立，重建期间搜索结果不完整
+
+        Args:
+            batch:每批处理的文章数量
+        """
+        from bluelog.search import reindex as rebuild_index
+
+        click.echo('Rebuilding the search index...')
+        for count in rebuild_index(batch):
+            click.echo('Indexed %d posts...' % count)
+        click.echo('Done.')
+
+    @app.cli.command()
+    @click.option('--top', type=int, help='Related posts per post, default is BLUELOG_RELATED_POSTS.')
+    @click.option('--features', type=int, help='Maximum TF-IDF features, default is BLUELOG_RELATED_FEATURES.')
+    @click.option('--block', type=int, help='Posts per similarity block, default is BLUELOG_RELATED_BLOCK.')
+    def related(top, features, block):
+        """Rebuild the related posts of all posts.
+
+        用所有文章的 TF-IDF 向量分块计算余弦相似度，保存每篇文章最相似的若干篇
+
+        Args:
+            top:每篇文章保存的相关文章数
+            features:特征词的最大数量
+            block:每次计算相似度的文章数
+        """
+        from bluelog.related import rebuild
+
+        config = app.config
+        click.echo('Computing related posts...')
+        for count in rebuild(top or config['BLUELOG_RELATED_POSTS'],
+                             features or config['BLUELOG_RELATED_FEATURES'],
+                             block or config['BLUELOG_RELATED_BLOCK'],
+                             config['BLUELOG_RELATED_MIN_SCORE']):
+            click.echo('Processed %d posts...' % count)
+        page_cache.clear()
+        click.echo('Done.')
+
+    @app.cli.command('assets')
+    @click.option('--brotli/--no-brotli', default=True, help='Also write brotli files, default is on.')
+    def build_assets(brotli):
+        """Fingerprint and precompress the static files.
+
+        把静态文件以带内容哈希的文件名复制到 BLUELOG_ASSETS_DIR，并生成 gzip 和 brotli 压缩文件；
+        BLUELOG_ASSETS 为 True 时应用使用这些文件，修改静态文件后需要重新运行并重启应用
+
+        Args:
+            brotli:是否生成 brotli 文件
+        """
+        from bluelog.assets import brotli as brotli_module, build_assets as build
+
+        config = app.config
+        if brotli and brotli_module is None:
+            click.echo('The brotli package is not installed, only gzip files are written.')
+        click.echo('Building static assets...')
+        stats = build(app.static_folder, config['BLUELOG_ASSETS_DIR'],
+                      config['BLUELOG_ASSETS_UNVERSIONED'], brotli)
+        click.echo('Done. %d files, %d bytes; %d bytes compressible, %d bytes gzip, '
+                   '%d bytes brotli.' % (stats['files'], stats['size'], stats['compressed_size'],
+                                         stats['gzip_size'], stats['brotli_size']))
+
+    @app.cli.command()
+    @click.option('--all', 'send_all', is_flag=True, help='Send all pending notifications now.')
+    @click.option('--base-url', default=None, help='Site URL used in links, default is BLUELOG_FREEZE_BASE_URL.')
+    def digest(send_all, base_url):
+        """Send the pending comment notification digests.
+
+        摘要模式下把等待超过 BLUELOG_DIGEST_WINDOW 秒的评论提醒按收件人合并发送，
+        BLUELOG_DIGEST_AUTO_SEND 为 False 时需要定时运行
+
+        Args:
+            send_all:是否不等待合并时间，立即发送所有提醒
+            base_url:邮件中链接使用的站点地址
+        """
+        from bluelog.notifications import send_digests
+
+        config = app.config
+        with app.test_request_context(base_url=base_url or config['BLUELOG_FREEZE_BASE_URL']):
+            count = send_digests(0 if send_all else config['BLUELOG_DIGEST_WINDOW'])
+        mail_queue.shutdown()
+        click.echo('Sent %d digests.' % count)
+
+    @app.cli.command()
+    @click.option('--output', type=click.Path(file_okay=False),
+                  help='Output directory, default is BLUELOG_FREEZE_DIR.')
+    @click.option('--workers', type=int, help='Rendering processes, default is BLUELOG_FREEZE_WORKERS.')
+    @click.option('--theme', 'themes', multiple=True,
+                  help='Theme to render, can be given more than once, default is all themes.')
+    @click.option('--base-url', default=None, help='Site URL used in feeds, default is BLUELOG_FREEZE_BASE_URL.')
+    @click.option('--incremental', is_flag=True, help='Only render the pages queued by data changes.')
+    def freeze(output, workers, themes, base_url, incremental):
+        """Render all public pages to static HTML files.
+
+        用进程池把主页、分类、文章的每一页评论和关于页面渲染为静态文件，供 CDN 托管；
+        内容没有变化的文件不会重写。使用 --incremental 时只生成数据修改后记录在队列中的页面
+
+        Args:
+            output:输出目录
+            workers:渲染页面的进程数
+            themes:要生成的主题，第一个主题输出在根目录
+            base_url:订阅源和站点地图中使用的站点地址
+            incremental:是否只生成队列中的页面
+        """
+        from bluelog.freeze import freeze as freeze_site
+
+        config = app.config
+        themes = list(themes) or sorted(config['BLUELOG_THEMES'],
+                                        key=lambda name: name != 'perfect_blue')
+        for theme in themes:
+            if theme not in config['BLUELOG_THEMES']:
+                raise click.BadParameter('Unknown theme %s.' % theme, param_hint='--theme')
+
+        click.echo('Freezing the site...')
+        for stats in freeze_site(output or config['BLUELOG_FREEZE_DIR'], themes,
+                                 workers or config['BLUELOG_FREEZE_WORKERS'] or os.cpu_count(),
+                                 base_url or config['BLUELOG_FREEZE_BASE_URL'], incremental):
+            click.echo('Rendered %d pages, %.1f pages/sec...' % (stats['pages'],
+                                                               stats['pages_per_sec']))
+        for filename, status in stats['errors']:
+            click.echo('Failed to render %s: %s' % (filename, status), err=True)
+        click.echo('Done. %d written, %d unchanged, %d removed, %d static files copied '
+                   'in %.1f seconds.' % (stats['written'], stats['unchanged'], stats['removed'],
+                                        stats['static'], stats['elapsed']))
+
     @app.cli.command()
     @click.option('--category',
                   default=10,
@@ -309,24 +558,36 @@ def register_commands(app):
                   help='Quantity of comments, default is 500.')
     @click.option('--url',
                   default=5,
-                  help='Quantity of comments, default is 5.')
-    def forge(category, post, comment, url):
+                  help='Quantity of links, default is 5.')
+    @click.option('--seed', type=int, help='Random seed, the same seed generates the same data.')
+    @click.option('--skew', default=3.0, help='How much comments focus on hot posts, 1 is uniform, default is 3.')
+    @click.option('--replies', default=0.3, help='Ratio of replies in comments, default is 0.3.')
+    @click.option('--workers', default=1, help='Processes generating comments, default is 1.')
+    def forge(category, post, comment, url, seed, skew, replies, workers):
         """Generates the fake categories, posts, and comments.
 
-        生成假数据用于展示效果。
+        用批量 INSERT 生成假数据，用于展示效果和性能测试；评论集中在少数热门文章上，
+        有很深的回复链，可以用多个进程并行生成
 
         Args:
             category:生成分类数量，默认为10
             post:生成文章数量，默认为50
             comment:生成评论数量，默认为500
             url:生成链接数量，默认为5
+            seed:随机数种子
+            skew:评论集中在热门文章上的程度
+            replies:回复在评论中所占的比例
+            workers:生成评论的进程数
 
         """
         from bluelog.fakes import (fake_admin, fake_categories, fake_posts,
-                                   fake_comments, fake_url)
+                                   fake_comments, fake_url, seed as seed_fakes)
 
+        if seed is not None:
+            seed_fakes(seed)
         db.drop_all()
         db.create_all()
+        start = time.time()
 
         click.echo('Generating the administrator...')
         fake_admin()
@@ -337,10 +598,14 @@ def register_commands(app):
         click.echo('Generating %d posts...' % post)
         fake_posts(post)
 
-        click.echo('Gemerating %d comments..' % comment)
-        fake_comments(comment)
+        click.echo('Generating %d comments..' % comment)
+        comment_start = time.time()
+        for count in fake_comments(comment, skew, replies, workers):
+            click.echo('Inserted %d comments, %.0f comments/sec...' % (
+                count, count / (time.time() - comment_start)))
 
         click.echo('Generating %d urls..' % url)
         fake_url(url)
 
-        click.echo('Done.')
+        page_cache.clear()
+        click.echo('Done in %.1f seconds.' % (time.time() - start))
@@ -1,14 +1,23 @@
 import re
+from datetime import datetime
+
 from flask import current_app, g, jsonify, request, url_for
 from flask import json
 from flask.views import MethodView
+from sqlalchemy import func
 
 from bluelog.apis.v1 import api_v1
 from bluelog.apis.v1.auth import auth_required, generate_token, AuthorizationResource, jwt_login_required
 from bluelog.apis.v1.errors import api_abort, ValidationError
-from bluelog.apis.v1.schemas import post_schem, posts_schem, category_schem
+from bluelog.apis.v1.schemas import post_schem, posts_schem, category_schem, search_schem
 from bluelog.models import Admin, Post, Category
+from bluelog.caching import get_categories
+from bluelog.counts import count_posts
 from bluelog.extensions import db
+from bluelog.moderation import approve_comments, delete_comments
+from bluelog.pagination import KeysetPagination, get_cursors, offset_paginate
+from bluelog.search import search_posts
+from bluelog.utils import conditional, make_etag
 
 
 def get_post_body():
@@ -19,6 +28,28 @@ def get_post_body():
     return body
 
 
+def post_validator(post_id):
+    """文章的验证值，由文章的最后修改时间生成"""
+    updated_at = db.session.query(Post.updated_at).filter_by(id=post_id).scalar()
+    if updated_at is None:
+        return None
+    return make_etag('post', post_id, updated_at), updated_at
+
+
+def posts_validator():
+    """文章列表的验证值，由查询字符串、全部文章的最后修改时间和文章数生成"""
+    updated_at = db.session.query(func.max(Post.updated_at)).scalar()
+    return make_etag(request.full_path, updated_at, count_posts()), updated_at
+
+
+def category_validator(category_id):
+    """分类的验证值，由缓存的分类数据生成"""
+    for category in get_categories():
+        if category.id == category_id:
+            return make_etag('category', category.id, category.name), None
+    return None
+
+
 class IndexAPI(MethodView):
 
     def get(self):
@@ -32,6 +63,7 @@ class PostAPI(MethodView):
     # 装饰器
     # decorator = [auth_required]
     # @auth_required
+    @conditional(post_validator)
     def get(self, post_id):
         post = Post.query.get_or_404(post_id)
         return jsonify(post_schem(post))
@@ -39,7 +71,7 @@ class PostAPI(MethodView):
     @jwt_login_required
     def put(self, post_id):
         post = Post.query.get_or_404(post_id)
-        post.body = get_post_body(post)
+        post.set_body(get_post_body())
         db.session.commit()
         return '', 204
     
@@ -49,8 +81,9 @@ class PostAPI(MethodView):
         if post:
             data = request.get_json()
             post.title = data.get('title')
-            post.body = data.get('body')
-
+            post.set_body(data.get('body'))
+            db.session.commit()
+            return '', 204
         else:
             return jsonify(message="文章不存在")
 
@@ -93,9 +126,37 @@ class AuthTokenAPI(MethodView):
 
 
 class PostsAPI(MethodView):
+    @conditional(posts_validator)
     def get(self):
+        """
+        文章列表，默认使用 after/before 游标分页，count=1 时返回总数；
+        传入 page 参数时使用页码分页
+        """
+        per_page = current_app.config['BLUELOG_POST_PER_PAGE']
+        if 'page' in request.args:
+            return self._get_page(per_page)
+
+        try:
+            after, before = get_cursors()
+        except ValueError:
+            raise ValidationError('The cursor was invalid.')
+        with_total = request.args.get('count', type=int) == 1
+        pagination = KeysetPagination(Post.query, Post, per_page, after=after, before=before,
+                                      with_total=with_total, total=count_posts)
+        extra = {'count': 1} if with_total else {}
+        current = url_for('.posts', _external=True, **request.args.to_dict())
+        prev = None
+        if pagination.prev_cursor:
+            prev = url_for('.posts', before=pagination.prev_cursor, _external=True, **extra)
+        next = None
+        if pagination.next_cursor:
+            next = url_for('.posts', after=pagination.next_cursor, _external=True, **extra)
+        return jsonify(posts_schem(pagination.items, current, prev, next, pagination))
+
+    def _get_page(self, per_page):
         page = request.args.get('page', 1, type=int)
-        pagination = Post.query.paginate(page, per_page=current_app.config['BLUELOG_POST_PER_PAGE'])
+        pagination = offset_paginate(Post.query.order_by(Post.timestamp.desc(), Post.id.desc()),
+                                     page, per_page, total=count_posts)
         posts = pagination.items
         current = url_for('.posts', page=page, _external=True)
         prev = None
@@ -111,14 +172,73 @@ class CategoryAPI(MethodView):
 
     # decorator = [auth_required]
     # @auth_required
+    @conditional(category_validator)
     def get(self, category_id):
         category = Category.query.get_or_404(category_id)
         return jsonify(category_schem(category))
 
 
+class SearchAPI(MethodView):
+
+    def get(self):
+        """按相关度搜索文章，q 为搜索字符串，page 为页码"""
+        q = request.args.get('q', '').strip()
+        if not q:
+            raise ValidationError('The search query was empty.')
+        page = request.args.get('page', 1, type=int)
+        per_page = current_app.config['BLUELOG_SEARCH_RESULT_PER_PAGE']
+        pagination = search_posts(q, page, per_page, with_body=True)
+        return jsonify(search_schem(q, pagination))
+
+
+class CommentModerationAPI(MethodView):
+    """批量接受或删除评论
+
+    请求体为 JSON 对象，ids（评论 id 列表）、filter（'all'、'unread' 或 'admin'）、post_id 和
+    older_than（ISO 格式的 UTC 时间）同时满足的评论被处理，至少需要一个条件。
+    """
+
+    def __init__(self, action):
+        self.action = action
+
+    @jwt_login_required
+    def post(self):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise ValidationError('The request body must be a JSON object.')
+        ids = data.get('ids')
+        if ids is not None and (not isinstance(ids, list)
+                                or not all(isinstance(id, int) for id in ids)):
+            raise ValidationError('The ids must be a list of integers.')
+        post_id = data.get('post_id')
+        if post_id is not None and not isinstance(post_id, int):
+            raise ValidationError('The post_id must be an integer.')
+        older_than = data.get('older_than')
+        if older_than is not None:
+            try:
+                older_than = datetime.fromisoformat(str(older_than))
+            except ValueError:
+                raise ValidationError('The older_than must be an ISO 8601 time.')
+        selectors = dict(ids=ids, filter_rule=data.get('filter', 'all'), post_id=post_id,
+                         older_than=older_than)
+        try:
+            if self.action == 'approve':
+                count = approve_comments(**selectors)
+            else:
+                count = delete_comments(**selectors)
+        except ValueError as e:
+            raise ValidationError(e.args[0])
+        return jsonify(action=self.action, count=count)
+
+
 api_v1.add_url_rule('/', view_func=IndexAPI.as_view('index'), methods=['GET'])
 api_v1.add_url_rule('/oauth/token', view_func=AuthTokenAPI.as_view('token'), methods=['POST'])
 api_v1.add_url_rule('/postauth', view_func=AuthorizationResource.as_view('postauth'), methods=['GET', 'POST'])
 api_v1.add_url_rule('/posts', view_func=PostsAPI.as_view('posts'), methods=['GET', 'POST'])
 api_v1.add_url_rule('/post/<int:post_id>', view_func=PostAPI.as_view('post'), methods=['GET', 'PUT', 'PATCH', 'Delete'])
 api_v1.add_url_rule('/category/<int:category_id>', view_func=CategoryAPI.as_view('category'), methods=['GET', 'POST'])
+api_v1.add_url_rule('/search', view_func=SearchAPI.as_view('search'), methods=['GET'])
+api_v1.add_url_rule('/comments/approve', view_func=CommentModerationAPI.as_view('approve_comments', action='approve'),
+                    methods=['POST'])
+api_v1.add_url_rule('/comments/delete', view_func=CommentModerationAPI.as_view('delete_comments', action='delete'),
+                    methods=['POST'])
@@ -1,16 +1,33 @@
 from flask import url_for
 
+from bluelog.pagination import KeysetPagination
+
 def post_schem(post):
     return {
         'id': post.id,
         'title': post.title,
         'body': post.body,
+        'excerpt': post.excerpt,
+        'word_count': post.word_count,
+        'reading_time': post.reading_time,
         'timestamp': post.timestamp,
         'can_comment': post.can_comment,
         'category_id': post.category_id,
     }
 
 def posts_schem(posts, current, prev, next, pagination):
+    if isinstance(pagination, KeysetPagination):
+        # 游标分页：不透明的游标，只有请求时才有总数
+        return {
+            'self': current,
+            'posts': [post_schem(post) for post in posts],
+            'prev': prev,
+            'first': url_for('.posts', _external=True),
+            'next': next,
+            'prev_cursor': pagination.prev_cursor,
+            'next_cursor': pagination.next_cursor,
+            'count': pagination.total,
+        }
     return {
         'self': current,
         'posts': [post_schem(post) for post in posts],
@@ -21,6 +38,22 @@ def posts_schem(posts, current, prev, next, pagination):
         'count': pagination.total,
     }
 
+def search_schem(q, pagination):
+    prev = None
+    if pagination.has_prev:
+        prev = url_for('.search', q=q, page=pagination.prev_num, _external=True)
+    next = None
+    if pagination.has_next:
+        next = url_for('.search', q=q, page=pagination.next_num, _external=True)
+    return {
+        'self': url_for('.search', q=q, page=pagination.page, _external=True),
+        'q': q,
+        'posts': [post_schem(post) for post in pagination.items],
+        'prev': prev,
+        'next': next,
+        'count': pagination.total,
+    }
+
 def category_schem(category):
     return {
         'id': category.id,
@@ -0,0 +1,198 @@
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import tempfile
+
+from flask import current_app, request, send_file
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖，没有安装时只生成 gzip 文件
+    brotli = None
+
+MANIFEST_FILE = 'manifest.json'
+# 小于这个字节数的文件压缩收益不大
+MIN_COMPRESS_SIZE = 256
+# 可以压缩的文件类型，图片和字体已经是压缩格式
+_compressible_types = ('text/', 'application/javascript', 'application/json',
+                       'application/xml', 'image/svg+xml')
+# 优先使用压缩率更高的编码
+_encodings = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _compressible(filename):
+    mimetype = mimetypes.guess_type(filename)[0] or ''
+    return mimetype.startswith(_compressible_types)
+
+
+def _versioned_name(filename, digest):
+    """在扩展名前插入内容哈希，例如 css/style.css 转为 css/style.1a2b3c4d5e6f.css"""
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def _gzip(data):
+    # mtime 固定为 0，相同的内容每次生成相同的压缩文件
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def _write(path, data):
+    """内容没有变化时不重写文件，否则先写临时文件再原子替换"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return
+    except OSError:
+        pass
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def build_assets(static_folder, directory, unversioned=(), use_brotli=True):
+    """给静态文件加上内容哈希并生成预压缩文件
+
+    每个文件以 name.<哈希>.ext 的文件名复制到 directory 中，文本类文件同时生成 .gz 和 .br 文件
+    （只保存比原文件小的压缩结果）。清单 manifest.json 记录原文件名到新文件名和可用编码的对应关系。
+    旧版本的文件不会删除，仍然引用旧文件名的缓存页面可以继续使用。
+
+    Args:
+        static_folder:静态文件目录
+        directory:输出目录
+        unversioned:保留原文件名的路径前缀，例如根据自身文件名查找其他文件的 CKEditor
+        use_brotli:是否生成 brotli 文件，没有安装 brotli 时忽略
+    Returns:
+        统计字典：files 为文件数，size 为总大小，compressed_size 为有压缩版本的文件的原始大小，
+        gzip_size 和 brotli_size 为压缩后的大小
+    """
+    manifest = {}
+    stats = dict(files=0, size=0, compressed_size=0, gzip_size=0, brotli_size=0)
+    use_brotli = use_brotli and brotli is not None
+    for root, dirs, names in os.walk(static_folder):
+        dirs.sort()
+        for name in sorted(names):
+            source = os.path.join(root, name)
+            filename = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            if filename.startswith(tuple(unversioned)):
+                stored = filename
+            else:
+                stored = _versioned_name(filename, hashlib.sha1(data).hexdigest()[:12])
+            target = os.path.join(directory, stored)
+            _write(target, data)
+            stats['files'] += 1
+            stats['size'] += len(data)
+
+            encodings = []
+            if _compressible(filename) and len(data) >= MIN_COMPRESS_SIZE:
+                variants = [('gzip', '.gz', _gzip(data))]
+                if use_brotli:
+                    variants.insert(0, ('br', '.br', brotli.compress(data, quality=11)))
+                for encoding, suffix, compressed in variants:
+                    if len(compressed) < len(data):
+                        _write(target + suffix, compressed)
+                        encodings.append(encoding)
+                        stats['gzip_size' if encoding == 'gzip' else 'brotli_size'] += len(
+                            compressed)
+                if encodings:
+                    stats['compressed_size'] += len(data)
+            manifest[filename] = dict(name=stored, encodings=encodings)
+    _write(os.path.join(directory, MANIFEST_FILE),
+           json.dumps(manifest, sort_keys=True, indent=1).encode('utf-8'))
+    return stats
+
+
+class Assets(object):
+    """使用 flask assets 生成的带哈希、预压缩的静态文件
+
+    启用后 url_for('static', filename=...) 生成带哈希的文件名，static 视图按 Accept-Encoding
+    返回 br、gzip 或原始文件；带哈希的文件内容不会改变，使用 immutable 的长期缓存。
+    用原文件名请求（例如 CKEditor 加载自身的插件）时同样返回预压缩文件，但使用默认的缓存时间。
+    没有生成过的文件仍由 Flask 的 static 视图处理。
+
+    Attributes:
+        directory: flask assets 的输出目录
+        max_age: 带哈希文件的缓存时间（秒）
+        manifest: 原文件名到 {'name': 新文件名, 'encodings': 可用编码} 的字典，未启用时为空
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.max_age = 365 * 24 * 3600
+        self.manifest = {}
+        self._stored = {}
+        self._send_static_file = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """读取清单，替换 app 的 static 视图
+
+        BLUELOG_ASSETS 为 False 或还没有运行 flask assets 时不做任何修改。
+        """
+        self.directory = app.config['BLUELOG_ASSETS_DIR']
+        self.max_age = app.config['BLUELOG_ASSETS_MAX_AGE']
+        app.extensions['assets'] = self
+        if not app.config['BLUELOG_ASSETS']:
+            return
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE)) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            app.logger.warning('Static assets are not built, run flask assets first.')
+            return
+        self._stored = {entry['name']: original for original, entry in self.manifest.items()}
+        self._send_static_file = app.view_functions['static']
+        app.view_functions['static'] = self.send_static_file
+        app.url_defaults(self._url_defaults)
+
+    def _url_defaults(self, endpoint, values):
+        """把 static 端点的文件名替换为带哈希的文件名"""
+        if endpoint == 'static':
+            entry = self.manifest.get(values.get('filename'))
+            if entry is not None:
+                values['filename'] = entry['name']
+
+    def send_static_file(self, filename):
+        """返回静态文件，按 Accept-Encoding 选择预压缩的版本"""
+        original = self._stored.get(filename)
+        if original is not None:
+            immutable = original != filename
+        elif filename in self.manifest:
+            original, immutable = filename, False
+        else:
+            return self._send_static_file(filename=filename)
+
+        entry = self.manifest[original]
+        path = os.path.join(self.directory, entry['name'])
+        content_encoding = None
+        for encoding, suffix in _encodings:
+            if encoding in entry['encodings'] and request.accept_encodings[encoding]:
+                path += suffix
+                content_encoding = encoding
+                break
+        max_age = self.max_age if immutable else current_app.get_send_file_max_age(original)
+        mimetype = mimetypes.guess_type(original)[0] or 'application/octet-stream'
+        response = send_file(path, mimetype=mimetype,
+                             conditional=True, cache_timeout=max_age)
+        if content_encoding is not None:
+            response.headers['Content-Encoding'] = content_encoding
+        if entry['encodings']:
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+        return response
+
+
+assets = Assets()
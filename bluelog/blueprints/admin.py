@@ -1,14 +1,20 @@
+from datetime import datetime, timedelta
+
 from flask import (Blueprint, render_template, request,
                    current_app, redirect, flash,
-                   url_for)
+                   url_for, abort)
 
 
 from flask_login import login_required, current_user
+from sqlalchemy.orm import defer, joinedload
 
 
+from bluelog.counts import comment_filters, count_comments, count_posts
 from bluelog.extensions import db
 from bluelog.models import Category, Post, Comment, Link, Admin
 from bluelog.forms import PostForm, CategoryForm, LinkForm, SettingForm
+from bluelog.moderation import approve_comments, delete_comments
+from bluelog.pagination import paginate
 from bluelog.utils import redirect_back
 
 admin_bp = Blueprint('admin', __name__)
@@ -46,11 +52,9 @@ def manage_post():
     Returns:
         文章管理界面
     """
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(
-        Post.timestamp.desc()
-    ).paginate(page,
-               per_page=current_app.config['BLUELOG_MANAGE_POST_PER_PAGE'])
+    pagination = paginate(Post.query.options(joinedload(Post.category), defer(Post.body)), Post,
+                          current_app.config['BLUELOG_MANAGE_POST_PER_PAGE'],
+                          total=count_posts)
     posts = pagination.items
     return render_template('admin/manage_post.html',
                            pagination=pagination,
@@ -78,18 +82,17 @@ def manage_comment():
         评论管理界面
     """
     filter_rule = request.args.get('filter', 'all')  # 从查询字符串获取过滤规则
-    page = request.args.get('page', 1, type=int)
+    if filter_rule not in comment_filters:
+        filter_rule = 'all'
+    post_id = request.args.get('post_id', type=int)  # 只显示一篇文章的评论
     per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']
-    if filter_rule == 'unread':
-        filtered_comments = Comment.query.filter_by(reviewed=False)
-    elif filter_rule == 'admin':
-        filtered_comments = Comment.query.filter_by(from_admin=True)
-    else:
-        filtered_comments = Comment.query
+    filtered_comments = comment_filters[filter_rule]()
+    total = lambda: count_comments(filter_rule)  # noqa: E731
+    if post_id is not None:
+        filtered_comments = filtered_comments.filter(Comment.post_id == post_id)
+        total = filtered_comments.count
 
-    pagination = filtered_comments.order_by(
-        Comment.timestamp.desc()
-    ).paginate(page, per_page=per_page)
+    pagination = paginate(filtered_comments, Comment, per_page, total=total)
     comments = pagination.items
     return render_template('admin/manage_comment.html',
                            comments=comments,
@@ -109,7 +112,8 @@ def new_post():
         title = form.title.data
         body = form.body.data
         category = Category.query.get(form.category.data)
-        post = Post(title=title, body=body, category=category)
+        post = Post(title=title, category=category)
+        post.set_body(body)
         db.session.add(post)
         db.session.commit()
         flash('Post Created', 'Success')
@@ -132,7 +136,7 @@ def edit_post(post_id):
     post = Post.query.get_or_404(post_id)
     if form.validate_on_submit():
         post.title = form.title.data
-        post.body = form.body.data
+        post.set_body(form.body.data)
         post.category = Category.query.get(form.category.data)
         db.session.commit()
         flash('Post updated.', 'success')
@@ -209,6 +213,44 @@ def approve_comment(comment_id):
     return redirect_back()
 
 
+@admin_bp.route('/comment/bulk', methods=['POST'])
+@login_required
+def bulk_comments():
+    """批量接受或删除评论
+
+    scope 为 'selected' 时处理勾选的评论，为 'filter' 时处理当前筛选条件（过滤规则和文章）下的
+    所有评论；填写了 older_than 时只处理这么多天之前的评论。
+    """
+    action = request.form.get('action')
+    if action not in ('approve', 'delete'):
+        abort(400)
+    selectors = dict(filter_rule=request.form.get('filter', 'all'),
+                     post_id=request.form.get('post_id', type=int))
+    if selectors['filter_rule'] not in comment_filters:
+        selectors['filter_rule'] = 'all'
+    if request.form.get('scope') != 'filter':
+        selectors['ids'] = request.form.getlist('ids', type=int)
+        if not selectors['ids']:
+            flash('没有选择评论.', 'warning')
+            return redirect_back()
+    days = request.form.get('older_than', type=int)
+    if days:
+        selectors['older_than'] = datetime.utcnow() - timedelta(days=days)
+    try:
+        if action == 'approve':
+            count = approve_comments(**selectors)
+        else:
+            count = delete_comments(**selectors)
+    except ValueError:  # 没有任何筛选条件
+        flash('请选择评论或筛选条件.', 'warning')
+        return redirect_back()
+    if action == 'approve':
+        flash('%d comments published.' % count, 'success')
+    else:
+        flash('%d 条评论删除成功.' % count, 'success')
+    return redirect_back()
+
+
 @admin_bp.route('/category/<int:category_id>/delete', methods=['post'])
 @login_required
 def delete_category(category_id):
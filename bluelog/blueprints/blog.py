@@ -1,25 +1,58 @@
+from datetime import datetime
+
 from flask import (Blueprint, current_app, render_template,
                    request, redirect, url_for,
-                   abort, make_response, flash)
+                   abort, make_response, flash, session)
 from flask_login import current_user
+from sqlalchemy import func
+from sqlalchemy.orm import defer, joinedload
+
+from bluelog.caching import get_archives, get_site_version
 
+from bluelog.comment_buffer import comment_buffer
+from bluelog.counts import count_posts
 from bluelog.models import Category, Comment, Post
-from bluelog.emails import send_new_comment_email, send_new_reply_email
 from bluelog.extensions import db
 from bluelog.forms import AdminCommentForm, CommentForm
-from bluelog.utils import redirect_back
+from bluelog.notifications import notifier
+from bluelog.page_cache import page_cache
+from bluelog.pagination import paginate
+from bluelog.related import related_posts, related_version
+from bluelog.search import search_posts
+from bluelog.threads import paginate_comments, paginate_threads
+from bluelog.utils import conditional, current_theme, make_etag, redirect_back
 
 blog_bp = Blueprint('blog', __name__)
 
 
+def page_validator(**kwargs):
+    """博客页面的 HTTP 缓存验证值
+
+    页面中的侧边栏包含所有文章的信息，所以用全部文章的最后修改时间和文章数作为版本，
+    再加上请求的路径、主题和侧边栏数据的版本；文章页面还包括相关文章列表的版本。
+    登录用户和有闪现消息的请求不做验证。
+
+    Returns:
+        (etag, last_modified) 元组，或 None
+    """
+    if current_user.is_authenticated or '_flashes' in session:
+        return None
+    updated_at = db.session.query(func.max(Post.updated_at)).scalar()
+    parts = [request.full_path, current_theme(), updated_at, count_posts(), get_site_version()]
+    if 'post_id' in kwargs:
+        parts.append(related_version(kwargs['post_id']))
+    etag = make_etag(*parts)
+    return etag, updated_at
+
+
 @blog_bp.route('/')
+@conditional(page_validator)
+@page_cache.cached
 def index():
     """主页函数"""
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.order_by(
-        Post.timestamp.desc()
-    ).paginate(page, per_page=per_page)
+    pagination = paginate(Post.query.options(joinedload(Post.category), defer(Post.body)),
+                          Post, per_page, total=count_posts)
     posts = pagination.items
     return render_template('blog/index.html',
                            pagination=pagination,
@@ -27,20 +60,37 @@ def index():
 
 
 @blog_bp.route('/about')
+@page_cache.cached
 def about():
     """管理员简介"""
     return render_template('blog/about.html')
 
 
+@blog_bp.route('/search')
+@page_cache.cached
+def search():
+    """搜索文章"""
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['BLUELOG_SEARCH_RESULT_PER_PAGE']
+    pagination = search_posts(q, page, per_page)
+    posts = pagination.items
+    return render_template('blog/search.html',
+                           q=q,
+                           pagination=pagination,
+                           posts=posts)
+
+
 @blog_bp.route('/category/<int:category_id>')
+@conditional(page_validator)
+@page_cache.cached
 def show_category(category_id):
     """显示分类"""
     category = Category.query.get_or_404(category_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(
-        Post.timestamp.desc()
-    ).paginate(page, per_page=per_page)
+    pagination = paginate(Post.query.with_parent(category).options(
+        joinedload(Post.category), defer(Post.body)
+    ), Post, per_page, total=lambda: count_posts(category.id))
     posts = pagination.items
     return render_template('blog/category.html',
                            category=category,
@@ -48,16 +98,58 @@ def show_category(category_id):
                            posts=posts)
 
 
+@blog_bp.route('/archive')
+@conditional(page_validator)
+@page_cache.cached
+def archives():
+    """归档：按年份列出每个月的文章数"""
+    return render_template('blog/archives.html')
+
+
+@blog_bp.route('/archive/<int:year>/<int:month>')
+@conditional(page_validator)
+@page_cache.cached
+def show_archive(year, month):
+    """显示某个月发布的文章
+
+    用 timestamp 索引的范围扫描读取这个月的文章，总数来自归档汇总表，不执行 COUNT 查询。
+    """
+    if not 1 <= month <= 12 or not datetime.min.year <= year < datetime.max.year:
+        abort(404)
+    count = next((archive.post_count for archive in get_archives()
+                  if (archive.year, archive.month) == (year, month)), 0)
+    if not count:
+        abort(404)
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    per_page = current_app.config['BLUELOG_POST_PER_PAGE']
+    pagination = paginate(Post.query.filter(
+        Post.timestamp >= start, Post.timestamp < end
+    ).options(joinedload(Post.category), defer(Post.body)), Post, per_page, total=lambda: count)
+    posts = pagination.items
+    return render_template('blog/archive.html',
+                           year=year,
+                           month=month,
+                           pagination=pagination,
+                           posts=posts)
+
+
 @blog_bp.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@conditional(page_validator)
+@page_cache.cached
 def show_post(post_id):
     """显示文章"""
     post = Post.query.get_or_404(post_id)
     page = request.args.get('page', 1, type=int)
     perpage = current_app.config['BLUELOG_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(post).filter_by(
-        reviewed=True
-    ).order_by(Comment.timestamp.asc()).paginate(page, perpage)
+    threads = None
+    if current_app.config['BLUELOG_COMMENT_THREADED']:
+        pagination, threads = paginate_threads(
+            post, page, perpage, current_app.config['BLUELOG_COMMENT_MAX_LEVEL'])
+    else:
+        pagination = paginate_comments(post, page, perpage)
     comments = pagination.items
+    related = related_posts(post.id)
 
     if current_user.is_authenticated:  # 如果当前用户已登录，使用管理员表单
         form = AdminCommentForm()
@@ -76,6 +168,16 @@ def show_post(post_id):
         email = form.email.data
         site = form.site.data
         body = form.body.data
+        replied_comment = None
+        replied_id = request.args.get('reply')
+        if replied_id:  # 如果 URL 中 reply 查询参数存在，那么说明是回复
+            # 只能回复同一篇文章的评论，删除文章时级联删除的回复都属于这篇文章
+            replied_comment = Comment.query.filter_by(id=replied_id, post_id=post.id).first_or_404()
+        # 匿名评论可以先写入缓冲区，由后台线程批量插入并发送提醒；管理员的评论同步写入
+        if not from_admin and comment_buffer.add(post.id, replied_comment and replied_comment.id,
+                                                 author, email, site, body):
+            flash('Thanks, your comment will be published after reviewed.', 'info')
+            return redirect(url_for('.show_post', post_id=post.id))
         comment = Comment(
             author=author,
             email=email,
@@ -85,11 +187,11 @@ def show_post(post_id):
             post=post,
             reviewed=reviewed
         )
-        replied_id = request.args.get('reply')
-        if replied_id:  # 如果 URL 中 reply 查询参数存在，那么说明是回复
-            replied_comment = Comment.query.get_or_404(replied_id)
+        if replied_comment is not None:
             comment.replied = replied_comment
-            send_new_reply_email(replied_comment)  # 发邮件给被回复用户
+            notifier.new_reply(replied_comment)  # 提醒被回复用户
+        if not current_user.is_authenticated:
+            notifier.new_comment(post)  # 提醒管理员审核
         db.session.add(comment)
         db.session.commit()
         if current_user.is_authenticated:  # 根据登录状态现实不同的提示信息
@@ -97,21 +199,23 @@ def show_post(post_id):
         else:
             flash('Thanks, your comment will be published after reviewed.',
                   'info')
-            send_new_comment_email(post)  # 发送提醒邮件给管理员
         return redirect(url_for('.show_post', post_id=post.id))
     return render_template('blog/post.html',
                            post=post,
                            pagination=pagination,
                            comments=comments,
+                           threads=threads,
+                           related=related,
                            form=form)
 
 
 @blog_bp.route('/reply/comment/<int:comment_id>')
 def reply_comment(comment_id):
     """回复评论"""
-    comment = Comment.query.get_or_404(comment_id)
+    comment = db.session.query(Comment.post_id, Comment.author).filter_by(
+        id=comment_id).first_or_404()
     return redirect(url_for('.show_post',
-                            post_id=comment.post.id,
+                            post_id=comment.post_id,
                             reply=comment_id,
                             author=comment.author)
                     + '#comment-form')
@@ -0,0 +1,117 @@
+from flask import (Blueprint, Response, current_app, render_template,
+                   request, stream_with_context, url_for)
+from markupsafe import escape
+from sqlalchemy import func
+from sqlalchemy.orm import defer, joinedload
+from werkzeug.http import http_date
+
+from bluelog.caching import get_site_version, site_cache
+from bluelog.counts import count_posts
+from bluelog.events import on_models_committed
+from bluelog.extensions import db
+from bluelog.models import Admin, Category, Post
+from bluelog.utils import conditional, make_etag
+
+feeds_bp = Blueprint('feeds', __name__)
+
+# 订阅源的模板和 Content-Type
+_feeds = {
+    'rss': ('feeds/rss.xml', 'application/rss+xml'),
+    'atom': ('feeds/atom.xml', 'application/atom+xml'),
+}
+
+
+@on_models_committed(Admin, Category, Post)
+def _invalidate_feeds(changes):
+    """文章、分类或博客信息修改后清除缓存的订阅源"""
+    site_cache.invalidate(*[('feed', name) for name in _feeds])
+
+
+def get_feed(name):
+    """获取缓存的订阅源，未命中时渲染最新的 BLUELOG_FEED_ITEMS 篇文章
+
+    缓存的是渲染好的 XML 和它的 ETag，订阅源轮询只需要一次字典查找。
+    文章中的链接是绝对地址，缓存键中包含请求的主机名。
+
+    Args:
+        name:'rss' 或 'atom'
+    Returns:
+        (body, etag, last_modified) 元组
+    """
+    template = _feeds[name][0]
+
+    def render():
+        posts = Post.query.options(joinedload(Post.category), defer(Post.body)).order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        ).limit(current_app.config['BLUELOG_FEED_ITEMS']).all()
+        updated = max((post.updated_at or post.timestamp for post in posts), default=None)
+        body = render_template(template, posts=posts, updated=updated, http_date=http_date)
+        return body, make_etag(body), updated
+
+    entries = site_cache.get(('feed', name), lambda: {})
+    entry = entries.get(request.host_url)
+    if entry is None:
+        entry = entries[request.host_url] = render()
+    return entry
+
+
+def feed_validator(name):
+    body, etag, last_modified = get_feed(name)
+    return etag, last_modified
+
+
+def sitemap_validator():
+    """站点地图的验证值，由文章的最后修改时间、文章数和分类数据的版本生成"""
+    updated_at = db.session.query(func.max(Post.updated_at)).scalar()
+    return make_etag('sitemap', request.host_url, updated_at, count_posts(),
+                     get_site_version()), updated_at
+
+
+def _feed_response(name):
+    body = get_feed(name)[0]
+    return Response(body, mimetype=_feeds[name][1])
+
+
+@feeds_bp.route('/feed.xml')
+@conditional(lambda: feed_validator('rss'))
+def rss():
+    """RSS 2.0 订阅源"""
+    return _feed_response('rss')
+
+
+@feeds_bp.route('/atom.xml')
+@conditional(lambda: feed_validator('atom'))
+def atom():
+    """Atom 订阅源"""
+    return _feed_response('atom')
+
+
+@feeds_bp.route('/sitemap.xml')
+@conditional(sitemap_validator)
+def sitemap():
+    """站点地图
+
+    用 yield_per 游标分批读取文章和分类，边查询边输出，不会把所有行保存在内存中。
+    """
+    batch = current_app.config['BLUELOG_SITEMAP_BATCH']
+
+    def url(loc, lastmod=None):
+        if lastmod is None:
+            return '<url><loc>%s</loc></url>\n' % escape(loc)
+        return '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+            escape(loc), lastmod.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def generate():
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        yield url(url_for('blog.index', _external=True))
+        yield url(url_for('blog.about', _external=True))
+        for id, in db.session.query(Category.id).order_by(Category.id).yield_per(batch):
+            yield url(url_for('blog.show_category', category_id=id, _external=True))
+        posts = db.session.query(Post.id, Post.timestamp, Post.updated_at).order_by(Post.id)
+        for id, timestamp, updated_at in posts.yield_per(batch):
+            yield url(url_for('blog.show_post', post_id=id, _external=True),
+                      updated_at or timestamp)
+        yield '</urlset>\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/xml')
@@ -0,0 +1,176 @@
+import hashlib
+import threading
+import time
+
+from sqlalchemy import func
+
+from bluelog.events import on_models_committed
+from bluelog.extensions import db
+from bluelog.models import Admin, ArchiveMonth, Category, Link, Post
+
+
+class SiteCache(object):
+    """进程级的站点数据缓存
+
+    缓存每个页面都要用到、但很少变化的数据（管理员、分类、链接）。
+    本进程内的写入通过模型提交事件使缓存立即失效，其他进程的写入依靠 TTL 兜底。
+
+    缓存中保存的是已脱离会话（detached）的模型对象，在模板中使用前需要 merge 到当前会话。
+
+    Attributes:
+        ttl: 缓存的过期时间（秒）
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self._store = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """读取配置并把缓存注册到 app 上"""
+        self.ttl = app.config['BLUELOG_CACHE_TTL']
+        app.extensions['site_cache'] = self
+
+    def get(self, key, loader):
+        """获取缓存的值
+
+        缓存未命中或已过期时调用 loader 加载。加载期间如果缓存被清除，加载到的值不会写入缓存。
+
+        Args:
+            key: 缓存的键
+            loader: 加载数据的函数
+        Returns:
+            缓存的值
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._store.get(key)
+            generation = self._generation
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = loader()
+        with self._lock:
+            if generation == self._generation:
+                self._store[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *keys):
+        """清除缓存，不指定 keys 时清除全部"""
+        with self._lock:
+            self._generation += 1
+            if keys:
+                for key in keys:
+                    self._store.pop(key, None)
+            else:
+                self._store.clear()
+
+
+site_cache = SiteCache()
+
+# 模型与受影响的缓存键的对应关系
+_model_keys = {
+    Admin: ('admin',),
+    Category: ('categories', 'category_counts'),
+    Link: ('links',),
+}
+
+
+@on_models_committed(*_model_keys)
+def _invalidate_site_cache(changes):
+    """模型写入后清除对应的缓存"""
+    keys = set()
+    for change in changes:
+        keys.update(_model_keys[change.model])
+    site_cache.invalidate(*keys)
+
+
+@on_models_committed(Post)
+def _invalidate_post_aggregates(changes):
+    """新建、删除文章或修改发布时间、分类后清除缓存的归档月份和分类文章数"""
+    keys = set()
+    for change in changes:
+        if change.changed('timestamp'):
+            keys.add('archives')
+        if change.changed('category_id'):
+            keys.add('category_counts')
+    if keys:
+        site_cache.invalidate(*keys)
+
+
+def _load(query):
+    """在独立的会话中执行查询，返回脱离会话的对象列表
+
+    使用独立会话可以避免把请求会话中已有的对象（例如 current_user）移出会话。
+    """
+    session = db.session.session_factory()
+    try:
+        return query.with_session(session).all()
+    finally:
+        session.close()
+
+
+def get_admin():
+    """获取缓存的管理员对象，不存在时返回 None"""
+    admins = site_cache.get('admin', lambda: _load(Admin.query.limit(1)))
+    return admins[0] if admins else None
+
+
+def get_categories():
+    """获取按名称排序的缓存分类列表"""
+    return site_cache.get('categories',
+                          lambda: _load(Category.query.order_by(Category.name)))
+
+
+def get_links():
+    """获取按名称排序的缓存链接列表"""
+    return site_cache.get('links', lambda: _load(Link.query.order_by(Link.name)))
+
+
+def get_category_counts():
+    """获取缓存的各分类文章数
+
+    用一次 GROUP BY 查询统计所有分类，侧边栏不需要加载每个分类的文章。
+
+    Returns:
+        分类 id 到文章数的字典，没有文章的分类不在字典中
+    """
+    return site_cache.get('category_counts', lambda: dict(
+        db.session.query(Post.category_id, func.count(Post.id)).group_by(Post.category_id)))
+
+
+def get_archives():
+    """获取缓存的归档月份列表，按时间倒序排列，只包括有文章的月份"""
+    return site_cache.get('archives', lambda: _load(ArchiveMonth.query.filter(
+        ArchiveMonth.post_count > 0
+    ).order_by(ArchiveMonth.year.desc(), ArchiveMonth.month.desc())))
+
+
+def get_site_version():
+    """根据缓存的管理员、分类、链接生成版本标识，用于页面的 ETag"""
+    admin = get_admin()
+    parts = []
+    if admin is not None:
+        parts.append((admin.name, admin.blog_title, admin.blog_sub_title, admin.about))
+    parts.extend((category.id, category.name) for category in get_categories())
+    parts.extend((link.id, link.name, link.url) for link in get_links())
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def merge_cached(objs):
+    """把缓存的对象 merge 到当前会话
+
+    使用 load=False，不会查询数据库；merge 后的对象可以正常使用延迟加载的关系。
+
+    Args:
+        objs: 缓存的对象或对象列表，可以为 None
+    Returns:
+        当前会话中的对象或对象列表
+    """
+    if objs is None:
+        return None
+    if isinstance(objs, list):
+        return [db.session.merge(obj, load=False) for obj in objs]
+    return db.session.merge(objs, load=False)
@@ -0,0 +1,306 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app, request
+
+from bluelog.counts import count_cache
+from bluelog.extensions import db
+from bluelog.models import Comment, CommentSegment, Post
+from bluelog.notifications import notifier
+
+SEGMENT_SUFFIX = '.jsonl'
+# 每条 INSERT 语句的行数，SQLite 默认最多 999 个参数
+INSERT_CHUNK = 100
+
+
+class _Segment(object):
+    """缓冲区的一个日志文件，持有文件锁的进程负责把它写入数据库
+
+    Attributes:
+        path: 文件路径
+        file: 打开并加了排他锁的文件对象
+        records: 文件中的评论
+        started: 第一条评论写入的时间，用于计算写入延迟
+        recovered: 是否是从崩溃的进程留下的文件中恢复的
+    """
+    __slots__ = ('path', 'file', 'records', 'started', 'recovered')
+
+    def __init__(self, path, file, records=None, recovered=False):
+        self.path = path
+        self.file = file
+        self.records = records or []
+        self.started = time.time()
+        self.recovered = recovered
+
+    @property
+    def id(self):
+        """文件名中不含扩展名的部分，同时用作数据库中写入记录的主键"""
+        return os.path.basename(self.path)[:-len(SEGMENT_SUFFIX)]
+
+    def remove(self):
+        """评论已经写入数据库，删除文件后释放锁"""
+        os.remove(self.path)
+        self.file.close()
+
+
+def write_comments(records, segment_id=None, recovered=False):
+    """用多行 INSERT 把缓冲的评论写入 Comment 表并提交
+
+    绕过了 ORM 的事件，所以在同一个事务中完成原本由事件完成的工作：回复继承讨论串、
+    增加文章的评论计数、记录或发送提醒；提交后修改评论管理页面的计数缓存。
+    文章已经删除的评论被丢弃，被回复的评论已经删除时作为根评论保存。
+
+    Args:
+        records:评论的字典列表，timestamp 为 ISO 格式的字符串
+        segment_id:评论所在日志文件的 id，在同一个事务中记录到 CommentSegment
+        recovered:是否是崩溃的进程留下的日志文件，已经记录过的文件在提交前崩溃，不再写入
+    Returns:
+        插入的评论数
+    """
+    segments = CommentSegment.__table__
+    if recovered and db.session.query(CommentSegment.id).filter_by(id=segment_id).first():
+        return 0
+    rows = [dict(record, timestamp=datetime.strptime(record['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'))
+            for record in records]
+    post_ids = {row['post_id'] for row in rows}
+    replied_ids = {row['replied_id'] for row in rows} - {None}
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(post_ids))}
+    replied = {}
+    if replied_ids:
+        replied = {comment.id: comment for comment in Comment.query.filter(
+            Comment.id.in_(replied_ids))}
+
+    values = []
+    for row in rows:
+        if row['post_id'] not in posts:
+            continue
+        parent = replied.get(row['replied_id'])
+        values.append(dict(row, from_admin=False, reviewed=False,
+                           replied_id=parent and parent.id,
+                           thread_id=parent and (parent.thread_id or parent.id)))
+    if not values:
+        return 0
+
+    if segment_id is not None:
+        db.session.execute(segments.insert().values(id=segment_id, timestamp=datetime.utcnow()))
+    table = Comment.__table__
+    for start in range(0, len(values), INSERT_CHUNK):
+        db.session.execute(table.insert().values(values[start:start + INSERT_CHUNK]))
+    post_table = Post.__table__
+    for post_id, count in Counter(row['post_id'] for row in values).items():
+        db.session.execute(post_table.update().where(post_table.c.id == post_id).values(
+            comment_count=post_table.c.comment_count + count,
+            updated_at=post_table.c.updated_at))  # 未审核的评论不显示，页面没有变化
+    for row in values:
+        if row['replied_id'] is not None:
+            notifier.new_reply(replied[row['replied_id']])
+        notifier.new_comment(posts[row['post_id']])
+    db.session.commit()
+    count_cache.adjust(('comments', 'all'), len(values))
+    count_cache.adjust(('comments', 'unread'), len(values))
+    return len(values)
+
+
+class CommentBuffer(object):
+    """匿名评论的写后缓冲区
+
+    启用后，通过验证的匿名评论（未审核，不显示在页面上）先追加到本机的日志文件并 fsync，
+    请求不访问数据库；后台线程在缓冲的评论达到 BLUELOG_COMMENT_BUFFER_BATCH 条或每隔
+    BLUELOG_COMMENT_BUFFER_INTERVAL 秒时，用一个事务批量写入。缓冲的评论超过
+    BLUELOG_COMMENT_BUFFER_MAX 条（例如数据库不可用）时 add 返回 False，由调用者同步写入。
+
+    每个进程写自己的日志文件并一直持有它的文件锁。一个日志文件中的评论在一个事务中写入，
+    事务中同时插入一行以文件名为主键的 CommentSegment。后台线程启动时检查目录中没有被锁住的
+    文件，它们是崩溃的进程留下的，写入数据库后删除；已经有 CommentSegment 记录的文件在提交后、
+    删除前崩溃，不再写入。
+
+    Attributes:
+        stats: buffered 缓冲的评论数、flushed 写入的评论数、batches 批次数、overflows 缓冲区满
+               改为同步写入的次数、recovered 恢复的评论数、failures 写入失败的次数、
+               last_latency 和 max_latency 评论从进入缓冲区到提交的最长等待时间（秒）、
+               flush_time 写入数据库花费的总时间（秒）
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.batch_size = 100
+        self.interval = 1.0
+        self.max_size = 1000
+        self.stats = dict(buffered=0, flushed=0, batches=0, overflows=0, recovered=0, failures=0,
+                          last_latency=0.0, max_latency=0.0, flush_time=0.0)
+        self._app = None
+        self._base_url = None
+        self._segment = None
+        self._failed = []
+        self._removed = []  # 已经删除的日志文件的 id，在下一次写入的事务中删除它们的记录
+        self._pending = 0
+        self._pid = None
+        self._exit_registered = False
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['BLUELOG_COMMENT_BUFFER']
+        self.directory = app.config['BLUELOG_COMMENT_BUFFER_DIR']
+        self.batch_size = app.config['BLUELOG_COMMENT_BUFFER_BATCH']
+        self.interval = app.config['BLUELOG_COMMENT_BUFFER_INTERVAL']
+        self.max_size = app.config['BLUELOG_COMMENT_BUFFER_MAX']
+        self._app = app
+        app.extensions['comment_buffer'] = self
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            app.before_request(self._start)  # 第一个请求时启动后台线程并恢复遗留的评论
+
+    def _start(self):
+        """启动写入数据库的后台线程；fork 出的子进程没有父进程的线程，重新启动"""
+        if self._pid == os.getpid() or not self.enabled:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._segment = None
+            self._failed = []
+            self._removed = []
+            self._pending = 0
+            self._base_url = request.host_url
+            if not self._exit_registered:
+                atexit.register(self.flush)
+                self._exit_registered = True
+        thr = threading.Thread(target=self._run, name='comment-buffer')
+        thr.daemon = True
+        thr.start()
+
+    def add(self, post_id, replied_id, author, email, site, body):
+        """把一条匿名评论写入缓冲区
+
+        Returns:
+            写入缓冲区时返回 True；没有启用或缓冲区已满时返回 False，调用者需要同步写入
+        """
+        if not self.enabled:
+            return False
+        self._start()
+        record = dict(post_id=post_id, replied_id=replied_id, author=author, email=email,
+                      site=site, body=body, timestamp=datetime.utcnow().isoformat(timespec='microseconds'))
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._pending >= self.max_size:
+                self.stats['overflows'] += 1
+                return False
+            if self._segment is None:
+                self._segment = self._open_segment()
+            segment = self._segment
+            segment.file.write(line)
+            segment.file.flush()
+            os.fsync(segment.file.fileno())
+            if not segment.records:
+                segment.started = time.time()
+            segment.records.append(record)
+            self._pending += 1
+            self.stats['buffered'] += 1
+            full = len(segment.records) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        return True
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, '%d-%s%s' % (os.getpid(), uuid.uuid4().hex,
+                                                         SEGMENT_SUFFIX))
+        file = open(path, 'a', encoding='utf-8')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return _Segment(path, file)
+
+    def _run(self):
+        self._recover()
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _recover(self):
+        """接管崩溃的进程留下的日志文件"""
+        for path in glob.glob(os.path.join(self.directory, '*' + SEGMENT_SUFFIX)):
+            try:
+                file = open(path, 'r+', encoding='utf-8')
+            except OSError:
+                continue
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:  # 文件属于正在运行的进程
+                file.close()
+                continue
+            records = []
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:  # 崩溃时没有写完的最后一行
+                    break
+            with self._lock:
+                self._failed.append(_Segment(path, file, records, recovered=True))
+                self._pending += len(records)
+
+    def flush(self):
+        """把缓冲的评论写入数据库，失败的批次保留到下一次重试"""
+        with self._flush_lock:
+            with self._lock:
+                segments, self._failed = self._failed, []
+                if self._segment is not None and self._segment.records:
+                    segments.append(self._segment)
+                    self._segment = None
+            for segment in segments:
+                if not self._write(segment):
+                    with self._lock:
+                        self._failed.append(segment)
+
+    def _write(self, segment):
+        app = self._app
+        with self._lock:
+            removed, self._removed = self._removed, []
+        with app.test_request_context(base_url=self._base_url or 'http://localhost/'):
+            try:
+                started = time.time()
+                if removed:
+                    table = CommentSegment.__table__
+                    db.session.execute(table.delete().where(table.c.id.in_(removed)))
+                count = write_comments(segment.records, segment.id, segment.recovered)
+                db.session.commit()  # 没有评论需要写入时提交删除的记录
+                finished = time.time()
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self.stats['failures'] += 1
+                    self._removed.extend(removed)
+                current_app.logger.exception('Failed to write %d buffered comments.',
+                                             len(segment.records))
+                return False
+            finally:
+                db.session.remove()
+        segment.remove()
+        latency = finished - segment.started
+        with self._lock:
+            self._removed.append(segment.id)
+            self._pending -= len(segment.records)
+            self.stats['flushed'] += count
+            self.stats['batches'] += 1
+            self.stats['flush_time'] += finished - started
+            if segment.recovered:
+                self.stats['recovered'] += count
+            else:
+                self.stats['last_latency'] = latency
+                self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+        return True
+
+
+comment_buffer = CommentBuffer()
@@ -0,0 +1,156 @@
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header
+
+# zlib 的 wbits 参数：gzip 格式带 gzip 头，HTTP 的 deflate 是带 zlib 头的格式
+_wbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def accepted_encoding(environ):
+    """按请求的 Accept-Encoding 选择压缩编码，优先使用 gzip，都不接受时返回 None"""
+    accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+    for encoding in ('gzip', 'deflate'):
+        if accept[encoding]:
+            return encoding
+    return None
+
+
+class CompressMiddleware(object):
+    """压缩响应的 WSGI 中间件
+
+    压缩状态为 200、类型在 mimetypes 中、大小不小于 min_size 的响应。已经设置了
+    Content-Encoding 的响应（例如页面缓存中预先压缩的页面和 flask assets 生成的静态文件）、
+    HEAD 请求和带 Cache-Control: no-transform 的响应不压缩。没有 Content-Length 的流式响应
+    （例如站点地图）边生成边压缩，不会先读入内存。
+
+    Attributes:
+        wsgi_app: 被包装的 WSGI 应用
+        level: 压缩级别，1 最快，9 压缩率最高
+        min_size: 小于这个字节数的响应不压缩
+        mimetypes: 需要压缩的 MIME 类型集合
+    """
+
+    def __init__(self, wsgi_app, level=6, min_size=500, mimetypes=()):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.min_size = min_size
+        self.mimetypes = frozenset(mimetypes)
+
+    def compressible(self, status_code, headers, size=None):
+        """响应是否需要压缩
+
+        Args:
+            status_code:响应的状态码
+            headers:响应头，Headers 对象
+            size:响应体的字节数，未知时为 None
+        """
+        if status_code != 200 or 'Content-Encoding' in headers:
+            return False
+        if parse_options_header(headers.get('Content-Type'))[0] not in self.mimetypes:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        return size is None or size >= self.min_size
+
+    def compress(self, data, encoding='gzip'):
+        """压缩一段完整的数据"""
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, _wbits[encoding])
+        return compressor.compress(data) + compressor.flush()
+
+    def __call__(self, environ, start_response):
+        encoding = accepted_encoding(environ)
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return lambda data: None  # 不支持已经废弃的 write()，本项目的应用不会使用
+
+        app_iter = self.wsgi_app(environ, capture)
+        if not captured:  # 规范允许应用在第一次迭代时才调用 start_response
+            app_iter = _Prefetched(app_iter)
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+        length = headers.get('Content-Length', type=int)
+        if not self.compressible(int(status.split(None, 1)[0]), headers, length):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        headers['Content-Encoding'] = encoding
+        vary = headers.get('Vary')
+        if vary is None:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            headers['Vary'] = vary + ', Accept-Encoding'
+        etag = headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag  # 压缩后内容不同，强验证值改为弱验证值
+        body = self._compress_iter(app_iter, encoding)
+        if length is None:
+            headers.remove('Content-Length')
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return body
+        body = b''.join(body)
+        headers['Content-Length'] = str(len(body))
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return [body]
+
+    def _compress_iter(self, app_iter, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, _wbits[encoding])
+        try:
+            for data in app_iter:
+                data = compressor.compress(data)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+
+
+class _Prefetched(object):
+    """先取出第一块数据，让应用调用 start_response，之后按原顺序返回"""
+
+    def __init__(self, app_iter):
+        self._app_iter = app_iter
+        self._iterator = iter(app_iter)
+        self._first = next(self._iterator, None)
+
+    def __iter__(self):
+        if self._first is not None:
+            yield self._first
+        yield from self._iterator
+
+    def close(self):
+        close = getattr(self._app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compress(object):
+    """在 WSGI 层压缩动态响应的扩展
+
+    BLUELOG_COMPRESS 为 True 时用 CompressMiddleware 包装 app.wsgi_app，中间件保存在
+    app.extensions['compress'] 中，页面缓存用它预先压缩缓存的页面。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['BLUELOG_COMPRESS']:
+            return
+        middleware = CompressMiddleware(app.wsgi_app,
+                                        app.config['BLUELOG_COMPRESS_LEVEL'],
+                                        app.config['BLUELOG_COMPRESS_MIN_SIZE'],
+                                        app.config['BLUELOG_COMPRESS_MIMETYPES'])
+        app.wsgi_app = middleware
+        app.extensions['compress'] = middleware
+
+
+compress = Compress()
@@ -0,0 +1,169 @@
+import threading
+import time
+
+from bluelog.events import on_models_committed
+from bluelog.models import Comment, Post
+
+
+class CountCache(object):
+    """按过滤条件缓存的计数
+
+    分页需要的总数不再每次请求都执行 COUNT(*)：第一次使用时统计，之后根据模型提交事件增量修改，
+    超过 reconcile_interval 秒后重新统计一次，用来修正其他进程的写入和批量操作造成的偏差。
+    统计期间收到的增量先记录下来，保存统计结果前补上；统计期间被删除的计数不保存。
+
+    Attributes:
+        reconcile_interval: 重新统计的间隔（秒）
+    """
+
+    def __init__(self, app=None):
+        self.reconcile_interval = 600
+        self._counts = {}
+        # 键 -> 正在进行的统计收到的增量列表，每个统计一个 [delta]，delta 为 None 表示统计期间被删除
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """读取配置并把计数缓存注册到 app 上"""
+        self.reconcile_interval = app.config['BLUELOG_COUNT_RECONCILE']
+        app.extensions['count_cache'] = self
+
+    def get(self, key, counter):
+        """获取计数
+
+        Args:
+            key: 过滤条件对应的键
+            counter: 统计计数的函数，缓存未命中或需要重新统计时调用
+        Returns:
+            计数
+        """
+        now = time.time()
+        pending = [0]
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            self._inflight.setdefault(key, []).append(pending)
+        try:
+            value = counter()
+        except Exception:
+            with self._lock:
+                self._finish(key, pending)
+            raise
+        with self._lock:
+            self._finish(key, pending)
+            if pending[0] is None:
+                return value
+            if pending[0]:
+                value = max(value + pending[0], 0)
+            self._counts[key] = [value, now + self.reconcile_interval]
+        return value
+
+    def _finish(self, key, pending):
+        """统计结束，不再记录增量；调用者需要持有锁"""
+        inflight = self._inflight[key]
+        del inflight[next(i for i, item in enumerate(inflight) if item is pending)]
+        if not inflight:
+            del self._inflight[key]
+
+    def adjust(self, key, delta):
+        """增量修改已缓存的计数和正在进行的统计，未缓存的键不处理"""
+        if not delta:
+            return
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None:
+                entry[0] = max(entry[0] + delta, 0)
+            for pending in self._inflight.get(key, ()):
+                if pending[0] is not None:
+                    pending[0] += delta
+
+    def invalidate(self, *keys):
+        """删除计数，下次使用时重新统计；不指定 keys 时删除全部"""
+        with self._lock:
+            if not keys:
+                keys = list(self._inflight)
+                self._counts.clear()
+            for key in keys:
+                self._counts.pop(key, None)
+                for pending in self._inflight.get(key, ()):
+                    pending[0] = None
+
+
+count_cache = CountCache()
+
+# 评论管理页面的过滤规则
+comment_filters = {
+    'all': lambda: Comment.query,
+    'unread': lambda: Comment.query.filter_by(reviewed=False),
+    'admin': lambda: Comment.query.filter_by(from_admin=True),
+}
+
+
+def count_posts(category_id=None):
+    """获取文章总数，指定 category_id 时获取该分类下的文章数"""
+    if category_id is None:
+        return count_cache.get('posts', lambda: Post.query.count())
+    return count_cache.get(('posts', category_id),
+                           lambda: Post.query.filter_by(category_id=category_id).count())
+
+
+def count_comments(filter_rule='all'):
+    """获取评论管理页面某个过滤规则下的评论数
+
+    Args:
+        filter_rule: 'all'、'unread' 或 'admin'
+    """
+    return count_cache.get(('comments', filter_rule),
+                           lambda: comment_filters[filter_rule]().count())
+
+
+def count_threads(post_id):
+    """获取文章中已审核的根评论数，即嵌套显示时讨论串的数量"""
+    return count_cache.get(('threads', post_id), lambda: Comment.query.filter_by(
+        post_id=post_id, reviewed=True, replied_id=None).count())
+
+
+def _sign(change):
+    return {'insert': 1, 'delete': -1}.get(change.operation, 0)
+
+
+@on_models_committed(Post, Comment)
+def _update_counts(changes):
+    """根据提交的写入增量修改计数"""
+    for change in changes:
+        values, old = change.values, change.old_values
+        sign = _sign(change)
+        if change.model is Post:
+            if sign:
+                count_cache.adjust('posts', sign)
+                count_cache.adjust(('posts', values['category_id']), sign)
+            elif 'category_id' in old:
+                count_cache.adjust(('posts', old['category_id']), -1)
+                count_cache.adjust(('posts', values['category_id']), 1)
+            if sign < 0 and values['comment_count'] != 0:
+                # 评论由数据库级联删除，没有逐条的写入记录；评论数未知（None）时同样重新统计
+                count_cache.invalidate(('comments', 'all'), ('comments', 'unread'),
+                                       ('comments', 'admin'), ('threads', change.id))
+            continue
+
+        for filter_rule, key, match in (('unread', 'reviewed', False),
+                                        ('admin', 'from_admin', True)):
+            matched = bool(values[key]) == match
+            if sign:
+                count_cache.adjust(('comments', filter_rule), sign if matched else 0)
+            elif key in old:
+                count_cache.adjust(('comments', filter_rule),
+                                   int(matched) - int(bool(old[key]) == match))
+        count_cache.adjust(('comments', 'all'), sign)
+
+        if values['replied_id'] is None:
+            if sign:
+                count_cache.adjust(('threads', values['post_id']), sign if values['reviewed'] else 0)
+            elif 'post_id' in old:
+                count_cache.invalidate(('threads', old['post_id']), ('threads', values['post_id']))
+            elif 'reviewed' in old:
+                count_cache.adjust(('threads', values['post_id']),
+                                   int(bool(values['reviewed'])) - int(bool(old['reviewed'])))
@@ -0,0 +1,200 @@
+from flask import current_app
+from sqlalchemy import and_, event, func, or_, select
+from sqlalchemy.orm import Session
+
+from bluelog.events import on_models_committed
+from bluelog.extensions import db
+from bluelog.freeze import queue_pages
+from bluelog.models import Admin, Category, Comment, Link, Post, RelatedPost
+from bluelog.page_cache import page_cache
+
+# 显示在每个页面的导航栏或侧边栏中的模型，写入后所有页面都受影响
+_global_models = (Admin, Category, Link)
+# 写入会影响页面的模型
+_tracked_models = _global_models + (Comment, Post)
+# 改变文章在列表中的位置或侧边栏分类计数的列
+_position_columns = ('timestamp', 'category_id')
+# 不按文章变化的页面
+_post_pages = ('/search', '/feed.xml', '/atom.xml', '/sitemap.xml')
+# 一次提交影响的文章超过这个数量时不再逐篇计算，直接按全部页面处理
+MAX_TRACKED_POSTS = 100
+
+
+class AffectedPages(object):
+    """一次提交影响的页面
+
+    Attributes:
+        everything: 是否影响所有页面
+        paths: 路径到页码集合的字典，页码集合为 None 表示这个路径的所有页
+    """
+    __slots__ = ('everything', 'paths')
+
+    def __init__(self, everything=False):
+        self.everything = everything
+        self.paths = {}
+
+    def add(self, path, page=None):
+        """添加受影响的页面，page 为 None 时表示路径的所有页"""
+        if page is None:
+            self.paths[path] = None
+        elif self.paths.get(path, ()) is not None:
+            self.paths.setdefault(path, set()).add(page)
+
+    def update(self, other):
+        """合并另一个 AffectedPages 中的页面"""
+        if other.everything:
+            self.everything = True
+        for path, pages in other.paths.items():
+            if pages is None:
+                self.add(path)
+            else:
+                for page in pages:
+                    self.add(path, page)
+
+    def __bool__(self):
+        return self.everything or bool(self.paths)
+
+    def __repr__(self):
+        if self.everything:
+            return '<AffectedPages everything>'
+        return '<AffectedPages %r>' % self.paths
+
+
+def _comment_visible(change):
+    """评论写入前后是否有一个状态显示在页面上（已审核）"""
+    return bool(change.values.get('reviewed') or change.old_values.get('reviewed'))
+
+
+def _list_position(connection, post, category_id=None):
+    """文章在首页或分类页中所在的页码，与 paginate 的 (timestamp, id) 倒序排序一致"""
+    table = Post.__table__
+    newer = or_(table.c.timestamp > post.timestamp,
+                and_(table.c.timestamp == post.timestamp, table.c.id > post.id))
+    if category_id is not None:
+        newer = and_(table.c.category_id == category_id, newer)
+    count = connection.execute(select([func.count(table.c.id)]).where(newer)).scalar()
+    return count // current_app.config['BLUELOG_POST_PER_PAGE'] + 1
+
+
+def affected_pages(changes, connection):
+    """计算写入影响的页面
+
+    - 管理员、分类、链接出现在每个页面中，文章的新建、删除、修改时间或分类会改变侧边栏的
+      分类计数和所有列表的分页，这些写入影响所有页面；
+    - 修改文章的其他列影响文章的所有页、它所在的首页和分类页、它所在月份的归档页、
+      把它列为相关文章的文章、搜索结果、订阅源和站点地图；
+    - 已审核评论的新建、删除和审核状态的改变影响文章的所有页（评论数和分页），以及
+      显示评论数的首页、分类页和归档页；未审核评论不显示，不影响任何页面。
+
+    相关文章由 bluelog.related 用 Core 语句改写，它自己清除改变了的文章页面。
+
+    Args:
+        changes: ModelChange 列表
+        connection: 查询文章在列表中的位置使用的连接，flush 时使用会话当前的连接
+    Returns:
+        AffectedPages 对象
+    """
+    pages = AffectedPages()
+    listed = set()
+    renamed = set()
+    for change in changes:
+        model, values, old = change.model, change.values, change.old_values
+        if issubclass(model, _global_models):
+            return AffectedPages(everything=True)
+        if model is Post:
+            if change.operation != 'update' or any(column in old for column in _position_columns):
+                return AffectedPages(everything=True)
+            pages.add('/post/%d' % change.id)
+            for path in _post_pages:
+                pages.add(path)
+            listed.add(change.id)
+            if 'title' in old:
+                renamed.add(change.id)
+        elif model is Comment:
+            if not _comment_visible(change):
+                continue
+            for post_id in {values.get('post_id'), old.get('post_id')} - {None}:
+                pages.add('/post/%d' % post_id)
+                listed.add(post_id)
+    return _add_list_pages(connection, pages, listed, renamed)
+
+
+def comment_pages(post_ids, connection):
+    """已审核评论的改变影响的页面，用于不经过 ORM 事件的批量修改，在提交前调用
+
+    Args:
+        post_ids: 评论所在文章的 id 集合
+        connection: 执行批量修改的连接
+    Returns:
+        AffectedPages 对象
+    """
+    pages = AffectedPages()
+    for post_id in post_ids:
+        pages.add('/post/%d' % post_id)
+    return _add_list_pages(connection, pages, set(post_ids))
+
+
+def _add_list_pages(connection, pages, listed, renamed=()):
+    """添加文章所在的首页、分类页和归档页，以及标题改变的文章出现在其中的相关文章"""
+    if not listed:
+        return pages
+    if len(listed) > MAX_TRACKED_POSTS:
+        return AffectedPages(everything=True)
+    table = Post.__table__
+    keyset = current_app.config['BLUELOG_KEYSET_PAGINATION']
+    posts = connection.execute(select([
+        table.c.id, table.c.timestamp, table.c.category_id
+    ]).where(table.c.id.in_(listed))).fetchall()
+    for post in posts:
+        category_path = '/category/%d' % post.category_id
+        if post.timestamp is not None:
+            pages.add('/archive/%d/%d' % (post.timestamp.year, post.timestamp.month))
+        if keyset:  # 游标分页没有页码，清除整个列表
+            pages.add('/')
+            pages.add(category_path)
+        else:
+            pages.add('/', _list_position(connection, post))
+            pages.add(category_path, _list_position(connection, post, post.category_id))
+    if renamed:
+        related = RelatedPost.__table__
+        for post_id, in connection.execute(select([related.c.post_id]).where(
+                related.c.related_id.in_(renamed))):
+            pages.add('/post/%d' % post_id)
+    return pages
+
+
+def purge_pages(pages):
+    """清除页面缓存中受影响的页面，并记录需要重新静态化的页面"""
+    if pages:
+        page_cache.purge(pages)
+        queue_pages(current_app.config['BLUELOG_FREEZE_DIR'], pages)
+
+
+@event.listens_for(Session, 'after_flush')
+def _locate_pages(session, flush_context):
+    """在 flush 的连接中计算本次写入影响的页面
+
+    结果保存在本次每条相关写入的 info['pages'] 中（同一个对象），提交后不需要再查询数据库。
+    """
+    changes = [change for change in session.info.get('bluelog_changes', ())
+               if 'pages' not in change.info and issubclass(change.model, _tracked_models)]
+    if not changes:
+        return
+    pages = affected_pages(changes, session.connection())
+    for change in changes:
+        change.info['pages'] = pages
+
+
+@on_models_committed(*_tracked_models)
+def _track_changes(changes):
+    """页面中显示的数据提交修改后，清除受影响的页面"""
+    pages = AffectedPages()
+    flushed = {}
+    for change in changes:
+        if 'pages' in change.info:
+            flushed[id(change.info['pages'])] = change.info['pages']
+        else:  # 没有经过 flush 的写入记录，无法查询它影响的页面
+            pages.everything = True
+    for located in flushed.values():
+        pages.update(located)
+    purge_pages(pages)
@@ -1,40 +1,210 @@
-from threading import Thread
+import atexit
+import os
+import queue
+import smtplib
+import threading
+import time
 
 from flask import url_for, current_app
 from flask_mail import Message
 
 from bluelog.extensions import mail
 
+# 连接断开或超时后重新连接 SMTP 服务器再发送一次
+_connection_errors = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+
+class MailQueue(object):
+    """有界的后台邮件发送队列
+
+    固定数量的 worker 线程从队列中取出邮件发送，每个线程保持一个 SMTP 连接重复使用，
+    空闲超过 BLUELOG_MAIL_IDLE_TIMEOUT 秒后关闭，连接断开时重新连接后重试。
+    队列满时 send 最多等待 BLUELOG_MAIL_QUEUE_TIMEOUT 秒，仍然没有空位就丢弃这封邮件，
+    评论刷屏时不会在 web 进程中无限制地创建线程和 SMTP 连接。进程退出时发送完队列中的邮件。
+    BLUELOG_MAIL_WORKERS 为 0 时在当前线程中同步发送。
+
+    Attributes:
+        stats: queued 入队数、sent 发送数、failed 失败数、dropped 因队列满丢弃的数量、
+               reconnects 重新连接次数、max_depth 队列的最大长度
+    """
+
+    def __init__(self, app=None):
+        self.workers = 2
+        self.queue_size = 100
+        self.queue_timeout = 0.5
+        self.idle_timeout = 30
+        self.shutdown_timeout = 10
+        self.stats = dict(queued=0, sent=0, failed=0, dropped=0, reconnects=0, max_depth=0)
+        self._app = None
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._exit_registered = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config['BLUELOG_MAIL_WORKERS']
+        self.queue_size = app.config['BLUELOG_MAIL_QUEUE_SIZE']
+        self.queue_timeout = app.config['BLUELOG_MAIL_QUEUE_TIMEOUT']
+        self.idle_timeout = app.config['BLUELOG_MAIL_IDLE_TIMEOUT']
+        self.shutdown_timeout = app.config['BLUELOG_MAIL_SHUTDOWN_TIMEOUT']
+        self._app = app
+        app.extensions['mail_queue'] = self
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def _start(self):
+        """第一次发送时启动 worker 线程；fork 出的子进程没有父进程的线程，重新启动"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.queue_size)
+            self._threads = []
+            for i in range(self.workers):
+                thr = threading.Thread(target=self._work, name='mail-worker-%d' % i)
+                thr.daemon = True
+                thr.start()
+                self._threads.append(thr)
+            if not self._exit_registered:
+                atexit.register(self.shutdown)
+                self._exit_registered = True
+
+    def send(self, message):
+        """把邮件放入发送队列
+
+        Args:
+            message:flask_mail.Message 对象
+        Returns:
+            放入队列（或同步发送成功）时返回 True，队列已满被丢弃时返回 False
+        """
+        if not self.workers:
+            connection = self._deliver(None, message)
+            self._close(connection)
+            return connection is not None
+        self._start()
+        try:
+            self._queue.put(message, timeout=self.queue_timeout)
+        except queue.Full:
+            self._count('dropped')
+            current_app.logger.warning('Mail queue is full, dropped email to %s.',
+                                       ', '.join(message.send_to))
+            return False
+        with self._lock:
+            self.stats['queued'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], self._queue.qsize())
+        return True
+
+    def _work(self):
+        connection = None
+        with self._app.app_context():
+            while True:
+                try:
+                    message = self._queue.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    connection = self._close(connection)  # 空闲时关闭连接
+                    continue
+                try:
+                    if message is None:  # shutdown 放入的结束标记
+                        self._close(connection)
+                        return
+                    connection = self._deliver(connection, message)
+                finally:
+                    self._queue.task_done()
+
+    def _deliver(self, connection, message):
+        """用已有的连接发送邮件，连接断开时重新连接并重试一次
+
+        Returns:
+            发送后可以继续使用的连接，出错时为 None
+        """
+        for attempt in range(2):
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()  # 保持连接打开，由 _close 关闭
+                connection.send(message)
+                self._count('sent')
+                return connection
+            except _connection_errors:
+                connection = self._close(connection)
+                if attempt == 0:
+                    self._count('reconnects')
+                    continue
+                self._count('failed')
+                self._app.logger.exception('Failed to send email to %s.',
+                                           ', '.join(message.send_to))
+            except Exception:
+                connection = self._close(connection)
+                self._count('failed')
+                self._app.logger.exception('Failed to send email to %s.',
+                                           ', '.join(message.send_to))
+                break
+        return None
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None and connection.host is not None:
+            try:
+                connection.host.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.host.close()
+        return None
+
+    def shutdown(self, timeout=None):
+        """等待队列中的邮件发送完成后结束 worker 线程
+
+        Args:
+            timeout:最多等待的秒数，默认为 BLUELOG_MAIL_SHUTDOWN_TIMEOUT
+        Returns:
+            所有邮件都已发送（或失败）时返回 True
+        """
+        if self._pid != os.getpid() or not self._threads:
+            return True
+        deadline = time.monotonic() + (self.shutdown_timeout if timeout is None else timeout)
+        threads, self._threads = self._threads, []
+        for thr in threads:
+            try:
+                self._queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                break
+        for thr in threads:
+            thr.join(max(deadline - time.monotonic(), 0))
+        self._pid = None
+        if any(thr.is_alive() for thr in threads):
+            self._app.logger.warning('Mail queue shut down with %d unsent emails.',
+                                     self._queue.qsize())
+            return False
+        return True
+
+
+mail_queue = MailQueue()
 
 
 def send_mail(subject, to, html):
-    """发送邮件"""
-    app = current_app._get_current_object()
+    """发送邮件，邮件放入 mail_queue 由后台线程发送"""
     message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    return mail_queue.send(message)
 
 
-def send_new_comment_email(post):
-    """发送新评论提醒邮件"""
+def new_comment_email(post):
+    """生成新评论提醒邮件，返回 send_mail 的参数"""
     post_url = url_for('blog.show_post', post_id=post.id, _external=True) + '#comments'
-    send_mail(subject='New comment', to=current_app.config['BLUELOG_EMAIL'],
-              html='<p>New comment in post <i>%s</i>, click the link below to check:</p>'
-                   '<p><a href="%s">%s</a></P>'
-                   '<p><small style="color: #868e96">Do not reply this email.</small></p>'
-                   % (post.title, post_url, post_url))
+    return dict(subject='New comment', to=current_app.config['BLUELOG_EMAIL'],
+                html='<p>New comment in post <i>%s</i>, click the link below to check:</p>'
+                     '<p><a href="%s">%s</a></P>'
+                     '<p><small style="color: #868e96">Do not reply this email.</small></p>'
+                     % (post.title, post_url, post_url))
 
 
-def send_new_reply_email(comment):
-    """发送评论被回复提醒邮件"""
+def new_reply_email(comment):
+    """生成评论被回复提醒邮件，返回 send_mail 的参数"""
     post_url = url_for('blog.show_post', post_id=comment.post_id, _external=True) + '#comments'
-    send_mail(subject='New reply', to=comment.email,
-              html='<p>New reply for the comment you left in post <i>%s</i>, click the link below to check: </p>'
-                   '<p><a href="%s">%s</a></p>'
-                   '<p><small style="color: #868e96">Do not reply this email.</small></p>'
-                   % (comment.post.title, post_url, post_url))
\ No newline at end of file
+    return dict(subject='New reply', to=comment.email,
+                html='<p>New reply for the comment you left in post <i>%s</i>, click the link below to check: </p>'
+                     '<p><a href="%s">%s</a></p>'
+                     '<p><small style="color: #868e96">Do not reply this email.</small></p>'
+                     % (comment.post.title, post_url, post_url))
@@ -0,0 +1,134 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import ObjectDeletedError
+
+_handlers = []
+
+
+class ModelChange(object):
+    """一次模型写入的记录
+
+    在 flush 时生成，只保存列的值，提交后处理函数不需要再访问数据库。修改和删除的对象中
+    已经过期的列在 flush 前加载，没有加载过的延迟加载列（例如列表页面中的 Post.body）为 None。
+
+    Attributes:
+        model: 模型类
+        id: 主键的值
+        operation: 'insert'、'update' 或 'delete'
+        values: flush 时各列的值
+        old_values: update 时被修改的列的旧值
+        info: 其他 after_flush 监听函数附加的数据，它们可以在 flush 的连接中查询，
+              把提交后需要的结果保存在这里
+    """
+    __slots__ = ('model', 'id', 'operation', 'values', 'old_values', 'info')
+
+    def __init__(self, model, id, operation, values, old_values=None):
+        self.model = model
+        self.id = id
+        self.operation = operation
+        self.values = values
+        self.old_values = old_values or {}
+        self.info = {}
+
+    def changed(self, key):
+        """判断某一列是否在这次写入中被修改"""
+        return self.operation != 'update' or key in self.old_values
+
+    def __repr__(self):
+        return '<ModelChange %s %s:%s>' % (self.operation, self.model.__name__, self.id)
+
+
+def on_models_committed(*models):
+    """注册事务提交后的处理函数
+
+    被装饰的函数接收本次提交中属于 models 的 ModelChange 列表，没有相关写入时不会被调用。
+    处理函数运行在 after_commit 事件中，不能再执行 SQL；需要查询的数据在 after_flush 中
+    查好并保存在 ModelChange.info 中。
+
+    Args:
+        *models: 关心的模型类，为空时接收所有模型的写入
+    """
+    def decorator(f):
+        _handlers.append((models, f))
+        return f
+    return decorator
+
+
+def record_changes(session, changes):
+    """记录没有经过 ORM 的写入，例如 flush 事件中直接执行的 DELETE
+
+    它们和 flush 收集到的写入一起在提交后分发，回滚时一起丢弃。
+
+    Args:
+        session: 执行写入的会话
+        changes: ModelChange 列表
+    """
+    session.info.setdefault('bluelog_changes', []).extend(changes)
+
+
+def _snapshot(obj, operation):
+    """生成对象的 ModelChange 记录"""
+    state = inspect(obj)
+    mapper = state.mapper
+    values = dict((attr.key, state.dict.get(attr.key)) for attr in mapper.column_attrs)
+    old_values = {}
+    if operation == 'update':
+        for attr in mapper.column_attrs:
+            history = state.attrs[attr.key].history
+            if history.has_changes():
+                old_values[attr.key] = history.deleted[0] if history.deleted else None
+        if not old_values:
+            return None
+    identity = mapper.primary_key_from_instance(obj)
+    return ModelChange(mapper.class_, identity[0], operation, values, old_values)
+
+
+@event.listens_for(Session, 'before_flush')
+def _load_expired(session, flush_context, instances):
+    """flush 前加载将要修改或删除的对象中已经过期的列
+
+    提交或 Core 语句之后对象的列会过期，_snapshot 读到的是 None；对象删除后无法再加载，
+    所以在 flush 之前用一次查询加载，处理函数总能拿到这些列的值。
+    """
+    for obj in list(session.dirty) + list(session.deleted):
+        state = inspect(obj)
+        if state.expired_attributes:
+            try:
+                getattr(obj, next(iter(state.expired_attributes)))  # 加载所有过期的列
+            except ObjectDeletedError:  # 行已经被删除，flush 会报告
+                pass
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    """在 flush 之后收集本次写入的对象（此时 new/dirty/deleted 仍是 flush 前的状态）
+
+    这个监听函数最先注册，之后注册的 after_flush 监听函数可以读取本次收集到的写入。
+    """
+    changes = session.info.setdefault('bluelog_changes', [])
+    for operation, objs in (('insert', session.new),
+                            ('update', session.dirty),
+                            ('delete', session.deleted)):
+        for obj in objs:
+            change = _snapshot(obj, operation)
+            if change is not None:
+                changes.append(change)
+
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch_changes(session):
+    """事务提交后把收集到的写入分发给各处理函数"""
+    changes = session.info.pop('bluelog_changes', None)
+    if not changes:
+        return
+    for models, handler in _handlers:
+        selected = [change for change in changes
+                    if not models or issubclass(change.model, models)]
+        if selected:
+            handler(selected)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    """事务回滚后丢弃收集到的写入"""
+    session.info.pop('bluelog_changes', None)
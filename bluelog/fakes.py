@@ -1,12 +1,41 @@
+import multiprocessing
 import random
+from datetime import datetime, timedelta
 
 from faker import Faker
 
 from bluelog.extensions import db
-from bluelog.models import Admin, Category, Comment, Post, Link
+from bluelog.models import Admin, ArchiveMonth, Category, Comment, Post, Link
+from bluelog.utils import summarize
 
 fake = Faker()
 
+# 每次批量 INSERT 并提交的行数，也是并行生成评论时每个任务的评论数
+BATCH_SIZE = 10000
+# 每批评论的评论者数量，同一个人会在多篇文章下评论；Faker 生成姓名和地址很慢，不能每条评论生成一次
+AUTHORS_PER_BATCH = 200
+# 回复时回复讨论串中最后一条评论的概率，连续回复形成很深的回复链
+CHAIN_RATIO = 0.7
+
+# 并行生成评论时，worker 进程中按热度排列的文章 (id, 发布时间) 列表
+_posts = None
+
+
+def seed(value):
+    """设置随机数种子，之后生成的数据只由种子和参数决定"""
+    random.seed(value)
+    fake.seed_instance(value)
+
+
+def _now():
+    """生成数据使用的当前时间，取当天零点，同一天内用同一个种子生成的数据相同"""
+    return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _sentence(rng, words, low=6, high=20):
+    """用词表拼出一个句子，比 Faker 的 sentence 快得多"""
+    return ' '.join(rng.choices(words, k=rng.randint(low, high))).capitalize() + '.'
+
 
 def fake_admin():
     """创建虚假管理员信息"""
@@ -23,97 +52,164 @@ def fake_admin():
 
 
 def fake_categories(count=10):
-    """创建虚假分类"""
-
-    category = Category(name='Default')
-    db.session.add(category)
-
-    for i in range(count):
-        category = Category(name=fake.word())
-        db.session.add(category)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
-
-
-def fake_posts(count=50):
-    """创建虚假文章"""
+    """创建虚假分类，第一个分类是 Default，重复的名称加上序号"""
+    names = ['Default']
     for i in range(count):
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=Category.query.get(random.randint(1, Category.query.count())),
-            timestamp=fake.date_time_this_year()
-        )
-
-        db.session.add(post)
+        name = fake.word()
+        names.append(name if name not in names else '%s-%d' % (name, i))
+    db.session.bulk_insert_mappings(Category, [dict(id=id, name=name)
+                                               for id, name in enumerate(names, 1)])
     db.session.commit()
 
 
-def fake_comments(count=500):
-    """创建虚假评论"""
-    for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-    
-    salt = int(count * 0.1)
-    for i in range(salt):
-        # 未审核评论
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=False,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
-        # 管理员发出的评论
-        comment = Comment(
-            author='Mima Kirigoe',
-            email='mima@example.com',
-            site='example.com',
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            from_admin=True,
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-    db.session.commit()
-    # 回复
-    for i in range(salt):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            replied=Comment.query.get(random.randint(1, Comment.query.count())),
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+def fake_posts(count=50):
+    """用批量 INSERT 创建虚假文章
+
+    文章的分类和时间在内存中选择，正文由 Faker 的词表拼成；批量插入不会触发文章的写入事件，
+    最后重新统计归档并重建搜索索引。
+    """
+    from bluelog.search import reindex
+
+    categories = Category.query.count()
+    first_id = (db.session.query(db.func.max(Post.id)).scalar() or 0) + 1
+    words = fake.words(500)
+    now = _now()
+    rows = []
+    for id in range(first_id, first_id + count):
+        body = '\n\n'.join(' '.join(_sentence(random, words) for j in range(random.randint(5, 15)))
+                           for i in range(random.randint(2, 5)))
+        excerpt, word_count, reading_time = summarize(body)
+        timestamp = now - timedelta(seconds=random.randint(0, 365 * 86400))
+        rows.append(dict(id=id, title=_sentence(random, words, 3, 8)[:60], body=body,
+                         excerpt=excerpt, word_count=word_count, reading_time=reading_time,
+                         category_id=random.randint(1, categories), can_comment=True,
+                         comment_count=0, reviewed_comment_count=0, timestamp=timestamp,
+                         updated_at=timestamp))
+        if len(rows) == BATCH_SIZE:
+            db.session.bulk_insert_mappings(Post, rows)
+            db.session.commit()
+            rows = []
+    if rows:
+        db.session.bulk_insert_mappings(Post, rows)
+        db.session.commit()
+    ArchiveMonth.rebuild()
+    for indexed in reindex():
+        pass
+
+
+def _init_worker(posts):
+    global _posts
+    _posts = posts
+
+
+def _comment_batch(args):
+    """生成一批评论的字典列表
+
+    只使用内存中的数据，不访问数据库。随机数种子由基础种子和批次序号决定，
+    生成的评论与进程数和执行顺序无关。回复只回复同一批中同一篇文章的评论。
+    """
+    index, first_id, size, base_seed, skew, reply_ratio, now = args
+    rng = random.Random('%d-%d' % (base_seed, index))
+    # 使用单独的 Faker 实例，不改变模块的 fake 之后生成的数据
+    local_fake = Faker()
+    local_fake.seed_instance('%d-%d' % (base_seed, index))
+    authors = [(local_fake.name(), local_fake.email(), local_fake.url())
+               for i in range(AUTHORS_PER_BATCH)]
+    words = local_fake.words(500)
+    # 文章 id -> 这一批中文章的每条评论所在的讨论串，讨论串是 (id, timestamp) 列表
+    threads = {}
+    rows = []
+    for id in range(first_id, first_id + size):
+        post_id, post_time = _posts[int(len(_posts) * rng.random() ** skew)]
+        post_threads = threads.setdefault(post_id, [])
+        if post_threads and rng.random() < reply_ratio:
+            # 随机选一条评论所在的讨论串，评论越多的讨论串越容易得到回复
+            thread = rng.choice(post_threads)
+            parent = thread[-1] if rng.random() < CHAIN_RATIO else rng.choice(thread)
+            replied_id, thread_id = parent[0], thread[0][0]
+            timestamp = min(now, parent[1] + timedelta(seconds=rng.randint(60, 86400)))
+            thread.append((id, timestamp))
+            post_threads.append(thread)
+        else:
+            replied_id = thread_id = None
+            timestamp = post_time + timedelta(seconds=rng.randint(
+                0, max(int((now - post_time).total_seconds()), 0)))
+            post_threads.append([(id, timestamp)])
+        from_admin = rng.random() < 0.05
+        if from_admin:
+            author, email, site = 'Mima Kirigoe', 'mima@example.com', 'example.com'
+        else:
+            author, email, site = rng.choice(authors)
+        rows.append(dict(id=id, author=author, email=email, site=site, body=_sentence(rng, words),
+                         timestamp=timestamp, from_admin=from_admin,
+                         reviewed=from_admin or rng.random() > 0.1, post_id=post_id,
+                         replied_id=replied_id, thread_id=thread_id))
+    return rows
+
+
+def fake_comments(count=500, skew=3.0, reply_ratio=0.3, workers=1):
+    """用批量 INSERT 创建虚假评论
+
+    评论集中在少数热门文章上：文章按随机顺序排列，第 int(n * random() ** skew) 篇得到评论，
+    skew 为 1 时均匀分布。文章在这一批中已经有评论时，新评论有 reply_ratio 的概率是回复，
+    评论越多的讨论串越容易得到回复，回复多接着讨论串的最后一条评论，形成很深的回复链。
+    约 10% 未审核，约 5% 来自管理员。
+
+    评论按批生成，workers 大于 1 时由进程池并行生成，当前进程按批次顺序插入并提交；
+    相同的随机数种子生成相同的数据，与 workers 无关。批量插入不会触发评论的写入事件，
+    最后重新计算文章的评论计数和修改时间。
+
+    Args:
+        count:评论数量
+        skew:热门文章的集中程度
+        reply_ratio:回复所占的比例
+        workers:生成评论的进程数
+    Returns:
+        生成器，每插入一批产生一次已插入的评论数
+    """
+    posts = [(id, timestamp) for id, timestamp in db.session.query(
+        Post.id, Post.timestamp).order_by(Post.id)]
+    if not posts:
+        return
+    random.shuffle(posts)
+    first_id = (db.session.query(db.func.max(Comment.id)).scalar() or 0) + 1
+    base_seed = random.getrandbits(32)
+    now = _now()
+    tasks = [(index, first_id + start, min(BATCH_SIZE, count - start), base_seed, skew,
+              reply_ratio, now) for index, start in enumerate(range(0, count, BATCH_SIZE))]
+
+    if workers > 1:
+        # 子进程不能继续使用父进程打开的连接
+        db.session.remove()
+        db.engine.dispose()
+        pool = multiprocessing.Pool(workers, _init_worker, (posts,))
+        batches = pool.imap(_comment_batch, tasks)
+    else:
+        pool = None
+        _init_worker(posts)
+        batches = map(_comment_batch, tasks)
+    inserted = 0
+    try:
+        for rows in batches:
+            db.session.bulk_insert_mappings(Comment, rows)
+            db.session.commit()
+            inserted += len(rows)
+            yield inserted
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    Post.recount_comments()
+    # 重新计数把 updated_at 改成了当前时间，改为最后一条已审核评论的时间，没有时为文章的发布时间
+    latest = db.select([db.func.max(Comment.timestamp)]).where(
+        (Comment.post_id == Post.id) & (Comment.reviewed == True))  # noqa: E712
+    Post.query.update({Post.updated_at: db.func.coalesce(latest.as_scalar(), Post.timestamp)},
+                      synchronize_session=False)
     db.session.commit()
 
 
 def fake_url(count=5):
     """创建虚假链接"""
-    for i in range(count):
-        link = Link(
-            name = fake.name(),
-            url = fake.url()
-        )
-        db.session.add(link)
-    db.session.commit()
\ No newline at end of file
+    db.session.bulk_insert_mappings(Link, [dict(name=fake.name(), url=fake.url())
+                                           for i in range(count)])
+    db.session.commit()
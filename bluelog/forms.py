@@ -4,6 +4,7 @@ from wtforms import (BooleanField, HiddenField, PasswordField, SelectField,
                      StringField, SubmitField, TextAreaField, ValidationError)
 from wtforms.validators import URL, DataRequired, Email, Length, Optional
 
+from bluelog.caching import get_categories
 from bluelog.models import Category
 
 
@@ -33,12 +34,12 @@ class PostForm(FlaskForm):
     def __init__(self, *args, **kwargs):
         """初始化表单内容
 
-        为分类设置查询对象
+        为分类设置选项，分类列表从缓存中获取
 
         """
         super(PostForm, self).__init__(*args, **kwargs)
         self.category.choices = [(category.id, category.name)
-                                 for category in Category.query.order_by(Category.name).all()]
+                                 for category in get_categories()]
 
 
 class CategoryForm(FlaskForm):
@@ -0,0 +1,478 @@
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from html import escape, unescape
+from urllib.parse import parse_qs, urlsplit
+
+from flask import current_app
+from sqlalchemy import event, func
+from sqlalchemy.pool import SingletonThreadPool
+
+from bluelog.assets import MANIFEST_FILE as ASSETS_MANIFEST_FILE
+from bluelog.counts import count_posts, count_threads
+from bluelog.extensions import db
+from bluelog.models import ArchiveMonth, Category, Comment, Post
+
+# 记录每个输出文件内容哈希的清单，保存在输出目录中
+MANIFEST_FILE = '.freeze.json'
+# 等待重新生成的页面队列，由 dependencies 模块在数据修改后追加
+QUEUE_FILE = '.freeze-queue'
+# 不区分主题的页面
+_plain_pages = ('/feed.xml', '/atom.xml', '/sitemap.xml')
+# 可以静态化的页面路径，只允许 page 查询参数
+_page_re = re.compile(r'^/(?:about|archive(?:/\d+/\d+)?|category/\d+|post/\d+)?$')
+_theme_re = re.compile(r'^/change-theme/([^/?#]+)$')
+_link_re = re.compile(r'href="([^"]*)"')
+_paged_re = re.compile(r'^/(category|post)/(\d+)$')
+_archive_re = re.compile(r'^/archive/(\d+)/(\d+)$')
+
+# 进程池中每个 worker 进程的 (client, base_url, default_theme)
+_worker = None
+
+
+def static_path(url, prefix=''):
+    """把博客页面的 URL 转为静态站点中的路径
+
+    /post/1?page=2 转为 /post/1/page/2/，第一页不带 page；主题变体的页面放在 /<主题名>/ 下面。
+
+    Args:
+        url:站内 URL，可以带片段
+        prefix:主题变体的路径前缀，默认主题为空字符串
+    Returns:
+        静态站点中的路径；不能静态化的 URL（表单、登录、搜索等）返回 None
+    """
+    parts = urlsplit(url)
+    if parts.scheme or parts.netloc or not _page_re.match(parts.path):
+        return None
+    args = parse_qs(parts.query)
+    if set(args) - {'page'}:
+        return None
+    path = prefix + parts.path.rstrip('/') + '/'
+    page = args.get('page', ['1'])[-1]
+    if not page.isdigit():
+        return None
+    if int(page) > 1:
+        path += 'page/%d/' % int(page)
+    return path + ('#' + parts.fragment if parts.fragment else '')
+
+
+def theme_prefix(theme, default_theme):
+    return '' if theme == default_theme else '/' + theme
+
+
+def rewrite_links(html, prefix, default_theme):
+    """把页面中指向其他页面的链接改为静态站点中的路径
+
+    切换主题的链接改为同一个页面在对应主题下的路径，不能静态化的链接保持不变，由源站处理。
+    """
+    def replace(match):
+        url = unescape(match.group(1))
+        theme = _theme_re.match(url.split('?', 1)[0])
+        if theme is not None:
+            next_url = parse_qs(urlsplit(url).query).get('next', ['/'])[-1]
+            path = static_path(next_url, theme_prefix(theme.group(1), default_theme))
+        else:
+            path = static_path(url, prefix)
+        if path is None:
+            return match.group(0)
+        return 'href="%s"' % escape(path)
+    return _link_re.sub(replace, html)
+
+
+def output_file(path):
+    """静态路径对应的输出文件（相对输出目录）"""
+    path = path.lstrip('/')
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    return path
+
+
+def _page_count(total, per_page):
+    return max(1, int(math.ceil(total / float(per_page))))
+
+
+def _page_url(path, page):
+    return path + ('?page=%d' % page if page > 1 else '')
+
+
+def _page_total(path):
+    """路径的页数；文章或分类不存在时返回 1，渲染时得到 404，已有的文件会被删除"""
+    config = current_app.config
+    if path == '/':
+        return _page_count(count_posts(), config['BLUELOG_POST_PER_PAGE'])
+    match = _archive_re.match(path)
+    if match is not None:
+        total = db.session.query(ArchiveMonth.post_count).filter_by(
+            year=int(match.group(1)), month=int(match.group(2))).scalar()
+        return _page_count(total or 0, config['BLUELOG_POST_PER_PAGE'])
+    match = _paged_re.match(path)
+    if match is None:
+        return 1
+    id = int(match.group(2))
+    if match.group(1) == 'category':
+        return _page_count(count_posts(id), config['BLUELOG_POST_PER_PAGE'])
+    if config['BLUELOG_COMMENT_THREADED']:
+        total = count_threads(id)
+    else:
+        total = db.session.query(Post.reviewed_comment_count).filter_by(id=id).scalar()
+    return _page_count(total or 0, config['BLUELOG_COMMENT_PER_PAGE'])
+
+
+def _path_files(path, prefix):
+    """匹配一个路径所有页的输出文件的正则表达式"""
+    directory = output_file(static_path(path, prefix))[:-len('index.html')]
+    return re.compile(r'^%s(?:page/\d+/)?index\.html$' % re.escape(directory))
+
+
+def iter_urls():
+    """生成需要静态化的所有页面 URL
+
+    文章的评论页数由 reviewed_comment_count 或讨论串数计算，分类的页数由一次分组查询计算，
+    归档月份的页数来自归档汇总表；用 yield_per 分批读取文章，不会把所有文章保存在内存中。
+    """
+    config = current_app.config
+    post_per_page = config['BLUELOG_POST_PER_PAGE']
+    comment_per_page = config['BLUELOG_COMMENT_PER_PAGE']
+    batch = config['BLUELOG_SITEMAP_BATCH']
+
+    for page in range(1, _page_count(count_posts(), post_per_page) + 1):
+        yield _page_url('/', page)
+    yield '/about'
+
+    yield '/archive'
+    for archive in ArchiveMonth.query.filter(ArchiveMonth.post_count > 0).order_by(
+            ArchiveMonth.year, ArchiveMonth.month):
+        path = '/archive/%d/%d' % (archive.year, archive.month)
+        for page in range(1, _page_count(archive.post_count, post_per_page) + 1):
+            yield _page_url(path, page)
+
+    counts = dict(db.session.query(Post.category_id, func.count(Post.id)).group_by(
+        Post.category_id))
+    for id, in db.session.query(Category.id).order_by(Category.id):
+        for page in range(1, _page_count(counts.get(id, 0), post_per_page) + 1):
+            yield _page_url('/category/%d' % id, page)
+
+    threads = None
+    if config['BLUELOG_COMMENT_THREADED']:
+        threads = dict(db.session.query(Comment.post_id, func.count(Comment.id)).filter(
+            Comment.reviewed == True, Comment.replied_id == None  # noqa: E711,E712
+        ).group_by(Comment.post_id))
+    posts = db.session.query(Post.id, Post.reviewed_comment_count).order_by(Post.id)
+    for id, reviewed in posts.yield_per(batch):
+        total = threads.get(id, 0) if threads is not None else reviewed or 0
+        for page in range(1, _page_count(total, comment_per_page) + 1):
+            yield _page_url('/post/%d' % id, page)
+
+
+def _read_only_listener(dialect):
+    """返回把新连接设为只读的连接事件监听函数"""
+    statement = {
+        'sqlite': 'PRAGMA query_only = ON',
+        'mysql': 'SET SESSION TRANSACTION READ ONLY',
+        'postgresql': 'SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY',
+    }.get(dialect)
+
+    def set_read_only(dbapi_connection, connection_record):
+        if statement is not None:
+            cursor = dbapi_connection.cursor()
+            cursor.execute(statement)
+            cursor.close()
+    return set_read_only
+
+
+def _init_worker(config_name, database_uri, base_url, default_theme):
+    """初始化 worker 进程
+
+    每个进程创建自己的 app 和只有一个连接的只读连接池，所有页面共用这个连接；
+    关闭页面缓存，渲染结果不写入缓存；关闭评论缓冲区、提醒邮件和相关文章的后台更新，
+    worker 进程不写入数据库，也不启动后台线程和 SMTP 连接。
+    """
+    global _worker
+    from bluelog import create_app
+    from bluelog.comment_buffer import comment_buffer
+    from bluelog.emails import mail_queue
+    from bluelog.notifications import notifier
+    from bluelog.page_cache import page_cache
+    from bluelog.related import related_updater
+
+    app = create_app(config_name)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(poolclass=SingletonThreadPool)
+    with app.app_context():
+        event.listen(db.engine, 'connect', _read_only_listener(db.engine.dialect.name))
+    page_cache.backend = None
+    comment_buffer.enabled = False
+    notifier.auto_send = False
+    mail_queue.workers = 0  # 在当前线程中“发送”，不启动 worker 线程
+    app.extensions['mail'].suppress = True  # 不连接 SMTP 服务器
+    related_updater.enabled = False
+    # 静态页面只能使用页码分页
+    app.config['BLUELOG_KEYSET_PAGINATION'] = False
+    _worker = (app.test_client(use_cookies=False), base_url, default_theme)
+
+
+def queue_pages(output, pages):
+    """把受影响的页面追加到静态输出目录的队列中，由 flask freeze --incremental 重新生成
+
+    每个页面一行：路径和逗号分隔的页码，* 表示所有页；单独一行 * 表示全部页面。
+    输出目录中还没有生成过静态站点时不记录。
+
+    Args:
+        output:静态输出目录
+        pages:dependencies.AffectedPages 对象
+    """
+    if not os.path.exists(os.path.join(output, MANIFEST_FILE)):
+        return
+    if pages.everything:
+        lines = ['*']
+    else:
+        lines = ['%s %s' % (path, '*' if numbers is None else ','.join(map(str, sorted(numbers))))
+                 for path, numbers in pages.paths.items()]
+    # 追加模式的一次小写入是原子的，多个进程同时追加不会交错
+    with open(os.path.join(output, QUEUE_FILE), 'a') as f:
+        f.write(''.join(line + '\n' for line in lines))
+
+
+def _take_queue(output):
+    """取出队列中的页面
+
+    队列先改名再读取，读取期间新追加的页面写入新的队列文件；取出的内容保存在 .pending 文件中，
+    生成完成后才删除，中断的生成下次会重新处理。
+
+    Returns:
+        路径到页码集合（None 表示所有页）的字典；需要生成全部页面时返回 None
+    """
+    queue = os.path.join(output, QUEUE_FILE)
+    pending = queue + '.pending'
+    lines = []
+    if os.path.exists(pending):
+        with open(pending) as f:
+            lines.extend(f.read().splitlines())
+    taken = '%s.%d' % (queue, os.getpid())
+    try:
+        os.replace(queue, taken)
+    except OSError:
+        pass
+    else:
+        with open(taken) as f:
+            lines.extend(f.read().splitlines())
+        _write(pending, ''.join(line + '\n' for line in lines).encode('utf-8'))
+        os.remove(taken)
+
+    paths = {}
+    for line in lines:
+        path, _, numbers = line.strip().partition(' ')
+        if path == '*':
+            return None
+        if not path:
+            continue
+        if numbers == '*' or paths.get(path, ()) is None:
+            paths[path] = None
+        else:
+            paths.setdefault(path, set()).update(int(n) for n in numbers.split(',') if n.isdigit())
+    return paths
+
+
+def _finish_queue(output):
+    try:
+        os.remove(os.path.join(output, QUEUE_FILE + '.pending'))
+    except OSError:
+        pass
+
+
+def _render(task):
+    """渲染一个页面，内容哈希与上次输出不同时写入文件
+
+    Args:
+        task:(url, theme, 输出目录, 上次输出的哈希) 元组，theme 为 None 表示不区分主题的页面
+    Returns:
+        (输出文件, 哈希, 状态) 元组，状态为 'written'、'unchanged'、'missing'（404）或错误的 HTTP 状态码
+    """
+    client, base_url, default_theme = _worker
+    url, theme, output, old_hash = task
+    if theme is None:
+        filename = url.lstrip('/')
+        headers = {}
+    else:
+        filename = output_file(static_path(url, theme_prefix(theme, default_theme)))
+        headers = {'Cookie': 'theme=%s' % theme}
+    response = client.get(url, base_url=base_url, headers=headers)
+    data = response.get_data()
+    if response.status_code == 404:
+        return filename, None, 'missing'
+    if response.status_code != 200:
+        return filename, old_hash, response.status_code
+    if theme is not None:
+        data = rewrite_links(data.decode('utf-8'), theme_prefix(theme, default_theme),
+                             default_theme).encode('utf-8')
+    digest = hashlib.sha1(data).hexdigest()
+    path = os.path.join(output, filename)
+    if digest == old_hash and os.path.exists(path):
+        return filename, digest, 'unchanged'
+    _write(path, data)
+    return filename, digest, 'written'
+
+
+def _write(path, data):
+    """先写临时文件再原子替换，CDN 同步时不会读到写了一半的文件"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def _copy_static(output, manifest, files, stats):
+    """复制静态文件，只复制内容改变了的文件，stats['static'] 为复制的文件数
+
+    启用了 flask assets 生成的文件时，页面引用带哈希的文件名，同时复制这些文件和预压缩文件。
+    """
+    folders = [current_app.static_folder]
+    assets = current_app.extensions['assets']
+    if assets.manifest:
+        folders.append(assets.directory)
+    for static_folder in folders:
+        for root, dirs, names in os.walk(static_folder):
+            for name in names:
+                source = os.path.join(root, name)
+                filename = os.path.relpath(source, static_folder).replace(os.sep, '/')
+                if static_folder == assets.directory and filename == ASSETS_MANIFEST_FILE:
+                    continue
+                filename = 'static/' + filename
+                with open(source, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+                target = os.path.join(output, filename)
+                if manifest.get(filename) != digest or not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copyfile(source, target)
+                    stats['static'] += 1
+                files[filename] = digest
+
+
+def _load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def freeze(output, themes, workers, base_url='http://localhost/', incremental=False,
+           chunksize=64):
+    """把公开页面渲染为静态 HTML 文件
+
+    页面分块交给进程池渲染，每个 worker 进程使用自己的只读数据库连接。输出目录中的清单
+    记录每个文件的内容哈希，内容没有变化的文件不会重写，CDN 同步时只需要上传改变了的文件；
+    已经不存在的页面（例如删除的文章）对应的文件会被删除。
+
+    incremental 为 True 时只重新生成队列中记录的页面；队列要求生成全部页面或还没有生成过时
+    按全量处理。
+
+    Args:
+        output:输出目录
+        themes:要生成的主题，第一个为默认主题，输出在根目录，其他主题输出在 /<主题名>/ 下面
+        workers:worker 进程数
+        base_url:订阅源和站点地图中绝对链接使用的地址
+        incremental:是否只生成队列中的页面
+        chunksize:每次交给 worker 的页面数
+    Returns:
+        生成器，每渲染 1000 个页面和结束时产生一次统计字典，包括
+        pages、written、unchanged、removed、static、errors、elapsed 和 pages_per_sec
+    """
+    app = current_app._get_current_object()
+    default_theme = themes[0]
+    output = os.path.abspath(output)
+    os.makedirs(output, exist_ok=True)
+    manifest = _load_manifest(output)
+    queued = _take_queue(output) if manifest else None
+    if not incremental:
+        queued = None  # 全量生成同时处理了队列中的页面
+    # 增量生成时从上次的清单开始，只替换生成了的页面
+    files = dict(manifest) if queued is not None else {}
+    rendered = set()
+    stats = dict(pages=0, written=0, unchanged=0, removed=0, static=0, errors=[])
+    start = time.time()
+
+    def urls():
+        if queued is None:
+            for url in _plain_pages:
+                yield url, True
+            for url in iter_urls():
+                yield url, False
+            return
+        for path, numbers in queued.items():
+            if path in _plain_pages:
+                yield path, True
+            elif static_path(path) is not None:
+                for page in sorted(numbers) if numbers is not None else range(
+                        1, _page_total(path) + 1):
+                    yield _page_url(path, page), False
+
+    def tasks():
+        # 进程池在单独的线程中读取任务，需要在这个线程中推送应用上下文
+        with app.app_context():
+            for url, plain in urls():
+                if plain:
+                    yield url, None, output, manifest.get(url.lstrip('/'))
+                    continue
+                for theme in themes:
+                    filename = output_file(static_path(url, theme_prefix(theme, default_theme)))
+                    yield url, theme, output, manifest.get(filename)
+
+    def report():
+        elapsed = time.time() - start
+        return dict(stats, elapsed=elapsed,
+                    pages_per_sec=stats['pages'] / elapsed if elapsed else 0.0)
+
+    args = (app.config['BLUELOG_CONFIG_NAME'], app.config['SQLALCHEMY_DATABASE_URI'], base_url,
+            default_theme)
+    # 子进程不能继续使用父进程打开的连接
+    db.session.remove()
+    db.engine.dispose()
+    pool = multiprocessing.Pool(workers, _init_worker, args)
+    results = pool.imap_unordered(_render, tasks(), chunksize)
+    try:
+        for filename, digest, status in results:
+            stats['pages'] += 1
+            if status in ('written', 'unchanged'):
+                stats[status] += 1
+                files[filename] = digest
+                rendered.add(filename)
+            elif status == 'missing':
+                files.pop(filename, None)
+            else:
+                stats['errors'].append((filename, status))
+                rendered.add(filename)
+            if stats['pages'] % 1000 == 0:
+                yield report()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    _copy_static(output, manifest, files, stats)
+    if queued is not None:
+        # 页数减少后（例如删除了评论）多出来的页
+        patterns = [_path_files(path, theme_prefix(theme, default_theme))
+                    for path, numbers in queued.items()
+                    if numbers is None and static_path(path) is not None for theme in themes]
+        for filename in list(files):
+            if filename not in rendered and any(p.match(filename) for p in patterns):
+                del files[filename]
+    for filename in set(manifest) - set(files):
+        try:
+            os.remove(os.path.join(output, filename))
+            stats['removed'] += 1
+        except OSError:
+            pass
+    _write(os.path.join(output, MANIFEST_FILE),
+           json.dumps(files, sort_keys=True).encode('utf-8'))
+    _finish_queue(output)
+    yield report()
@@ -1,9 +1,17 @@
+import sqlite3
+from collections import Counter, defaultdict
 from datetime import datetime
 
 from flask_login import UserMixin
+from sqlalchemy import event, func, inspect, select, text
+from sqlalchemy.dialects import mysql
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import object_session
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from bluelog.events import ModelChange, record_changes
 from bluelog.extensions import db
+from bluelog.utils import summarize
 
 
 class Admin(db.Model, UserMixin):
@@ -74,15 +82,21 @@ class Category(db.Model):
     def delete(self):
         """删除分类
 
-        删除分类并将此分类下的文章移至默认分类
+        删除分类并用一条 UPDATE 语句将此分类下的文章移至默认分类。
+        批量更新不会触发文章的写入事件，所以直接清除两个分类的文章计数。
 
         """
-        default_category = Category.query.get(1)
-        posts = self.posts[:]
-        for post in posts:
-            post.category = default_category
+        from bluelog.counts import count_cache
+
+        Post.query.filter_by(category_id=self.id).update({
+            Post.category_id: 1,
+            Post.updated_at: datetime.utcnow(),
+        }, synchronize_session='evaluate')
+        # 会话中已加载的文章列表已经过期，删除分类时不能再按它修改文章
+        db.session.expire(self, ['posts'])
         db.session.delete(self)
         db.session.commit()
+        count_cache.invalidate(('posts', self.id), ('posts', 1))
 
 
 class Post(db.Model):
@@ -95,22 +109,76 @@ class Post(db.Model):
         title:文章的标题，限制长度60
         body:文章的内容
         timestamp:文章的创建时间，默认是当前时间
+        updated_at:文章或其评论最后修改的时间，已审核评论数的更新也会修改它，用作 HTTP 缓存验证
         can_coment:文章是否可以评论
+        excerpt:正文去掉标签后的摘要，在设置正文时生成
+        word_count:正文的字数，在设置正文时生成
+        reading_time:估算的阅读时间（分钟），在设置正文时生成
+        comment_count:文章的评论总数（包括未审核评论），由 Comment 的写入事件维护
+        reviewed_comment_count:文章已审核的评论数，由 Comment 的写入事件维护
         category_id:文章的分类id，外键
         category:设置和分类的中间表的名称
-        coments:设置和评论的中间表的名称，规定删除文章时，删除文章下的所有评论
+        coments:设置和评论的中间表的名称，删除文章时由外键的 ON DELETE CASCADE 删除文章下的所有评论，
+                不会把评论加载到会话中
+
+    索引与文章列表的查询一致：按时间倒序列出全部文章，或列出某个分类下的文章。
 
     """
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_category_id_timestamp', 'category_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
     body = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # active_history：修改时间时加载旧值，用于把文章从原来的归档月份中减去
+    timestamp = db.column_property(db.Column(db.DateTime, default=datetime.utcnow),
+                                   active_history=True)
     can_comment = db.Column(db.Boolean, default=True)
+    # MySQL 使用微秒精度，同一秒内的多次修改也能产生不同的验证值
+    updated_at = db.Column(db.DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql'),
+                           default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    excerpt = db.Column(db.String(300))
+    word_count = db.Column(db.Integer, default=0)
+    reading_time = db.Column(db.Integer, default=1)
+    comment_count = db.Column(db.Integer, default=0)
+    reviewed_comment_count = db.Column(db.Integer, default=0)
 
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
 
     category = db.relationship('Category', back_populates='posts')
-    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')
+    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan',
+                               passive_deletes=True)
+
+    def set_body(self, body):
+        """设置文章正文
+
+        同时生成摘要、字数和阅读时间，列表页面不需要再加载和处理正文。
+
+        Args:
+            body:HTML 正文
+        """
+        self.body = body
+        self.excerpt, self.word_count, self.reading_time = summarize(body)
+
+    @staticmethod
+    def recount_comments():
+        """重新计算所有文章的评论计数
+
+        使用一条带关联子查询的 UPDATE 语句，修正计数与评论表不一致的情况。
+
+        Returns:
+            更新的文章数量
+        """
+        count = select([func.count(Comment.id)]).where(Comment.post_id == Post.id)
+        reviewed_count = count.where(Comment.reviewed == True)  # noqa: E712
+        rowcount = Post.query.update({
+            Post.comment_count: count.as_scalar(),
+            Post.reviewed_comment_count: reviewed_count.as_scalar(),
+        }, synchronize_session=False)
+        db.session.commit()
+        return rowcount
 
 
 class Comment(db.Model):
@@ -129,28 +197,153 @@ class Comment(db.Model):
         timestamp:评论的时间，默认为当前时间，并设置索引
         post_id:评论文章的评论的外键为文章的id
         relied_id:回复评论的评论的外键为评论的id
+        thread_id:所在讨论串的根评论的id，根评论为 None；创建回复时自动设置
         post:设置和post的中间表
-        replies:
+        replies:评论的回复，删除评论时由 _delete_replies 用一条 DELETE 删除所有回复
         relied:
 
+    复合索引对应评论的查询：文章页按文章和审核状态列出评论，管理页按审核状态或是否来自管理员筛选，
+    都按时间排序。嵌套显示时按 thread_id 一次取出一页讨论串中的所有回复。
+
     """
+    __table_args__ = (
+        db.Index('ix_comment_post_id_reviewed_timestamp', 'post_id', 'reviewed', 'timestamp', 'id'),
+        db.Index('ix_comment_reviewed_timestamp', 'reviewed', 'timestamp', 'id'),
+        db.Index('ix_comment_from_admin_timestamp', 'from_admin', 'timestamp', 'id'),
+        db.Index('ix_comment_thread_id_timestamp', 'thread_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(30))
     email = db.Column(db.String(354))
     site = db.Column(db.String(255))
     body = db.Column(db.Text)
     from_admin = db.Column(db.Boolean, default=False)
-    reviewed = db.Column(db.Boolean, default=False)
+    # active_history：对象过期（例如提交之后）再修改时也加载旧值，文章的评论计数按新旧值增减
+    reviewed = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
-    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    post_id = db.column_property(db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE')),
+                                 active_history=True)
+    # 级联删除按 replied_id 查找回复，MySQL 会为外键自动建立索引，SQLite 不会
+    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id', ondelete='CASCADE'), index=True)
+    thread_id = db.Column(db.Integer)
 
     post = db.relationship('Post', back_populates='comments')
-    replies = db.relationship('Comment', back_populates='replied', cascade='all, delete-orphan')
+    replies = db.relationship('Comment', back_populates='replied', cascade='all, delete-orphan',
+                              passive_deletes=True)
     replied = db.relationship('Comment', back_populates='replies', remote_side=[id])
 
 
+def _update_comment_count(connection, post_id, total, reviewed):
+    """在同一个事务中原子地修改文章的评论计数
+
+    Args:
+        connection:当前 flush 使用的数据库连接
+        post_id:文章的id
+        total:评论总数的增量
+        reviewed:已审核评论数的增量
+    """
+    if post_id is None or (total == 0 and reviewed == 0):
+        return
+    table = Post.__table__
+    values = dict(comment_count=table.c.comment_count + total,
+                  reviewed_comment_count=table.c.reviewed_comment_count + reviewed)
+    if reviewed == 0:
+        # 页面上看不到未审核的评论，不修改 updated_at，HTTP 缓存验证值保持不变
+        values['updated_at'] = table.c.updated_at
+    connection.execute(table.update().where(table.c.id == post_id).values(**values))
+
+
+@event.listens_for(Comment, 'before_insert')
+def _set_comment_thread(mapper, connection, target):
+    """回复继承被回复评论所在的讨论串"""
+    if target.replied_id is None:
+        return
+    replied = target.replied
+    if replied is None:
+        table = Comment.__table__
+        replied = connection.execute(select([table.c.id, table.c.thread_id]).where(
+            table.c.id == target.replied_id)).first()
+    if replied is not None:
+        target.thread_id = replied.thread_id or replied.id
+
+
+@event.listens_for(Comment, 'after_insert')
+def _comment_inserted(mapper, connection, target):
+    """新评论写入后增加文章的评论计数"""
+    _update_comment_count(connection, target.post_id, 1, 1 if target.reviewed else 0)
+
+
+@event.listens_for(Comment, 'after_delete')
+def _comment_deleted(mapper, connection, target):
+    """评论删除后减少文章的评论计数"""
+    _update_comment_count(connection, target.post_id, -1, -1 if target.reviewed else 0)
+
+
+@event.listens_for(Comment, 'before_delete')
+def _delete_replies(mapper, connection, target):
+    """删除评论前删除它的所有回复（包括回复的回复）
+
+    用一次查询取出讨论串中的评论，找出这条评论的所有回复，减少文章的评论计数后用 DELETE 删除，
+    不经过 ORM；删除整个讨论串时按 thread_id 只执行一条语句。不直接依赖 ON DELETE CASCADE：
+    它不会修改计数，而且 MySQL 的级联最多嵌套 15 层，MySQL 中先清空回复的 replied_id。
+    会话中已经标记删除的回复由 ORM 删除，这里跳过。删除的回复记录为提交后的写入，
+    计数缓存和页面缓存照常更新。
+    """
+    table = Comment.__table__
+    rows = connection.execute(select([table]).where(
+        table.c.thread_id == (target.thread_id or target.id))).fetchall()
+    children = defaultdict(list)
+    for row in rows:
+        children[row.replied_id].append(row)
+    session = object_session(target)
+    deleted = {obj.id for obj in session.deleted if isinstance(obj, Comment)}
+    replies = []
+    parents = [target.id]
+    while parents:
+        for row in children.pop(parents.pop(), ()):
+            parents.append(row.id)
+            if row.id not in deleted:
+                replies.append(row)
+    if not replies:
+        return
+
+    totals = Counter(row.post_id for row in replies)
+    reviewed = Counter(row.post_id for row in replies if row.reviewed)
+    for post_id, total in totals.items():
+        _update_comment_count(connection, post_id, -total, -reviewed[post_id])
+    if target.thread_id is None and len(replies) == len(rows):
+        conditions = [table.c.thread_id == target.id]
+    else:
+        ids = [row.id for row in replies]
+        conditions = [table.c.id.in_(ids[start:start + 500])  # SQLite 默认最多 999 个参数
+                      for start in range(0, len(ids), 500)]
+    for condition in conditions:
+        if connection.dialect.name == 'mysql':
+            connection.execute(table.update().where(condition).values(replied_id=None))
+        connection.execute(table.delete().where(condition))
+    record_changes(session, [ModelChange(Comment, row.id, 'delete', dict(row)) for row in replies])
+
+
+@event.listens_for(Comment, 'after_update')
+def _comment_updated(mapper, connection, target):
+    """评论审核状态或所属文章改变后修正文章的评论计数"""
+    state = inspect(target)
+    post_history = state.attrs.post_id.history
+    reviewed_history = state.attrs.reviewed.history
+    if not post_history.has_changes() and not reviewed_history.has_changes():
+        return
+    old_post_id = post_history.deleted[0] if post_history.deleted else target.post_id
+    old_reviewed = reviewed_history.deleted[0] if reviewed_history.deleted else target.reviewed
+    if old_post_id == target.post_id:
+        _update_comment_count(connection, target.post_id, 0,
+                              int(bool(target.reviewed)) - int(bool(old_reviewed)))
+    else:
+        _update_comment_count(connection, old_post_id, -1, -1 if old_reviewed else 0)
+        _update_comment_count(connection, target.post_id, 1, 1 if target.reviewed else 0)
+
+
 class Link(db.Model):
     """生成链接表的类
 
@@ -164,3 +357,208 @@ class Link(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     url = db.Column(db.String(255))
+
+
+class ArchiveMonth(db.Model):
+    """按月汇总的文章数，用于归档页面和侧边栏的归档列表
+
+    由 Post 的写入事件在同一个事务中增量维护：新建、删除文章和修改发布时间时修改对应月份的计数，
+    不需要每次都对文章表做 GROUP BY。月份按 UTC 时间计算。
+
+    Attributes:
+        year:年份，主键
+        month:月份，主键
+        post_count:这个月发布的文章数，为 0 的行不显示
+    """
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    month = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def rebuild():
+        """用一次 GROUP BY 查询重新统计每个月的文章数
+
+        Returns:
+            有文章的月份数量
+        """
+        year = func.extract('year', Post.timestamp)
+        month = func.extract('month', Post.timestamp)
+        rows = db.session.query(year, month, func.count(Post.id)).filter(
+            Post.timestamp != None  # noqa: E711
+        ).group_by(year, month).all()
+        table = ArchiveMonth.__table__
+        db.session.execute(table.delete())
+        if rows:
+            db.session.execute(table.insert(), [
+                dict(year=int(y), month=int(m), post_count=count) for y, m, count in rows])
+        db.session.commit()
+        return len(rows)
+
+
+def _update_archive(connection, timestamp, delta):
+    """在同一个事务中修改文章发布月份的文章数，月份还没有记录时插入
+
+    增加计数时使用一条 upsert 语句，两个事务同时插入同一个新月份时不会违反主键约束。
+    """
+    if timestamp is None:
+        return
+    table = ArchiveMonth.__table__
+    if delta <= 0:
+        connection.execute(table.update().where(
+            (table.c.year == timestamp.year) & (table.c.month == timestamp.month)
+        ).values(post_count=table.c.post_count + delta))
+    elif connection.dialect.name == 'mysql':
+        connection.execute(mysql.insert(table).values(
+            year=timestamp.year, month=timestamp.month, post_count=delta
+        ).on_duplicate_key_update(post_count=table.c.post_count + delta))
+    else:  # SQLite 3.24 及以上
+        connection.execute(text(
+            'INSERT INTO archive_month (year, month, post_count) VALUES (:year, :month, :delta) '
+            'ON CONFLICT (year, month) DO UPDATE SET post_count = post_count + excluded.post_count'
+        ), year=timestamp.year, month=timestamp.month, delta=delta)
+
+
+@event.listens_for(Post, 'after_insert')
+def _archive_post_inserted(mapper, connection, target):
+    _update_archive(connection, target.timestamp, 1)
+
+
+@event.listens_for(Post, 'after_delete')
+def _archive_post_deleted(mapper, connection, target):
+    _update_archive(connection, target.timestamp, -1)
+
+
+@event.listens_for(Post, 'before_delete')
+def _detach_replies(mapper, connection, target):
+    """删除文章前在 MySQL 中清空它的评论的 replied_id
+
+    文章的评论由 post_id 的 ON DELETE CASCADE 删除，MySQL 删除每条评论时还会沿 replied_id
+    级联删除回复，嵌套超过 15 层的回复链会使删除失败。SQLite 没有这个限制。
+    """
+    if connection.dialect.name != 'mysql':
+        return
+    table = Comment.__table__
+    connection.execute(table.update().where(
+        (table.c.post_id == target.id) & (table.c.replied_id != None)  # noqa: E711
+    ).values(replied_id=None))
+
+
+@event.listens_for(Post, 'after_update')
+def _archive_post_updated(mapper, connection, target):
+    """发布时间改到另一个月时，把文章从原来的月份移到新的月份"""
+    history = inspect(target).attrs.timestamp.history
+    if not history.has_changes():
+        return
+    old = history.deleted[0] if history.deleted else None
+    new = target.timestamp
+    if old is not None and new is not None and (old.year, old.month) == (new.year, new.month):
+        return
+    _update_archive(connection, old, -1)
+    _update_archive(connection, new, 1)
+
+
+class SearchDocument(db.Model):
+    """全文搜索中的文档，每篇文章一行
+
+    Attributes:
+        post_id:文章的id，主键
+        length:标题和正文的词数，用于 BM25 的长度归一化
+    """
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    length = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SearchPosting(db.Model):
+    """全文搜索的倒排索引，每个词在每篇文章中一行
+
+    由 bluelog.search 在文章写入的同一个事务中维护。(term, weight) 索引使搜索时
+    可以按权重从高到低只读取每个词的前若干篇文章。
+
+    Attributes:
+        term:词
+        post_id:包含这个词的文章的id
+        tf:词在文章中出现的次数，标题中的词加权
+        length:文章的词数，与 SearchDocument 相同
+        weight:BM25 中与 idf 相乘的词频部分，按写入时的平均文章长度计算，flask reindex 时重新计算
+    """
+    __table_args__ = (
+        db.Index('ix_search_posting_term_weight', 'term', 'weight'),
+    )
+
+    term = db.Column(db.String(64), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True, index=True)
+    tf = db.Column(db.Integer, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    weight = db.Column(db.Float, nullable=False, default=0)
+
+
+class RelatedPost(db.Model):
+    """预先计算的相关文章
+
+    由 bluelog.related 根据文章的 TF-IDF 向量的余弦相似度生成，每篇文章保存得分最高的若干篇。
+
+    Attributes:
+        post_id:文章的id
+        related_id:相关文章的id
+        score:余弦相似度
+    """
+    __table_args__ = (
+        db.Index('ix_related_post_post_id_score', 'post_id', 'score'),
+    )
+
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True, index=True)
+    score = db.Column(db.Float, nullable=False)
+
+
+class Notification(db.Model):
+    """等待合并发送的评论提醒
+
+    摘要模式下新评论和回复只在评论的事务中插入一行，由 bluelog.notifications 按收件人合并为
+    一封摘要邮件发送，发送后删除。
+
+    Attributes:
+        id:提醒的id
+        recipient:收件人的E-mail
+        kind:'comment' 为管理员收到的新评论提醒，'reply' 为评论作者收到的回复提醒
+        post_id:评论所在文章的id
+        timestamp:提醒的时间
+        claim:正在发送这条提醒的进程写入的随机标记，等待发送时为 None
+        claimed_at:写入标记的时间，超过 BLUELOG_DIGEST_CLAIM_TIMEOUT 秒仍未发送时
+                   认为发送的进程已经退出，提醒可以被重新取走
+    """
+    __table_args__ = (
+        db.Index('ix_notification_claim_recipient_timestamp', 'claim', 'recipient', 'timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(254), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False, index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claim = db.Column(db.String(32))
+    claimed_at = db.Column(db.DateTime)
+
+
+class CommentSegment(db.Model):
+    """已经写入数据库的匿名评论缓冲区日志文件
+
+    bluelog.comment_buffer 在写入一个日志文件中的评论的同一个事务中插入一行，
+    恢复崩溃的进程留下的日志文件时，据此跳过提交后还没来得及删除的文件。
+    日志文件删除后，这一行在下一次写入的事务中删除。
+
+    Attributes:
+        id:日志文件名（不含扩展名），包括进程号和随机的 uuid
+        timestamp:写入的时间
+    """
+    id = db.Column(db.String(64), primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite 默认不检查外键，打开后 ON DELETE CASCADE 才会生效"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
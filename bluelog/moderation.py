@@ -0,0 +1,164 @@
+from collections import defaultdict
+
+from sqlalchemy import case, func
+
+from bluelog.counts import comment_filters, count_cache
+from bluelog.dependencies import comment_pages, purge_pages
+from bluelog.extensions import db
+from bluelog.models import Comment, Post
+
+# IN 列表的最大长度，SQLite 默认最多 999 个参数
+CHUNK_SIZE = 500
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def select_comments(ids=None, filter_rule='all', post_id=None, older_than=None):
+    """按条件选择评论，各条件同时满足
+
+    Args:
+        ids:评论的id列表
+        filter_rule:评论管理页面的过滤规则，'all'、'unread' 或 'admin'
+        post_id:评论所在文章的id
+        older_than:只选择这个时间（UTC）之前的评论
+    Returns:
+        Comment 的查询对象
+    Raises:
+        ValueError:过滤规则不存在，或者没有任何条件（不允许一次选择所有评论）
+    """
+    if filter_rule not in comment_filters:
+        raise ValueError('Unknown comment filter %s.' % filter_rule)
+    if ids is None and filter_rule == 'all' and post_id is None and older_than is None:
+        raise ValueError('No comments selected.')
+    query = comment_filters[filter_rule]()
+    if ids is not None:
+        query = query.filter(Comment.id.in_(ids))
+    if post_id is not None:
+        query = query.filter(Comment.post_id == post_id)
+    if older_than is not None:
+        query = query.filter(Comment.timestamp < older_than)
+    return query
+
+
+def _adjust_posts(totals, reviewed):
+    """在同一个事务中修改文章的评论计数
+
+    Args:
+        totals:文章id到评论总数增量的字典
+        reviewed:文章id到已审核评论数增量的字典
+    """
+    table = Post.__table__
+    for post_id in set(totals) | set(reviewed):
+        values = dict(comment_count=table.c.comment_count + totals.get(post_id, 0),
+                      reviewed_comment_count=table.c.reviewed_comment_count + reviewed.get(post_id, 0))
+        if not reviewed.get(post_id):  # 只修改了未审核的评论，页面没有变化
+            values['updated_at'] = table.c.updated_at
+        db.session.execute(table.update().where(table.c.id == post_id).values(**values))
+
+
+def approve_comments(**selectors):
+    """用 UPDATE 语句批量接受评论
+
+    选中的未审核评论改为已审核，在同一个事务中增加文章的已审核评论数；提交后修改计数缓存，
+    清除显示这些评论的页面。批量修改不经过 ORM 事件，这些工作在这里完成。
+
+    Args:
+        **selectors:select_comments 的参数
+    Returns:
+        接受的评论数
+    """
+    query = select_comments(**selectors).filter(Comment.reviewed == False)  # noqa: E712
+    rows = query.with_entities(Comment.id, Comment.post_id,
+                               Comment.replied_id).with_for_update().all()
+    if not rows:
+        return 0
+    approved = defaultdict(int)
+    threads = defaultdict(int)
+    for id, post_id, replied_id in rows:
+        approved[post_id] += 1
+        if replied_id is None:
+            threads[post_id] += 1
+    table = Comment.__table__
+    for chunk in _chunks(id for id, post_id, replied_id in rows):
+        db.session.execute(table.update().where(table.c.id.in_(chunk)).values(reviewed=True))
+    _adjust_posts({}, approved)
+    pages = comment_pages(set(approved), db.session.connection())
+    db.session.commit()
+
+    count_cache.adjust(('comments', 'unread'), -len(rows))
+    for post_id, count in threads.items():
+        count_cache.adjust(('threads', post_id), count)
+    purge_pages(pages)
+    return len(rows)
+
+
+def _with_replies(ids):
+    """加上评论的所有回复（包括回复的回复），与 Comment.replies 的级联删除一致"""
+    selected = set(ids)
+    frontier = selected
+    while frontier:
+        children = set()
+        for chunk in _chunks(frontier):
+            children.update(id for id, in db.session.query(Comment.id).filter(
+                Comment.replied_id.in_(chunk)))
+        frontier = children - selected
+        selected |= frontier
+    return selected
+
+
+def delete_comments(**selectors):
+    """批量删除评论和它们的所有回复
+
+    先按层查出所有回复，再清空它们的 replied_id 并用 DELETE 删除，不会触发外键的级联删除
+    （MySQL 的级联最多嵌套 15 层）；在同一个事务中减少文章的评论计数，提交后修改计数缓存并清除
+    受影响的页面。
+
+    Args:
+        **selectors:select_comments 的参数
+    Returns:
+        删除的评论数（包括回复）
+    """
+    ids = [id for id, in select_comments(**selectors).with_entities(Comment.id).with_for_update()]
+    if not ids:
+        return 0
+    ids = _with_replies(ids)
+    totals = defaultdict(int)
+    reviewed = defaultdict(int)
+    threads = defaultdict(int)
+    unread = admin = 0
+    table = Comment.__table__
+    for chunk in _chunks(ids):
+        for post_id, total, reviewed_count, root_count, admin_count in db.session.query(
+                Comment.post_id, func.count(Comment.id),
+                func.sum(case([(Comment.reviewed == True, 1)], else_=0)),  # noqa: E712
+                func.sum(case([((Comment.reviewed == True)  # noqa: E712
+                                & (Comment.replied_id == None), 1)], else_=0)),  # noqa: E711
+                func.sum(case([(Comment.from_admin == True, 1)], else_=0))  # noqa: E712
+        ).filter(Comment.id.in_(chunk)).group_by(Comment.post_id):
+            reviewed_count, root_count, admin_count = (int(count or 0) for count in (
+                reviewed_count, root_count, admin_count))  # MySQL 的 SUM 返回 Decimal
+            totals[post_id] -= total
+            reviewed[post_id] -= reviewed_count
+            threads[post_id] -= root_count
+            unread += total - reviewed_count
+            admin += admin_count
+    for chunk in _chunks(ids):
+        db.session.execute(table.update().where(table.c.id.in_(chunk)).values(replied_id=None))
+    for chunk in _chunks(ids):
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+    _adjust_posts(totals, reviewed)
+    pages = comment_pages({post_id for post_id, count in reviewed.items() if count},
+                          db.session.connection())
+    db.session.commit()
+
+    count_cache.adjust(('comments', 'all'), -len(ids))
+    count_cache.adjust(('comments', 'unread'), -unread)
+    count_cache.adjust(('comments', 'admin'), -admin)
+    for post_id, count in threads.items():
+        count_cache.adjust(('threads', post_id), count)
+    purge_pages(pages)
+    return len(ids)
@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app, request, url_for
+from markupsafe import escape
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from bluelog.emails import new_comment_email, new_reply_email, send_mail
+from bluelog.extensions import db
+from bluelog.models import Notification, Post
+
+# 摘要邮件中每种提醒的标题和正文中的说明
+_kinds = {
+    'comment': ('%d new comments', 'New comments'),
+    'reply': ('%d new replies', 'New replies to your comments'),
+}
+
+
+def send_digests(window):
+    """把等待时间超过 window 秒的提醒按收件人合并为摘要邮件发送
+
+    先用一次 UPDATE 给到期收件人的提醒写入本次发送的随机标记和时间并提交，多个进程同时发送时
+    每条提醒只会被一个进程取到；被取走超过 BLUELOG_DIGEST_CLAIM_TIMEOUT 秒的提醒属于已经
+    退出的进程，可以重新取走。邮件放入发送队列后删除这些提醒，发送队列已满被丢弃的摘要的提醒
+    清除标记，下次重新发送。邮件中的链接是绝对地址，需要在请求上下文中调用。
+
+    Args:
+        window:收件人最早的一条提醒等待超过这个秒数时发送，为 0 时发送所有提醒
+    Returns:
+        放入发送队列的摘要邮件数量
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=window)
+    table = Notification.__table__
+    claimable = (table.c.claim == None) | (table.c.claimed_at <= now - timedelta(  # noqa: E711
+        seconds=current_app.config['BLUELOG_DIGEST_CLAIM_TIMEOUT']))
+    due = db.session.query(Notification.recipient).filter(claimable).group_by(
+        Notification.recipient).having(func.min(Notification.timestamp) <= cutoff)
+    recipients = [recipient for recipient, in due]
+    if not recipients:
+        return 0
+
+    claim = uuid.uuid4().hex
+    db.session.execute(table.update().where(
+        claimable & table.c.recipient.in_(recipients)
+    ).values(claim=claim, claimed_at=now))
+    db.session.commit()
+
+    rows = db.session.query(
+        Notification.recipient, Notification.kind, Notification.post_id, func.count(Notification.id)
+    ).filter(Notification.claim == claim).group_by(
+        Notification.recipient, Notification.kind, Notification.post_id
+    ).all()
+    titles = dict(db.session.query(Post.id, Post.title).filter(
+        Post.id.in_({row.post_id for row in rows})))
+    digests = defaultdict(lambda: defaultdict(list))
+    for recipient, kind, post_id, count in rows:
+        if post_id in titles:  # 跳过已经删除的文章
+            digests[recipient][kind].append((post_id, count))
+    dropped = []
+    for recipient, kinds in digests.items():
+        subject = ', '.join(_kinds[kind][0] % sum(count for post_id, count in kinds[kind])
+                            for kind in _kinds if kind in kinds)
+        if not send_mail(subject=subject, to=recipient, html=_digest_html(kinds, titles)):
+            dropped.append(recipient)
+    if dropped:
+        db.session.execute(table.update().where(
+            (table.c.claim == claim) & table.c.recipient.in_(dropped)
+        ).values(claim=None, claimed_at=None))
+    db.session.execute(table.delete().where(table.c.claim == claim))
+    db.session.commit()
+    return len(digests) - len(dropped)
+
+
+def _digest_html(kinds, titles):
+    """摘要邮件的正文，列出每篇文章的新评论数量和链接"""
+    parts = []
+    for kind, (subject, label) in _kinds.items():
+        posts = kinds.get(kind)
+        if not posts:
+            continue
+        parts.append('<p>%s:</p><ul>' % label)
+        for post_id, count in sorted(posts, key=lambda item: -item[1]):
+            post_url = url_for('blog.show_post', post_id=post_id, _external=True) + '#comments'
+            parts.append('<li><a href="%s">%s</a> (%d)</li>' % (post_url, escape(titles[post_id]),
+                                                                 count))
+        parts.append('</ul>')
+    parts.append('<p><small style="color: #868e96">Do not reply this email.</small></p>')
+    return ''.join(parts)
+
+
+class Notifier(object):
+    """新评论和回复的提醒
+
+    BLUELOG_NOTIFY_MODE 为 'immediate' 时每条评论发送一封邮件，邮件在评论的事务提交成功后
+    才放入发送队列，回滚时丢弃；为 'digest' 时只在评论的事务中记录一行 Notification，每个收件人最早的提醒等待 BLUELOG_DIGEST_WINDOW 秒后，
+    把这段时间内的提醒合并为一封按文章统计数量的摘要邮件。BLUELOG_DIGEST_AUTO_SEND 为 True 时
+    由 web 进程中的后台线程定期发送，否则需要定时运行 flask digest。
+    """
+
+    def __init__(self, app=None):
+        self.mode = 'immediate'
+        self.window = 600
+        self.auto_send = True
+        self._app = None
+        self._base_url = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.mode = app.config['BLUELOG_NOTIFY_MODE']
+        self.window = app.config['BLUELOG_DIGEST_WINDOW']
+        self.auto_send = app.config['BLUELOG_DIGEST_AUTO_SEND']
+        self._app = app
+        app.extensions['notifier'] = self
+
+    def new_comment(self, post):
+        """提醒管理员文章有新评论，需要在提交评论之前调用"""
+        if self.mode != 'digest':
+            _send_after_commit(new_comment_email(post))
+            return
+        self._record('comment', current_app.config['BLUELOG_EMAIL'], post.id)
+
+    def new_reply(self, comment):
+        """提醒评论作者收到了回复，需要在提交回复之前调用"""
+        if self.mode != 'digest':
+            _send_after_commit(new_reply_email(comment))
+            return
+        self._record('reply', comment.email, comment.post_id)
+
+    def _record(self, kind, recipient, post_id):
+        if not recipient:
+            return
+        db.session.add(Notification(kind=kind, recipient=recipient, post_id=post_id))
+        if self.auto_send:
+            self._base_url = request.host_url  # 后台线程用它生成邮件中的链接
+            self._start()
+
+    def _start(self):
+        """第一次记录提醒时启动发送摘要的后台线程，fork 出的子进程重新启动"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        thr = threading.Thread(target=self._run, name='digest-sender')
+        thr.daemon = True
+        thr.start()
+
+    def _run(self):
+        interval = max(min(self.window, 60), 1)
+        while True:
+            time.sleep(interval)
+            with self._app.test_request_context(base_url=self._base_url):
+                try:
+                    send_digests(self.window)
+                except Exception:
+                    db.session.rollback()
+                    self._app.logger.exception('Failed to send comment digests.')
+                finally:
+                    db.session.remove()
+
+
+notifier = Notifier()
+
+
+def _send_after_commit(mail):
+    """提交成功后发送邮件，邮件内容现在生成，提交后对象已经过期"""
+    db.session.info.setdefault('bluelog_mails', []).append(mail)
+
+
+@event.listens_for(Session, 'after_commit')
+def _send_mails(session):
+    """事务提交后发送即时模式的提醒邮件"""
+    for mail in session.info.pop('bluelog_mails', ()):
+        send_mail(**mail)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_mails(session):
+    """事务回滚后丢弃提醒邮件，评论没有保存"""
+    session.info.pop('bluelog_mails', None)
+
+
+@event.listens_for(Post, 'before_delete')
+def _post_deleted(mapper, connection, target):
+    """删除文章前删除它的待发送提醒"""
+    table = Notification.__table__
+    connection.execute(table.delete().where(table.c.post_id == target.id))
@@ -0,0 +1,373 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import parse_qs
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from werkzeug.utils import import_string
+
+from bluelog.utils import current_theme
+
+
+def split_key(key):
+    """从缓存键中取出路径和页码
+
+    Returns:
+        (path, page) 元组；没有 page 参数时页码为 1，游标分页的页面页码为 None
+    """
+    path, _, rest = key.partition('?')
+    args = parse_qs(rest.rpartition('|')[0])
+    if 'after' in args or 'before' in args:
+        return path, None
+    page = args.get('page', ['1'])[-1]
+    return path, int(page) if page.isdigit() else None
+
+
+def _matches(page, pages):
+    """缓存的页面是否在要清除的页码中；pages 为 None 或页码未知时都清除"""
+    return pages is None or page is None or page in pages
+
+
+class MemoryBackend(object):
+    """进程内的 LRU 页面缓存后端
+
+    Attributes:
+        max_entries: 最多缓存的页面数量，超出后淘汰最久未使用的页面
+    """
+
+    def __init__(self, app):
+        self.max_entries = app.config['BLUELOG_PAGE_CACHE_MAX_ENTRIES']
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def purge(self, path, pages=None):
+        with self._lock:
+            for key in list(self._entries):
+                key_path, page = split_key(key)
+                if key_path == path and _matches(page, pages):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileSystemBackend(object):
+    """文件系统页面缓存后端
+
+    每个页面保存为一个文件，同一台主机上的多个 worker 进程可以共享缓存。
+    文件名以路径的哈希和页码开头，清除某个路径的页面时不需要读取文件内容。
+    写入时只维护一个文件数的计数，计数超过上限时才扫描目录，删除最早写入的文件直到比上限少
+    slack 个，之后至少再写入 slack 个文件才会再次扫描，每次写入的平均开销是常数；其他进程的写入
+    不在计数中，所以每写入 max_entries 个文件也扫描一次。
+
+    Attributes:
+        cache_dir: 缓存文件所在的目录
+        max_entries: 最多缓存的页面数量，超出后删除最早写入的文件
+        slack: 超出上限时多删除的文件数，为 max_entries 的十分之一
+    """
+    suffix = '.cache'
+
+    def __init__(self, app):
+        self.cache_dir = app.config['BLUELOG_PAGE_CACHE_DIR']
+        self.max_entries = app.config['BLUELOG_PAGE_CACHE_MAX_ENTRIES']
+        self.slack = max(self.max_entries // 10, 1)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = len(self._files())  # 目录中文件数的估计
+        self._writes = 0  # 上次扫描目录之后写入的文件数
+
+    @staticmethod
+    def _prefix(path):
+        return hashlib.sha1(path.encode('utf-8')).hexdigest()[:16] + '-'
+
+    def _path(self, key):
+        path, page = split_key(key)
+        name = '%s%s-%s' % (self._prefix(path), page or 0,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+        return os.path.join(self.cache_dir, name + self.suffix)
+
+    def _files(self):
+        return [os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith(self.suffix)]
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+
+    def set(self, key, entry):
+        path = self._path(key)
+        added = not os.path.exists(path)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)  # 原子替换，其他进程不会读到写了一半的文件
+        with self._lock:
+            self._size += added
+            self._writes += 1
+            due = self._size > self.max_entries or self._writes >= self.max_entries
+            if due:
+                self._writes = 0
+        if due:
+            self._prune()
+
+    def _prune(self):
+        """扫描目录，文件超过上限时删除最早写入的文件，直到比上限少 slack 个"""
+        files = self._files()
+        removed = 0
+        if len(files) > self.max_entries:
+            mtimes = {}
+            for path in files:
+                try:
+                    mtimes[path] = os.path.getmtime(path)
+                except OSError:  # 已经被其他进程删除
+                    mtimes[path] = 0
+            files.sort(key=mtimes.get)
+            for path in files[:len(files) - self.max_entries + self.slack]:
+                removed += self._remove(path)
+        with self._lock:
+            self._size = len(files) - removed
+
+    def purge(self, path, pages=None):
+        prefix = self._prefix(path)
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith(prefix) or not name.endswith(self.suffix):
+                continue
+            page = int(name[len(prefix):].split('-', 1)[0]) or None
+            if _matches(page, pages):
+                removed += self._remove(os.path.join(self.cache_dir, name))
+        with self._lock:
+            self._size = max(self._size - removed, 0)
+
+    def clear(self):
+        for path in self._files():
+            self._remove(path)
+        with self._lock:
+            self._size = 0
+
+    @staticmethod
+    def _remove(path):
+        """删除文件，返回是否删除了"""
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+
+backends = {
+    'memory': MemoryBackend,
+    'filesystem': FileSystemBackend,
+}
+
+
+class PageCache(object):
+    """匿名用户 GET 请求的整页缓存
+
+    缓存键由路径、查询字符串和主题 cookie 组成。页面过期后的 BLUELOG_PAGE_CACHE_STALE 秒内，
+    先返回旧页面，同时在后台线程中重新渲染（stale-while-revalidate）。
+    数据提交修改后由 dependencies 模块计算受影响的页面，只清除这些页面。
+
+    Attributes:
+        backend: 缓存后端，未启用时为 None
+        stats: 命中、未命中、过期命中等计数
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.timeout = 60
+        self.stale = 300
+        self.stats = dict(hits=0, misses=0, stale_hits=0, refreshes=0, purges=0, page_purges=0)
+        self._generation = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """根据配置创建缓存后端
+
+        BLUELOG_PAGE_CACHE_BACKEND 可以是 'memory'、'filesystem'、后端类或类的导入路径，为 None 时不启用。
+        """
+        backend = app.config['BLUELOG_PAGE_CACHE_BACKEND']
+        self.timeout = app.config['BLUELOG_PAGE_CACHE_TIMEOUT']
+        self.stale = app.config['BLUELOG_PAGE_CACHE_STALE']
+        if backend is not None:
+            if isinstance(backend, str):
+                backend = backends.get(backend) or import_string(backend)
+            self.backend = backend(app)
+        app.extensions['page_cache'] = self
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def clear(self):
+        """清空所有缓存的页面"""
+        if self.backend is None:
+            return
+        with self._lock:
+            self._generation += 1
+            self.stats['purges'] += 1
+        self.backend.clear()
+
+    def purge(self, pages):
+        """清除受影响的页面
+
+        后端没有实现 purge 方法（自定义后端）或影响所有页面时清空整个缓存。
+
+        Args:
+            pages: dependencies.AffectedPages 对象
+        """
+        if self.backend is None:
+            return
+        purge = getattr(self.backend, 'purge', None)
+        if pages.everything or purge is None:
+            self.clear()
+            return
+        with self._lock:
+            self._generation += 1
+            self.stats['page_purges'] += 1
+        for path, numbers in pages.paths.items():
+            purge(path, numbers)
+
+    @staticmethod
+    def make_key():
+        """根据路径、查询字符串和主题生成缓存键"""
+        return '%s?%s|%s' % (request.path, request.query_string.decode('latin-1'),
+                             current_theme())
+
+    @staticmethod
+    def _cacheable_request():
+        """只缓存匿名用户且没有待显示闪现消息的 GET 请求"""
+        return (request.method == 'GET'
+                and not current_user.is_authenticated
+                and '_flashes' not in session)
+
+    @staticmethod
+    def _cacheable_response(response):
+        """只缓存没有设置 cookie 的 200 响应（例如生成了 CSRF 令牌的页面不能共享）"""
+        return (response.status_code == 200
+                and not response.direct_passthrough
+                and 'Set-Cookie' not in response.headers
+                and not session.modified)
+
+    def _store(self, key, response, generation):
+        """保存响应；渲染期间缓存被清空时放弃保存
+
+        启用了响应压缩时同时保存 gzip 压缩的页面，命中时不需要再压缩。
+
+        Returns:
+            缓存的数据
+        """
+        body = response.get_data()
+        entry = dict(created=time.time(),
+                     status=response.status_code,
+                     headers=[(k, v) for k, v in response.headers if k != 'Set-Cookie'],
+                     body=body)
+        compress = current_app.extensions.get('compress')
+        if compress is not None and compress.compressible(response.status_code,
+                                                          response.headers, len(body)):
+            entry['gzip'] = compress.compress(body, 'gzip')
+        if generation == self._generation:
+            self.backend.set(key, entry)
+        return entry
+
+    @staticmethod
+    def _make_response(entry, state):
+        gzipped = entry.get('gzip')
+        if gzipped is not None and request.accept_encodings['gzip']:
+            response = current_app.response_class(gzipped, status=entry['status'],
+                                                  headers=entry['headers'])
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = current_app.response_class(entry['body'], status=entry['status'],
+                                                  headers=entry['headers'])
+        if gzipped is not None:
+            response.vary.add('Accept-Encoding')
+        response.headers['X-Page-Cache'] = state
+        return response
+
+    def _schedule_refresh(self, key):
+        """在后台线程中重新渲染页面，同一个键同时只刷新一次"""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        app = current_app._get_current_object()
+        args = dict(path=request.path,
+                    query_string=request.query_string,
+                    base_url=request.host_url,
+                    headers={'Cookie': 'theme=%s' % request.cookies.get('theme', '')})
+        thr = threading.Thread(target=self._refresh, args=[app, key, args])
+        thr.daemon = True
+        thr.start()
+
+    def _refresh(self, app, key, args):
+        try:
+            with app.test_request_context(**args):
+                g.page_cache_refresh = True
+                app.full_dispatch_request()
+            self._count('refreshes')
+        except Exception:
+            app.logger.exception('Failed to refresh cached page %s', key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def cached(self, f):
+        """缓存视图函数的装饰器"""
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if self.backend is None or not self._cacheable_request():
+                return f(*args, **kwargs)
+            key = self.make_key()
+            if not g.get('page_cache_refresh'):
+                entry = self.backend.get(key)
+                if entry is not None:
+                    age = time.time() - entry['created']
+                    if age < self.timeout:
+                        self._count('hits')
+                        return self._make_response(entry, 'HIT')
+                    if age < self.timeout + self.stale:
+                        self._count('stale_hits')
+                        self._schedule_refresh(key)
+                        return self._make_response(entry, 'STALE')
+                self._count('misses')
+            generation = self._generation
+            response = make_response(f(*args, **kwargs))
+            if self._cacheable_response(response):
+                entry = self._store(key, response, generation)
+                if 'gzip' in entry:  # 直接使用保存的压缩页面，中间件不会再压缩一次
+                    return self._make_response(entry, 'MISS')
+            response.headers['X-Page-Cache'] = 'MISS'
+            return response
+        return decorated
+
+
+page_cache = PageCache()
@@ -0,0 +1,200 @@
+import base64
+import binascii
+from datetime import datetime
+
+from flask import abort, current_app, request, url_for
+from flask_sqlalchemy import Pagination
+from sqlalchemy import and_, or_
+
+_timestamp_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(timestamp, id):
+    """把 (timestamp, id) 编码为不透明的游标字符串"""
+    raw = '%s|%d' % (timestamp.strftime(_timestamp_format), id)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解码游标字符串
+
+    Args:
+        cursor:encode_cursor 生成的游标
+    Returns:
+        (timestamp, id) 元组
+    Raises:
+        ValueError:游标格式不正确
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, _timestamp_format), int(id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+
+
+class KeysetPagination(object):
+    """基于 (timestamp, id) 的游标分页
+
+    用 WHERE 条件定位到游标的位置，代替 OFFSET，翻到很深的页也只需要一次索引范围扫描；
+    只有在 with_total 为 True 时才执行 COUNT 查询。
+
+    Attributes:
+        items:当前页的对象
+        per_page:每页数量
+        has_next:是否有下一页（更旧的方向）
+        has_prev:是否有上一页（更新的方向）
+        next_cursor:下一页的游标
+        prev_cursor:上一页的游标
+        total:总数，未要求统计时为 None
+    """
+
+    def __init__(self, query, model, per_page, after=None, before=None,
+                 descending=True, with_total=False, total=None):
+        """执行分页查询
+
+        Args:
+            query:未排序的查询对象
+            model:带有 timestamp 和 id 列的模型类
+            per_page:每页数量
+            after:从这个游标之后开始取（下一页）
+            before:取这个游标之前的部分（上一页）
+            descending:是否按时间倒序排列
+            with_total:是否需要总数
+            total:返回总数的函数，为 None 时执行 COUNT 查询
+        """
+        self.per_page = per_page
+        self.total = None
+        if with_total:
+            self.total = total() if total is not None else query.order_by(None).count()
+        backwards = before is not None
+        cursor = before if backwards else after
+
+        timestamp_col, id_col = model.timestamp, model.id
+        # 向“更大”的方向读取：倒序时的上一页，或正序时的下一页
+        forward = descending == backwards
+        if cursor is not None:
+            timestamp, id = cursor
+            if forward:
+                query = query.filter(or_(timestamp_col > timestamp,
+                                         and_(timestamp_col == timestamp, id_col > id)))
+            else:
+                query = query.filter(or_(timestamp_col < timestamp,
+                                         and_(timestamp_col == timestamp, id_col < id)))
+        if forward:
+            query = query.order_by(None).order_by(timestamp_col.asc(), id_col.asc())
+        else:
+            query = query.order_by(None).order_by(timestamp_col.desc(), id_col.desc())
+
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+            self.has_prev = more
+            self.has_next = True
+        else:
+            self.has_prev = cursor is not None
+            self.has_next = more
+        self.items = items
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(self.items[-1].timestamp, self.items[-1].id)
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor(self.items[0].timestamp, self.items[0].id)
+
+    def _url(self, **cursor):
+        args = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('before', None)
+        args.update(request.view_args or {})
+        args.update(cursor)
+        return url_for(request.endpoint, **args)
+
+    def next_url(self):
+        """下一页的链接，保留当前请求的其他查询参数"""
+        cursor = self.next_cursor
+        return self._url(after=cursor) if cursor else None
+
+    def prev_url(self):
+        """上一页的链接，保留当前请求的其他查询参数"""
+        cursor = self.prev_cursor
+        return self._url(before=cursor) if cursor else None
+
+
+def get_cursors():
+    """从查询字符串读取 after/before 游标
+
+    Returns:
+        (after, before) 元组，没有时为 None
+    Raises:
+        ValueError:游标格式不正确
+    """
+    after = request.args.get('after')
+    before = request.args.get('before')
+    return (decode_cursor(after) if after else None,
+            decode_cursor(before) if before else None)
+
+
+def offset_paginate(query, page, per_page, total=None):
+    """页码分页
+
+    与 Flask-SQLAlchemy 的 paginate 相同，但可以使用缓存的总数代替 COUNT 查询。
+
+    Args:
+        query:已排序的查询对象
+        page:页码
+        per_page:每页数量
+        total:总数，或返回总数的函数；为 None 时执行 COUNT 查询
+    Returns:
+        Flask-SQLAlchemy 的 Pagination 对象
+    """
+    if total is None:
+        return query.paginate(page, per_page=per_page)
+    if page < 1:
+        abort(404)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        abort(404)
+    if callable(total):
+        total = total()
+    return Pagination(query, page, per_page, total, items)
+
+
+def paginate(query, model, per_page, descending=True, total=None):
+    """按 BLUELOG_KEYSET_PAGINATION 设置选择分页方式
+
+    偏移分页使用查询字符串中的 page 参数，游标分页使用 after/before 参数；两种方式都按
+    (timestamp, id) 排序，时间相同的对象的顺序是确定的。
+
+    Args:
+        query:未排序的查询对象
+        model:带有 timestamp 和 id 列的模型类
+        per_page:每页数量
+        descending:是否按时间倒序排列
+        total:返回总数的函数，为 None 时执行 COUNT 查询；游标分页只在请求 count=1 时调用
+    Returns:
+        Flask-SQLAlchemy 的 Pagination 对象或 KeysetPagination 对象
+    """
+    if not current_app.config['BLUELOG_KEYSET_PAGINATION']:
+        page = request.args.get('page', 1, type=int)
+        if descending:
+            order = (model.timestamp.desc(), model.id.desc())
+        else:
+            order = (model.timestamp.asc(), model.id.asc())
+        return offset_paginate(query.order_by(*order), page, per_page, total)
+    try:
+        after, before = get_cursors()
+    except ValueError:
+        abort(400)
+    return KeysetPagination(query, model, per_page, after=after, before=before,
+                            descending=descending,
+                            with_total=request.args.get('count', type=int) == 1,
+                            total=total)
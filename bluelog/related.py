@@ -0,0 +1,402 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+from scipy import sparse
+from flask import current_app
+from sqlalchemy import event, func, or_, select
+from sqlalchemy.orm import defer
+
+from bluelog.dependencies import AffectedPages, purge_pages
+from bluelog.events import on_models_committed
+from bluelog.extensions import db
+from bluelog.models import Post, RelatedPost
+from bluelog.search import analyze
+
+# 词表、idf 和稀疏向量矩阵保存在一个文件中，整体原子替换
+MODEL_FILE = 'model.npz'
+# 出现在超过这个比例的文章中的词不作为特征
+MAX_DF = 0.5
+
+
+def related_posts(post_id):
+    """获取文章的相关文章，按相似度从高到低排列，只执行一次查询"""
+    return Post.query.join(RelatedPost, RelatedPost.related_id == Post.id).filter(
+        RelatedPost.post_id == post_id
+    ).order_by(RelatedPost.score.desc()).options(defer(Post.body)).all()
+
+
+def related_version(post_id):
+    """文章相关文章列表的版本标识，用于页面的 ETag
+
+    相关文章在后台线程或 flask related 中用 Core 语句改写，不会修改文章的 updated_at。
+    """
+    table = RelatedPost.__table__
+    rows = db.session.execute(select([table.c.related_id, table.c.score]).where(
+        table.c.post_id == post_id).order_by(table.c.related_id)).fetchall()
+    return hashlib.sha1(repr([tuple(row) for row in rows]).encode('utf-8')).hexdigest()
+
+
+def _read_documents(batch):
+    """按 id 分批读取并切分所有文章
+
+    Returns:
+        (ids, vocabulary, documents) 元组：文章 id 列表、词到编号的字典、
+        每篇文章的 (词编号数组, 词频数组) 列表
+    """
+    ids, documents, vocabulary = [], [], {}
+    last_id = 0
+    while True:
+        rows = db.session.query(Post.id, Post.title, Post.body).filter(
+            Post.id > last_id).order_by(Post.id).limit(batch).all()
+        if not rows:
+            break
+        for row in rows:
+            counts = analyze(row.title, row.body)[0]
+            ids.append(row.id)
+            documents.append((
+                np.fromiter((vocabulary.setdefault(term, len(vocabulary)) for term in counts),
+                            np.int64, len(counts)),
+                np.fromiter(counts.values(), np.float32, len(counts)),
+            ))
+        last_id = rows[-1].id
+    return ids, vocabulary, documents
+
+
+def _select_features(vocabulary, documents, size):
+    """选择特征词
+
+    去掉只出现在一篇文章中和出现在超过 MAX_DF 比例的文章中的词，再按总词频保留最多 size 个。
+
+    Returns:
+        (terms, df) 元组：特征词的编号数组和它们的文档频率
+    """
+    df = np.zeros(len(vocabulary), np.int64)
+    tf = np.zeros(len(vocabulary), np.float64)
+    for term_ids, counts in documents:
+        df[term_ids] += 1
+        tf[term_ids] += counts
+    terms = np.flatnonzero((df >= 2) & (df <= MAX_DF * len(documents)))
+    if len(terms) > size:
+        terms = terms[np.argsort(-tf[terms], kind='stable')[:size]]
+    return terms, df[terms]
+
+
+def _weigh(columns, counts, idf):
+    """把一篇文章的词频转换为 L2 归一化的 TF-IDF 权重，columns 为 -1 的词不是特征
+
+    Returns:
+        (columns, weights) 元组：特征的列号和权重
+    """
+    mask = columns >= 0
+    columns = columns[mask]
+    weights = ((1 + np.log(counts[mask])) * idf[columns]).astype(np.float32)
+    norm = np.linalg.norm(weights)
+    if norm:
+        weights /= norm
+    return columns, weights
+
+
+def _vectorize(documents, columns, idf):
+    """把所有文章转换为 CSR 格式的稀疏 TF-IDF 矩阵，只保存非零的权重
+
+    Args:
+        documents:每篇文章的 (词编号数组, 词频数组) 列表
+        columns:词编号到特征列号的数组，不是特征的词为 -1
+        idf:每个特征的 idf
+    """
+    indptr = np.zeros(len(documents) + 1, np.int64)
+    indices, data = [], []
+    for i, (term_ids, counts) in enumerate(documents):
+        row_columns, weights = _weigh(columns[term_ids], counts, idf)
+        indices.append(row_columns)
+        data.append(weights)
+        indptr[i + 1] = indptr[i] + len(row_columns)
+    indices = np.concatenate(indices) if indices else np.zeros(0, np.int64)
+    data = np.concatenate(data) if data else np.zeros(0, np.float32)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(documents), len(idf)))
+
+
+def _top_k(vectors, k, block):
+    """分块计算每篇文章余弦相似度最高的 k 篇文章
+
+    每次只计算 block 行与全部文章的相似度，内存占用为 block × N，不会生成 N × N 矩阵。
+
+    Args:
+        vectors:CSR 格式的 TF-IDF 矩阵
+
+    Yields:
+        (start, columns, scores) 元组：块的起始行，以及每行按相似度从高到低排列的 k 个列号和相似度
+    """
+    n = vectors.shape[0]
+    transposed = vectors.T.tocsr()
+    for start in range(0, n, block):
+        scores = (vectors[start:start + block] @ transposed).toarray()
+        rows = np.arange(len(scores))
+        scores[rows, start + rows] = -1  # 排除文章自身
+        columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top = np.take_along_axis(scores, columns, axis=1)
+        order = np.argsort(-top, axis=1, kind='stable')
+        yield (start, np.take_along_axis(columns, order, axis=1),
+               np.take_along_axis(top, order, axis=1))
+
+
+def _save_model(directory, ids, terms, idf, vectors):
+    """保存增量更新需要的词表、idf 和稀疏向量矩阵，先写临时文件再原子替换"""
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, ids=ids, terms=terms, idf=idf, indptr=vectors.indptr,
+                 indices=vectors.indices, data=vectors.data)
+    os.replace(tmp, os.path.join(directory, MODEL_FILE))
+
+
+def load_model(directory):
+    """读取 flask related 保存的模型
+
+    Returns:
+        (ids, columns, idf, vectors) 元组，columns 为词到列号的字典，vectors 为 CSR 格式的矩阵；
+        还没有生成模型时返回 None
+    """
+    try:
+        with np.load(os.path.join(directory, MODEL_FILE)) as model:
+            ids, terms, idf = model['ids'], model['terms'], model['idf']
+            vectors = sparse.csr_matrix((model['data'], model['indices'], model['indptr']),
+                                        shape=(len(ids), len(idf)))
+    except (OSError, ValueError, KeyError):
+        return None
+    columns = {term: column for column, term in enumerate(terms.tolist())}
+    return ids, columns, idf, vectors
+
+
+def rebuild(top, features, block, min_score, batch=1000):
+    """重新计算所有文章的相关文章
+
+    每计算完一块就在一个事务中删除并写入这些文章的相关文章，其他文章仍然显示原来的相关文章，
+    中途失败时已经处理的文章使用新结果，其余的保持不变。
+
+    Args:
+        top:每篇文章保存的相关文章数
+        features:特征词的最大数量
+        block:每次计算相似度的行数
+        min_score:低于这个相似度的文章不保存
+        batch:读取文章时每批的数量
+    Returns:
+        生成器，每计算完一块产生一次已处理的文章数
+    """
+    ids, vocabulary, documents = _read_documents(batch)
+    n = len(ids)
+    terms, df = _select_features(vocabulary, documents, features)
+    idf = (np.log((1.0 + n) / (1.0 + df)) + 1).astype(np.float32)
+    columns = np.full(len(vocabulary), -1, np.int64)
+    columns[terms] = np.arange(len(terms))
+    vectors = _vectorize(documents, columns, idf)
+    del documents
+
+    words = {index: term for term, index in vocabulary.items()}
+    ids = np.asarray(ids, np.int64)
+    _save_model(current_app.config['BLUELOG_RELATED_DIR'], ids,
+                np.array([words[index] for index in terms.tolist()], dtype=str), idf, vectors)
+
+    table = RelatedPost.__table__
+    k = min(top, n - 1)
+    if k < 1:
+        db.session.execute(table.delete())
+        db.session.commit()
+        return
+    for start, neighbours, scores in _top_k(vectors, k, block):
+        rows = [dict(post_id=int(ids[start + i]), related_id=int(ids[j]), score=float(score))
+                for i in range(len(neighbours))
+                for j, score in zip(neighbours[i], scores[i]) if score >= min_score]
+        # 文章按 id 排列，在一个事务中替换这一块文章的相关文章
+        db.session.execute(table.delete().where(table.c.post_id.between(
+            int(ids[start]), int(ids[start + len(neighbours) - 1]))))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+        yield start + len(neighbours)
+
+
+def update_post(post_id):
+    """用已保存的模型更新一篇文章的相关文章
+
+    计算这篇文章与模型中所有文章的相似度，替换它自己的相关文章，并把它加入相似度超过
+    其他文章现有最低分的相关列表，提交后清除相关列表改变了的文章页面。
+    flask related 之后新建的文章之间不会互相比较，需要定期重建。
+
+    Args:
+        post_id:新建或修改的文章的id
+    """
+    config = current_app.config
+    model = load_model(config['BLUELOG_RELATED_DIR'])
+    if model is None:
+        return
+    ids, columns, idf, vectors = model
+    top, min_score = config['BLUELOG_RELATED_POSTS'], config['BLUELOG_RELATED_MIN_SCORE']
+
+    table = RelatedPost.__table__
+    # 相关列表改变了的文章，提交后清除它们的页面
+    changed = {post_id}
+    changed.update(id for id, in db.session.execute(select([table.c.post_id]).where(
+        table.c.related_id == post_id)))
+    db.session.execute(table.delete().where(
+        or_(table.c.post_id == post_id, table.c.related_id == post_id)))
+    row = db.session.query(Post.title, Post.body).filter_by(id=post_id).first()
+    if row is None or not len(ids):
+        _commit(changed)
+        return
+
+    counts = analyze(row.title, row.body)[0]
+    known = [(columns[term], count) for term, count in counts.items() if term in columns]
+    vector = np.zeros(len(idf), np.float32)
+    if known:
+        known_columns, weights = _weigh(np.array([column for column, count in known], np.int64),
+                                        np.array([count for column, count in known], np.float32),
+                                        idf)
+        vector[known_columns] = weights
+    scores = vectors @ vector
+    scores[ids == post_id] = -1
+    # 多取一些候选，其中也包括可能需要加入这篇文章的其他文章
+    candidates = np.argsort(-scores, kind='stable')[:top * 10]
+    candidates = {int(ids[i]): float(scores[i]) for i in candidates if scores[i] >= min_score}
+    if candidates:
+        existing = {id for id, in db.session.query(Post.id).filter(Post.id.in_(candidates))}
+        candidates = {id: score for id, score in candidates.items() if id in existing}
+
+    ranked = sorted(candidates.items(), key=lambda item: -item[1])
+    rows = [dict(post_id=post_id, related_id=id, score=score) for id, score in ranked[:top]]
+    lists = {}
+    if candidates:
+        lists = {id: (count, lowest) for id, count, lowest in db.session.query(
+            RelatedPost.post_id, func.count(RelatedPost.related_id), func.min(RelatedPost.score)
+        ).filter(RelatedPost.post_id.in_(candidates)).group_by(RelatedPost.post_id)}
+    for id, score in ranked:
+        count, lowest = lists.get(id, (0, None))
+        if count >= top:
+            if score <= lowest:
+                continue
+            db.session.execute(table.delete().where(
+                (table.c.post_id == id) & (table.c.score == lowest)))
+        rows.append(dict(post_id=id, related_id=post_id, score=score))
+        changed.add(id)
+    if rows:
+        db.session.execute(table.insert(), rows)
+    _commit(changed)
+
+
+def _commit(post_ids):
+    """提交相关文章的修改，清除相关列表改变了的文章页面
+
+    Core 语句不产生模型写入记录，页面依赖的跟踪不会处理它们。
+    """
+    db.session.commit()
+    pages = AffectedPages()
+    for post_id in post_ids:
+        pages.add('/post/%d' % post_id)
+    purge_pages(pages)
+
+
+class RelatedUpdater(object):
+    """在一个后台线程中增量更新相关文章
+
+    保存文章后把文章 id 放入待更新集合，由一个 worker 线程依次调用 update_post，
+    同一篇文章在更新前多次保存只更新一次。待更新的文章超过 BLUELOG_RELATED_QUEUE_SIZE 篇时
+    丢弃新的文章并记录日志，批量修改或导入文章时不会无限制地积压，之后运行 flask related 更新。
+    BLUELOG_RELATED_AUTO_UPDATE 为 False 时不更新。
+
+    Attributes:
+        stats: queued 加入的文章数、updated 更新的文章数、failed 失败数、dropped 丢弃的文章数
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.queue_size = 1000
+        self.stats = dict(queued=0, updated=0, failed=0, dropped=0)
+        self._app = None
+        self._pending = {}  # 待更新的文章 id，按加入的顺序保存
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['BLUELOG_RELATED_AUTO_UPDATE']
+        self.queue_size = app.config['BLUELOG_RELATED_QUEUE_SIZE']
+        self._app = app
+        app.extensions['related_updater'] = self
+
+    def add(self, post_ids):
+        """把文章放入待更新集合，第一次调用时启动 worker 线程，fork 出的子进程重新启动
+
+        Args:
+            post_ids:新建或修改的文章的id列表
+        """
+        if not self.enabled:
+            return
+        dropped = []
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending = {}
+                thr = threading.Thread(target=self._run, name='related-updater')
+                thr.daemon = True
+                thr.start()
+            for post_id in post_ids:
+                if post_id in self._pending:
+                    continue
+                if len(self._pending) >= self.queue_size:
+                    dropped.append(post_id)
+                    continue
+                self._pending[post_id] = None
+                self.stats['queued'] += 1
+            self.stats['dropped'] += len(dropped)
+            self._wakeup.notify()
+        if dropped:
+            self._app.logger.warning('Related post queue is full, dropped posts %s; '
+                                     'run flask related to update them.', dropped)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+                post_id = next(iter(self._pending))
+                del self._pending[post_id]
+            with self._app.app_context():
+                try:
+                    update_post(post_id)
+                except Exception:
+                    db.session.rollback()
+                    self._count('failed')
+                    self._app.logger.exception('Failed to update related posts of %d', post_id)
+                else:
+                    self._count('updated')
+                finally:
+                    db.session.remove()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+related_updater = RelatedUpdater()
+
+
+@on_models_committed(Post)
+def _schedule_update(changes):
+    """文章新建或修改标题、正文后，交给 related_updater 在后台更新相关文章"""
+    post_ids = [change.id for change in changes if change.operation != 'delete'
+                and (change.changed('title') or change.changed('body'))]
+    if post_ids:
+        related_updater.add(post_ids)
+
+
+@event.listens_for(Post, 'before_delete')
+def _post_deleted(mapper, connection, target):
+    """删除文章前删除引用它的相关文章记录"""
+    table = RelatedPost.__table__
+    connection.execute(table.delete().where(
+        or_(table.c.post_id == target.id, table.c.related_id == target.id)))
@@ -0,0 +1,262 @@
+import math
+import re
+from collections import Counter
+
+from flask import abort, current_app
+from flask_sqlalchemy import Pagination
+from markupsafe import Markup
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import defer, joinedload, object_session
+
+from bluelog.counts import count_cache
+from bluelog.events import ModelChange, on_models_committed, record_changes
+from bluelog.extensions import db
+from bluelog.models import Post, SearchDocument, SearchPosting
+
+# 字母和数字按单词切分，连续的汉字按相邻两个字切分
+_token_re = re.compile(r'[\u4e00-\u9fff]+|[a-z0-9]+')
+# BM25 参数
+K1 = 1.2
+B = 0.75
+# 标题中的词按出现 TITLE_WEIGHT 次计算
+TITLE_WEIGHT = 3
+MAX_TERM_LENGTH = 64
+# 搜索时最多使用的词数
+MAX_QUERY_TERMS = 16
+
+
+def tokenize(text):
+    """把纯文本切分为词
+
+    英文转为小写，单个汉字作为一个词，两个以上的汉字切分为相邻两个字组成的词。
+
+    Args:
+        text:纯文本
+    Returns:
+        词的列表
+    """
+    tokens = []
+    for match in _token_re.findall(text.lower()):
+        if '\u4e00' <= match[0] <= '\u9fff' and len(match) > 1:
+            tokens.extend(match[i:i + 2] for i in range(len(match) - 1))
+        else:
+            tokens.append(match[:MAX_TERM_LENGTH])
+    return tokens
+
+
+def analyze(title, body):
+    """计算文章的词频和长度
+
+    Args:
+        title:文章标题
+        body:HTML 正文，去掉标签后切分
+    Returns:
+        (词频 Counter, 文章的词数) 元组
+    """
+    terms = Counter(tokenize(Markup(body or '').striptags()))
+    for term in tokenize(title or ''):
+        terms[term] += TITLE_WEIGHT
+    return terms, sum(terms.values())
+
+
+def _weight(tf, length, average_length):
+    """BM25 中与 idf 相乘的词频部分"""
+    return tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / average_length))
+
+
+def _index_rows(post_id, title, body, average_length=None):
+    terms, length = analyze(title, body)
+    document = dict(post_id=post_id, length=length)
+    # 索引为空时没有平均长度，用文章自身的长度，避免第一篇文章的权重被长度归一化压低
+    average_length = average_length or length or 1
+    postings = [dict(term=term, post_id=post_id, tf=tf, length=length,
+                     weight=_weight(tf, length, average_length))
+                for term, tf in terms.items()]
+    return document, postings
+
+
+def _remove_post(connection, post_id):
+    """删除文章的索引
+
+    Returns:
+        (terms, length) 元组：索引中保存的词的集合和文章长度，没有索引时长度为 None
+    """
+    postings, documents = SearchPosting.__table__, SearchDocument.__table__
+    terms = {term for term, in connection.execute(select([postings.c.term]).where(
+        postings.c.post_id == post_id))}
+    length = connection.execute(select([documents.c.length]).where(
+        documents.c.post_id == post_id)).scalar()
+    for table in (postings, documents):
+        connection.execute(table.delete().where(table.c.post_id == post_id))
+    return terms, length
+
+
+def _index_post(connection, post, operation):
+    old_terms, old_length = _remove_post(connection, post.id)
+    document, postings = _index_rows(post.id, post.title, post.body, _stats(connection)[1])
+    connection.execute(SearchDocument.__table__.insert(), document)
+    if postings:
+        connection.execute(SearchPosting.__table__.insert(), postings)
+    _record(post, operation, document, old_length,
+            old_terms | {posting['term'] for posting in postings})
+
+
+def _record(post, operation, document, old_length, terms):
+    """记录绕过 ORM 的索引写入，提交后由 _invalidate_stats 重新统计
+
+    Args:
+        post:文章对象
+        operation:'insert'、'update' 或 'delete'
+        document:SearchDocument 行的值
+        old_length:写入前保存的文章长度
+        terms:写入前后索引中的词，它们的文档频率可能改变
+    """
+    change = ModelChange(SearchDocument, post.id, operation, document,
+                         dict(length=old_length) if operation == 'update' else None)
+    change.info['terms'] = terms
+    record_changes(object_session(post), [change])
+
+
+@event.listens_for(Post, 'after_insert')
+def _post_inserted(mapper, connection, target):
+    """新文章写入后建立索引"""
+    _index_post(connection, target, 'insert')
+
+
+@event.listens_for(Post, 'after_update')
+def _post_updated(mapper, connection, target):
+    """标题或正文修改后重建这篇文章的索引"""
+    state = inspect(target)
+    if state.attrs.title.history.has_changes() or state.attrs.body.history.has_changes():
+        _index_post(connection, target, 'update')
+
+
+@event.listens_for(Post, 'before_delete')
+def _post_deleted(mapper, connection, target):
+    """删除文章前删除它的索引
+
+    文章的正文在列表页面中延迟加载，删除时可能没有读取，所以使用索引中保存的词和长度。
+    """
+    terms, length = _remove_post(connection, target.id)
+    _record(target, 'delete', dict(post_id=target.id, length=length), None, terms)
+
+
+@on_models_committed(SearchDocument)
+def _invalidate_stats(changes):
+    """文章的索引改变后重新统计文章长度和索引前后各词的文档频率"""
+    keys = {('search', 'stats')}
+    for change in changes:
+        keys.update(('search', 'df', term) for term in change.info['terms'])
+    count_cache.invalidate(*keys)
+
+
+def _stats(bind):
+    """返回 (文章数, 平均文章长度)，索引为空时平均长度为 None
+
+    Args:
+        bind:执行查询的会话或连接，在 flush 中使用当前的连接
+    """
+    def load():
+        table = SearchDocument.__table__
+        documents, total_length = bind.execute(select([
+            func.count(table.c.post_id), func.coalesce(func.sum(table.c.length), 0)
+        ])).first()
+        return documents, float(total_length) / documents if total_length else None
+    return count_cache.get(('search', 'stats'), load)
+
+
+def _document_frequency(term):
+    """包含某个词的文章数
+
+    常用词的统计要扫描很多索引项，所以结果缓存在计数缓存中；文档频率的少量偏差只会轻微影响排序。
+    """
+    return count_cache.get(('search', 'df', term), lambda: db.session.query(
+        func.count(SearchPosting.post_id)).filter_by(term=term).scalar())
+
+
+def search_posts(q, page, per_page, with_body=False):
+    """按 BM25 相关度搜索文章
+
+    每个词按权重从高到低只读取前 BLUELOG_SEARCH_MAX_RESULTS 篇文章，在内存中累加得分，
+    查询的开销与文章总数无关；最多返回 BLUELOG_SEARCH_MAX_RESULTS 篇结果。
+
+    Args:
+        q:搜索字符串
+        page:页码
+        per_page:每页数量
+        with_body:是否加载文章正文，列表页面只需要摘要
+    Returns:
+        Flask-SQLAlchemy 的 Pagination 对象，items 为按相关度排序的文章
+    """
+    terms = list(dict.fromkeys(tokenize(q)))[:MAX_QUERY_TERMS]
+    frequencies = {}
+    for term in terms:
+        df = _document_frequency(term)
+        if df:
+            frequencies[term] = df
+    if not frequencies:
+        return Pagination(None, page, per_page, 0, [])
+
+    documents = max(_stats(db.session)[0], max(frequencies.values()))
+    depth = current_app.config['BLUELOG_SEARCH_MAX_RESULTS']
+    scores = {}
+    for term, df in frequencies.items():
+        idf = math.log(1 + (documents - df + 0.5) / (df + 0.5))
+        postings = db.session.query(SearchPosting.post_id, SearchPosting.weight).filter_by(
+            term=term).order_by(SearchPosting.weight.desc()).limit(depth)
+        for post_id, weight in postings:
+            scores[post_id] = scores.get(post_id, 0) + idf * weight
+    ranked = sorted(scores, key=lambda id: (-scores[id], -id))[:depth]
+
+    if page < 1 or (page - 1) * per_page >= len(ranked) and page != 1:
+        abort(404)
+    ids = ranked[(page - 1) * per_page:page * per_page]
+    query = Post.query.filter(Post.id.in_(ids)).options(joinedload(Post.category))
+    if not with_body:
+        query = query.options(defer(Post.body))
+    posts = {post.id: post for post in query}
+    return Pagination(None, page, per_page, len(ranked),
+                      [posts[id] for id in ids if id in posts])
+
+
+def reindex(batch=500):
+    """重建全部文章的索引
+
+    清空索引后按 id 分批读取文章，每批用批量 INSERT 写入并提交一次，最后按新的平均长度
+    重新计算所有权重。增量更新使用写入时的平均长度，定期重建可以修正权重的偏差。
+
+    Args:
+        batch:每批处理的文章数量
+    Returns:
+        生成器，每处理完一批产生一次已处理的文章数
+    """
+    db.session.execute(SearchPosting.__table__.delete())
+    db.session.execute(SearchDocument.__table__.delete())
+    db.session.commit()
+    last_id = 0
+    count = 0
+    while True:
+        rows = db.session.query(Post.id, Post.title, Post.body).filter(
+            Post.id > last_id).order_by(Post.id).limit(batch).all()
+        if not rows:
+            break
+        documents, postings = [], []
+        for row in rows:
+            document, post_postings = _index_rows(row.id, row.title, row.body)
+            documents.append(document)
+            postings.extend(post_postings)
+        db.session.execute(SearchDocument.__table__.insert(), documents)
+        if postings:
+            db.session.execute(SearchPosting.__table__.insert(), postings)
+        db.session.commit()
+        last_id = rows[-1].id
+        count += len(rows)
+        yield count
+
+    # 所有文章写入后才知道平均长度，最后用一条 UPDATE 计算权重
+    count_cache.invalidate(('search', 'stats'))
+    average_length = _stats(db.session)[1] or 1.0
+    table = SearchPosting.__table__
+    db.session.execute(table.update().values(weight=_weight(table.c.tf, table.c.length,
+                                                            average_length)))
+    db.session.commit()
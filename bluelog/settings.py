@@ -16,20 +16,91 @@ class BaseConfig(object):
     JWT_EXPIRE_DAYS = os.getenv('JWT_EXPIRE_DAYS', 1)  # JWT 长期 token 的过期时间，默认一天
     # SQLalchemy 相关设置项
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_RECORD_QUERIES = False
     # 邮件相关设置项
     MAIL_SERVER = os.getenv('MAIL_SERVER')
     MAIL_PORT = os.getenv('MAIL_PORT')
     MAIL_USE_SSL = os.getenv('MAIL_USE_SSL')
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
-    MAIL_DEfAULT_SENDER = ('Bluelog Admin', MAIL_USERNAME)
+    MAIL_DEFAULT_SENDER = ('Bluelog Admin', MAIL_USERNAME)
+    # 后台发送邮件的线程数（0 表示在请求中同步发送）、队列长度、队列满时的等待时间（秒）、
+    # SMTP 连接空闲多久后关闭（秒）和进程退出时等待队列发送完成的时间（秒）
+    BLUELOG_MAIL_WORKERS = 2
+    BLUELOG_MAIL_QUEUE_SIZE = 100
+    BLUELOG_MAIL_QUEUE_TIMEOUT = 0.5
+    BLUELOG_MAIL_IDLE_TIMEOUT = 30
+    BLUELOG_MAIL_SHUTDOWN_TIMEOUT = 10
+    # 评论提醒方式：'immediate' 每条评论发送一封邮件，'digest' 按收件人合并为摘要邮件；
+    # 摘要的合并时间（秒），以及是否由 web 进程的后台线程发送（否则定时运行 flask digest）；
+    # 被取走超过 BLUELOG_DIGEST_CLAIM_TIMEOUT 秒仍未发送的提醒（发送的进程已经退出）重新发送
+    BLUELOG_NOTIFY_MODE = os.getenv('BLUELOG_NOTIFY_MODE', 'immediate')
+    BLUELOG_DIGEST_WINDOW = 600
+    BLUELOG_DIGEST_AUTO_SEND = True
+    BLUELOG_DIGEST_CLAIM_TIMEOUT = 600
+    # 匿名评论的写后缓冲区：是否启用、日志文件目录、每批写入的评论数、写入间隔（秒）和
+    # 缓冲的评论上限（超过后同步写入）
+    BLUELOG_COMMENT_BUFFER = False
+    BLUELOG_COMMENT_BUFFER_DIR = os.path.join(basedir, 'cache', 'comments')
+    BLUELOG_COMMENT_BUFFER_BATCH = 100
+    BLUELOG_COMMENT_BUFFER_INTERVAL = 1.0
+    BLUELOG_COMMENT_BUFFER_MAX = 1000
 
     BLUELOG_EMAIL = os.getenv('BLUELOG_EMAIL')
     BLUELOG_POST_PER_PAGE = 10
     BLUELOG_MANAGE_POST_PER_PAGE = 15
     BLUELOG_COMMENT_PER_PAGE = 15
+    BLUELOG_SEARCH_RESULT_PER_PAGE = 10
+    BLUELOG_ARCHIVE_SIDEBAR_MONTHS = 12  # 侧边栏中显示的最近月份数
+    BLUELOG_FEED_ITEMS = 20  # 订阅源中的文章数
+    BLUELOG_SITEMAP_BATCH = 1000  # 生成站点地图时每批读取的行数
+    # 搜索时每个词最多读取的文章数，也是搜索结果的数量上限
+    BLUELOG_SEARCH_MAX_RESULTS = 1000
+    # 是否按讨论串嵌套显示评论，嵌套时每页显示 BLUELOG_COMMENT_PER_PAGE 个讨论串
+    BLUELOG_COMMENT_THREADED = False
+    # 嵌套显示时的最大缩进层级，更深的回复不再缩进
+    BLUELOG_COMMENT_MAX_LEVEL = 4
+    # 文章列表和评论管理页面使用游标分页（较新/较旧链接）代替页码分页
+    BLUELOG_KEYSET_PAGINATION = False
     # ('theme name', 'display name')
     BLUELOG_THEMES = {'perfect_blue':'Perfect Blue', 'Black_swan': 'Black Swan'}
+    # 管理员、分类、链接缓存的过期时间（秒），用于兜底其他进程中的修改
+    BLUELOG_CACHE_TTL = 300
+    # 匿名用户页面缓存：后端可选 'memory'、'filesystem' 或后端类的导入路径，None 表示不启用
+    BLUELOG_PAGE_CACHE_BACKEND = os.getenv('BLUELOG_PAGE_CACHE_BACKEND')
+    BLUELOG_PAGE_CACHE_TIMEOUT = 60  # 页面缓存的有效时间（秒）
+    BLUELOG_PAGE_CACHE_STALE = 300  # 过期后仍可返回旧页面并在后台刷新的时间（秒）
+    BLUELOG_PAGE_CACHE_MAX_ENTRIES = 1000
+    BLUELOG_PAGE_CACHE_DIR = os.path.join(basedir, 'cache', 'pages')
+    BLUELOG_COUNT_RECONCILE = 600  # 分页总数缓存重新统计的间隔（秒）
+    # 相关文章：每篇文章显示的数量和最低相似度，由 flask related 生成
+    BLUELOG_RELATED_POSTS = 5
+    BLUELOG_RELATED_MIN_SCORE = 0.05
+    BLUELOG_RELATED_FEATURES = 2048  # TF-IDF 特征词的最大数量
+    BLUELOG_RELATED_BLOCK = 256  # 每次计算相似度的文章数
+    BLUELOG_RELATED_DIR = os.path.join(basedir, 'cache', 'related')
+    BLUELOG_RELATED_AUTO_UPDATE = True  # 保存文章后在后台更新相关文章
+    BLUELOG_RELATED_QUEUE_SIZE = 1000  # 等待后台更新相关文章的文章数上限，超过后丢弃
+    # 在 WSGI 层压缩响应：压缩级别（1~9）、最小字节数和需要压缩的 MIME 类型
+    BLUELOG_COMPRESS = True
+    BLUELOG_COMPRESS_LEVEL = 6
+    BLUELOG_COMPRESS_MIN_SIZE = 500
+    BLUELOG_COMPRESS_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/xml',
+                                  'application/json', 'application/javascript', 'application/xml',
+                                  'application/rss+xml', 'application/atom+xml')
+    # 是否使用 flask assets 生成的带哈希、预压缩的静态文件；修改静态文件后需要重新生成
+    BLUELOG_ASSETS = False
+    BLUELOG_ASSETS_DIR = os.path.join(basedir, 'cache', 'assets')
+    BLUELOG_ASSETS_MAX_AGE = 365 * 24 * 3600  # 带哈希的静态文件的缓存时间（秒）
+    BLUELOG_ASSETS_UNVERSIONED = ('ckeditor/',)  # 保留原文件名的目录，CKEditor 按自身的文件名查找插件
+    # flask freeze 的输出目录、进程数（None 表示 CPU 核数）和订阅源中使用的站点地址
+    BLUELOG_FREEZE_DIR = os.path.join(basedir, 'build')
+    BLUELOG_FREEZE_WORKERS = None
+    BLUELOG_FREEZE_BASE_URL = os.getenv('BLUELOG_FREEZE_BASE_URL', 'http://localhost/')
+    # 每个请求的 SQL 查询数量预算，None 表示不检查；需要同时打开 SQLALCHEMY_RECORD_QUERIES
+    BLUELOG_QUERY_BUDGET = None
+    BLUELOG_QUERY_BUDGETS = {}  # 按端点单独设置的预算，例如 {'blog.show_post': 8}
+    BLUELOG_QUERY_BUDGET_STRICT = False  # 为 True 时超出预算抛出异常，否则记录警告日志
     # 为了使 API post 方法不发生 csrf 错误，关闭 csrf 验证，如果不使用 API 要打开。
     WTF_CSRF_ENABLED = False
 
@@ -37,9 +108,11 @@ class BaseConfig(object):
 class DevelopmentConfig(BaseConfig):
     """开发环境设置
 
-    包括基础设置之外的数据库设置
+    包括基础设置之外的数据库设置和查询数量预算
 
     """
+    SQLALCHEMY_RECORD_QUERIES = True
+    BLUELOG_QUERY_BUDGET = 20
     DE_MYSQL_USER = os.getenv('DE_MYSQL_USER')
     DE_MYSQL_USER_PASSWORD = os.getenv('DE_MYSQL_PASSWORD')
     DE_MYSQL_USER_PORT = os.getenv('DE_MYSQL_PORT')
@@ -54,15 +127,20 @@ class TestingConfig(BaseConfig):
     """
     TESTING = True
     WTF_CSRF_ENABLE = False
+    SQLALCHEMY_RECORD_QUERIES = True
+    BLUELOG_QUERY_BUDGET = 20
+    BLUELOG_QUERY_BUDGET_STRICT = True
+    BLUELOG_RELATED_AUTO_UPDATE = False  # 内存数据库只在创建它的线程中可见，不在后台线程中更新
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:' # in-emory database
 
 
 class ProductionConfig(BaseConfig):
     """生产环境设置
 
-    设置生产环境的数据库设置
+    设置生产环境的数据库设置，使用 flask assets 生成的带哈希的静态文件
 
     """
+    BLUELOG_ASSETS = True
     PR_MYSQL_USER = os.getenv('PR_MYSQL_USER')
     PR_MYSQL_PASSWORD = os.getenv('PR_MYSQL_PASSWORD')
     PR_MYSQL_PORT = os.getenv('PR_MYSQL_PORT')
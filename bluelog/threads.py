@@ -0,0 +1,110 @@
+from sqlalchemy.orm import joinedload
+
+from bluelog.counts import count_threads
+from bluelog.models import Comment
+from bluelog.pagination import offset_paginate
+
+
+class CommentNode(object):
+    """讨论串中的一条评论
+
+    Attributes:
+        comment: 评论对象
+        level: 显示的缩进层级，根评论为 0
+        parent: 显示出来的上级评论（跳过了未审核的评论），根评论为 None
+        children: 显示在这条评论下面的回复，按时间排序
+    """
+    __slots__ = ('comment', 'level', 'parent', 'children', '_siblings')
+
+    def __init__(self, comment, level=0, parent=None, siblings=None):
+        self.comment = comment
+        self.level = level
+        self.parent = parent
+        self.children = []
+        self._siblings = siblings
+
+
+def build_threads(roots, replies, max_level):
+    """在内存中把评论组装成讨论串
+
+    未审核的回复不显示，它下面已审核的回复显示在最近的已审核上级下面；
+    超过 max_level 层的回复不再缩进，和上级显示在同一层。组装过程不使用递归，
+    深度很大的讨论串也不会超出递归限制。
+
+    Args:
+        roots: 根评论列表，按时间排序
+        replies: 这些讨论串中的所有回复（包括未审核的）
+        max_level: 最大缩进层级，至少为 1
+    Returns:
+        CommentNode 列表，每个讨论串一个
+    """
+    comments = {comment.id: comment for comment in replies}
+    children = {}
+    for comment in replies:
+        if not comment.reviewed:
+            continue
+        parent_id = comment.replied_id
+        while parent_id in comments and not comments[parent_id].reviewed:
+            parent_id = comments[parent_id].replied_id
+        children.setdefault(parent_id, []).append(comment)
+
+    threads = []
+    stack = []
+    for comment in roots:
+        node = CommentNode(comment, 0, siblings=threads)
+        threads.append(node)
+        stack.append(node)
+    containers = []
+    while stack:
+        node = stack.pop()
+        node_replies = children.get(node.comment.id)
+        if not node_replies:
+            continue
+        if node.level < max_level:
+            container, level = node.children, node.level + 1
+            containers.append(container)
+        else:
+            container, level = node._siblings, node.level
+        for comment in node_replies:
+            child = CommentNode(comment, level, node.comment, container)
+            container.append(child)
+            stack.append(child)
+    # 超过最大层级的回复追加在上级所在的列表末尾，需要重新按时间排序
+    for container in containers:
+        container.sort(key=lambda child: (child.comment.timestamp, child.comment.id))
+    return threads
+
+
+def paginate_comments(post, page, per_page):
+    """一页已审核的评论，被回复的评论在同一个查询中用 JOIN 取出
+
+    Returns:
+        Flask-SQLAlchemy 的 Pagination 对象
+    """
+    query = Comment.query.with_parent(post).filter_by(reviewed=True).options(
+        joinedload(Comment.replied)
+    ).order_by(Comment.timestamp.asc(), Comment.id.asc())
+    return offset_paginate(query, page, per_page, total=post.reviewed_comment_count)
+
+
+def paginate_threads(post, page, per_page, max_level):
+    """按讨论串分页，每页 per_page 个根评论和它们的全部回复
+
+    无论讨论串中有多少回复，都只需要两个查询：一页根评论，以及这些讨论串中的所有回复。
+
+    Returns:
+        (pagination, threads) 元组，threads 为 CommentNode 列表
+    """
+    query = Comment.query.with_parent(post).filter_by(
+        reviewed=True, replied_id=None
+    ).order_by(Comment.timestamp.asc(), Comment.id.asc())
+    pagination = offset_paginate(query, page, per_page,
+                                 total=lambda: count_threads(post.id))
+    roots = pagination.items
+    replies = []
+    if roots:
+        replies = Comment.query.filter(
+            Comment.thread_id.in_([root.id for root in roots]),
+            Comment.post_id == post.id
+        ).order_by(Comment.timestamp.asc(), Comment.id.asc()).all()
+    return pagination, build_threads(roots, replies, max_level)
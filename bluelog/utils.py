@@ -1,5 +1,12 @@
+import hashlib
+import math
+import re
+from functools import wraps
+
 import jwt
-from flask import current_app, g, redirect, request, url_for
+from flask import current_app, g, make_response, redirect, request, url_for
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
 
 try:
     from urlparse import urlparse, urljoin
@@ -7,6 +14,96 @@ except ImportError:
     from urllib.parse import urlparse, urljoin
 
 
+# 一个汉字或一个由字母数字组成的单词计为一个字
+_word_re = re.compile(r'[\u4e00-\u9fff]|[A-Za-z0-9_\'-]+')
+# 每分钟阅读的字数，用于估算阅读时间
+WORDS_PER_MINUTE = 300
+
+
+def summarize(html, length=255, end='...', leeway=5):
+    """生成 HTML 正文的摘要、字数和阅读时间
+
+    摘要与模板中 body|striptags|truncate 的结果相同。
+
+    Args:
+        html:HTML 正文
+        length:摘要的最大长度
+        end:截断后添加的结尾
+        leeway:超出 length 不多于 leeway 个字符时不截断
+
+    Returns:
+        (excerpt, word_count, reading_time) 元组，阅读时间以分钟为单位，至少为 1
+    """
+    text = Markup(html or '').striptags()
+    if len(text) <= length + leeway:
+        excerpt = text
+    else:
+        excerpt = text[:length - len(end)].rsplit(' ', 1)[0] + end
+    word_count = len(_word_re.findall(text))
+    reading_time = max(1, int(math.ceil(word_count / float(WORDS_PER_MINUTE))))
+    return excerpt, word_count, reading_time
+
+
+def current_theme():
+    """获取当前请求使用的主题名称，cookie 无效时返回默认主题"""
+    theme = request.cookies.get('theme')
+    if theme not in current_app.config['BLUELOG_THEMES']:
+        theme = 'perfect_blue'
+    return theme
+
+
+def make_etag(*parts):
+    """根据若干部分生成 ETag
+
+    Args:
+        *parts:决定响应内容的值
+
+    Returns:
+        由各部分的 SHA1 摘要生成的 ETag 字符串
+    """
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def conditional(validator):
+    """为视图函数添加条件请求（ETag / Last-Modified）支持
+
+    validator 以视图参数调用，返回 (etag, last_modified)，不需要验证时返回 None。
+    请求中的 If-None-Match / If-Modified-Since 与之匹配时直接返回 304，不执行视图函数。
+
+    Args:
+        validator:计算验证值的函数，只能使用轻量的查询，不能渲染页面
+
+    Returns:
+        视图函数的装饰器
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return f(*args, **kwargs)
+            validators = validator(**kwargs)
+            if validators is None:
+                return f(*args, **kwargs)
+            etag, last_modified = validators
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True  # 每次使用前都需要验证
+            return response
+        return decorated
+    return decorator
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """请求执行的 SQL 查询数量超出了配置的预算"""
+
+
 def is_safe_url(target):
     """检查一个链接是否安全
 
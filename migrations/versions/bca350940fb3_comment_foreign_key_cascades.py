@@ -0,0 +1,63 @@
+"""comment foreign key cascades
+
+Revision ID: bca350940fb3
+Revises: 8258b9b82bcf
+Create Date: 2026-10-18 06:43:01.328016
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bca350940fb3'
+down_revision = '8258b9b82bcf'
+branch_labels = None
+depends_on = None
+
+# SQLite 中的外键没有名称，batch 模式重建表时按这个规则命名后再删除
+naming_convention = {
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s',
+}
+
+
+def _foreign_keys():
+    """comment 表中 post_id 和 replied_id 外键的名称，MySQL 中是自动生成的名称"""
+    names = {}
+    for fk in sa.inspect(op.get_bind()).get_foreign_keys('comment'):
+        column = fk['constrained_columns'][0]
+        names[column] = fk['name'] or 'fk_comment_%s_%s' % (column, fk['referred_table'])
+    return names
+
+
+def _replace_foreign_keys(ondelete, index):
+    """用 ondelete 规则重建 post_id 和 replied_id 外键，index 为 True 时为 replied_id 建立索引
+
+    MySQL 不允许删除外键正在使用的索引，删除索引需要在删除外键之后、重建外键之前。
+    """
+    names = _foreign_keys()
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    if sqlite:
+        # 重建表时删除旧表会按新的级联规则删除有 replied_id 的评论，先关闭外键检查
+        op.execute('PRAGMA foreign_keys = OFF')
+    with op.batch_alter_table('comment', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint(names['post_id'], type_='foreignkey')
+        batch_op.drop_constraint(names['replied_id'], type_='foreignkey')
+        if index:
+            batch_op.create_index(batch_op.f('ix_comment_replied_id'), ['replied_id'], unique=False)
+        else:
+            batch_op.drop_index(batch_op.f('ix_comment_replied_id'))
+        batch_op.create_foreign_key('fk_comment_post_id_post', 'post', ['post_id'], ['id'],
+                                    ondelete=ondelete)
+        batch_op.create_foreign_key('fk_comment_replied_id_comment', 'comment', ['replied_id'], ['id'],
+                                    ondelete=ondelete)
+    if sqlite:
+        op.execute('PRAGMA foreign_keys = ON')
+
+
+def upgrade():
+    _replace_foreign_keys('CASCADE', index=True)
+
+
+def downgrade():
+    _replace_foreign_keys(None, index=False)
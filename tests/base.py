@@ -0,0 +1,55 @@
+import os
+import unittest
+from datetime import datetime
+
+# settings 在导入时拼接 MySQL 的连接地址，测试使用 SQLite，这些变量只需要存在
+for name in ('DE_MYSQL_USER', 'DE_MYSQL_PASSWORD', 'DE_MYSQL_PORT',
+             'PR_MYSQL_USER', 'PR_MYSQL_PASSWORD', 'PR_MYSQL_PORT'):
+    os.environ.setdefault(name, '')
+# create_app 的日志处理器写入 ./logs/bluelog.log
+os.makedirs('logs', exist_ok=True)
+
+from bluelog import create_app  # noqa: E402
+from bluelog.counts import count_cache  # noqa: E402
+from bluelog.extensions import db  # noqa: E402
+from bluelog.models import Category, Comment, Post  # noqa: E402
+
+
+class BlogTestCase(unittest.TestCase):
+    """测试的基类
+
+    每个测试创建 testing 配置的 app 和内存中的 SQLite 数据库，推入请求上下文，
+    并创建一个 id 为 1 的默认分类；进程级的计数缓存在测试前后清空。
+    """
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.context = self.app.test_request_context()
+        self.context.push()
+        db.create_all()
+        count_cache.invalidate()
+        db.session.add(Category(id=1, name='Default'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        count_cache.invalidate()
+
+    def add_post(self, title='Post', body='Body', category_id=1, timestamp=None):
+        """新建并提交一篇文章"""
+        post = Post(title=title, category_id=category_id,
+                    timestamp=timestamp or datetime.utcnow())
+        post.set_body(body)
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def add_comment(self, post, reviewed=True, replied=None, from_admin=False, body='Comment'):
+        """新建并提交一条评论，replied 为被回复的评论"""
+        comment = Comment(author='Guest', email='guest@example.com', body=body, post=post,
+                          reviewed=reviewed, from_admin=from_admin, replied=replied)
+        db.session.add(comment)
+        db.session.commit()
+        return comment
@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.comment_buffer import CommentBuffer, _Segment
+from bluelog.models import Comment, CommentSegment, Post
+
+
+class CommentBufferRecoveryTestCase(BlogTestCase):
+    """恢复崩溃的进程留下的日志文件"""
+
+    def setUp(self):
+        super(CommentBufferRecoveryTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.app.config.update(BLUELOG_COMMENT_BUFFER=True, BLUELOG_COMMENT_BUFFER_DIR=self.directory,
+                               BLUELOG_EMAIL='admin@example.com')
+        self.add_post()
+
+    def tearDown(self):
+        super(CommentBufferRecoveryTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def write_segment(self, name, count):
+        """写入一个没有被锁住的日志文件，就像进程崩溃后留下的一样"""
+        path = os.path.join(self.directory, name + '.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            for i in range(count):
+                f.write(json.dumps(dict(post_id=1, replied_id=None, author='Guest',
+                                        email='guest@example.com', site='', body='Comment %d' % i,
+                                        timestamp='2026-10-18T01:02:03.%06d' % i)) + '\n')
+        return path
+
+    def recover(self):
+        """模拟重新启动的进程：接管遗留的日志文件并写入数据库"""
+        buffer = CommentBuffer(self.app)
+        buffer._recover()
+        buffer.flush()
+        return buffer
+
+    def test_replay_committed_segment(self):
+        path = self.write_segment('1234-0123456789abcdef0123456789abcdef', 3)
+        # 提交后、删除文件前崩溃
+        with mock.patch.object(_Segment, 'remove', lambda segment: segment.file.close()):
+            self.recover()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(Comment.query.count(), 3)
+
+        buffer = self.recover()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Comment.query.count(), 3)
+        self.assertEqual(Post.query.get(1).comment_count, 3)
+        self.assertEqual(buffer.stats['recovered'], 0)
+
+    def test_recover_uncommitted_segment(self):
+        path = self.write_segment('1234-fedcba9876543210fedcba9876543210', 2)
+        buffer = self.recover()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Comment.query.count(), 2)
+        self.assertEqual(buffer.stats['recovered'], 2)
+        self.assertEqual(CommentSegment.query.count(), 1)
+
+        # 文件删除后，记录在下一次写入的事务中删除
+        self.write_segment('1234-00000000000000000000000000000000', 1)
+        buffer._recover()
+        buffer.flush()
+        self.assertEqual([segment.id for segment in CommentSegment.query],
+                         ['1234-00000000000000000000000000000000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.counts import count_comments
+from bluelog.extensions import db
+from bluelog.models import Comment, Post
+
+
+class CommentCountTestCase(BlogTestCase):
+    """Post 上由评论的写入事件维护的评论计数"""
+
+    def assertCounts(self, post_id, total, reviewed):
+        db.session.expire_all()
+        post = Post.query.get(post_id)
+        self.assertEqual((post.comment_count, post.reviewed_comment_count), (total, reviewed))
+
+    def test_insert_and_delete(self):
+        post = self.add_post()
+        self.add_comment(post)
+        unread = self.add_comment(post, reviewed=False)
+        self.assertCounts(post.id, 2, 1)
+
+        db.session.delete(unread)
+        db.session.commit()
+        self.assertCounts(post.id, 1, 1)
+
+    def test_review_and_move(self):
+        first, second = self.add_post(), self.add_post()
+        comment = self.add_comment(first, reviewed=False)
+        self.assertCounts(first.id, 1, 0)
+
+        comment.reviewed = True
+        db.session.commit()
+        self.assertCounts(first.id, 1, 1)
+
+        comment.post_id = second.id
+        db.session.commit()
+        self.assertCounts(first.id, 0, 0)
+        self.assertCounts(second.id, 1, 1)
+
+    def test_delete_reply_tree(self):
+        post = self.add_post()
+        root = self.add_comment(post)
+        reply = self.add_comment(post, replied=root, reviewed=False)
+        nested = self.add_comment(post, replied=reply)
+        self.add_comment(post, replied=nested)
+        other = self.add_comment(post)
+        self.assertCounts(post.id, 5, 4)
+        self.assertEqual(count_comments('all'), 5)
+
+        # 删除讨论串中间的评论，它下面的回复一起删除
+        db.session.delete(reply)
+        db.session.commit()
+        self.assertCounts(post.id, 2, 2)
+        self.assertEqual(count_comments('all'), 2)
+
+        db.session.delete(root)
+        db.session.commit()
+        self.assertCounts(post.id, 1, 1)
+        self.assertEqual([comment.id for comment in Comment.query], [other.id])
+
+    def test_delete_post(self):
+        post = self.add_post()
+        root = self.add_comment(post)
+        self.add_comment(post, replied=root, reviewed=False)
+        self.assertEqual((count_comments('all'), count_comments('unread')), (2, 1))
+
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(Comment.query.count(), 0)
+        self.assertEqual((count_comments('all'), count_comments('unread')), (0, 0))
+
+    def test_recount_fixes_drift(self):
+        post = self.add_post()
+        self.add_comment(post)
+        self.add_comment(post, reviewed=False)
+        db.session.execute(Post.__table__.update().values(comment_count=7,
+                                                          reviewed_comment_count=7))
+        db.session.commit()
+
+        Post.recount_comments()
+        self.assertCounts(post.id, 2, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
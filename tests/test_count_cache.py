@@ -0,0 +1,78 @@
+import unittest
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.counts import CountCache, count_comments, count_posts
+from bluelog.extensions import db
+from bluelog.models import Post
+
+
+class CountCacheTestCase(unittest.TestCase):
+    """统计期间收到的增量和删除"""
+
+    def setUp(self):
+        self.cache = CountCache()
+
+    def test_adjust_during_count(self):
+        def counter():
+            self.cache.adjust('key', 2)  # 统计已经读到旧值时提交的写入
+            return 10
+        self.assertEqual(self.cache.get('key', counter), 12)
+        self.assertEqual(self.cache.get('key', lambda: 0), 12)
+
+    def test_invalidate_during_count(self):
+        def counter():
+            self.cache.invalidate('key')
+            return 10
+        self.assertEqual(self.cache.get('key', counter), 10)
+        self.assertEqual(self.cache.get('key', lambda: 3), 3)
+
+    def test_adjust_uncached_key(self):
+        self.cache.adjust('key', 5)
+        self.assertEqual(self.cache.get('key', lambda: 1), 1)
+
+    def test_reconcile(self):
+        self.cache.reconcile_interval = 0
+        self.cache.get('key', lambda: 1)
+        self.assertEqual(self.cache.get('key', lambda: 2), 2)
+
+
+class CountEventsTestCase(BlogTestCase):
+    """提交后按写入增量修改缓存的计数，不再执行 COUNT"""
+
+    def test_posts(self):
+        post = self.add_post()
+        self.assertEqual((count_posts(), count_posts(1)), (1, 1))
+
+        self.add_post()
+        self.assertEqual((count_posts(), count_posts(1)), (2, 2))
+
+        # 过期的文章删除前加载旧值，按原来的分类减去
+        db.session.expire_all()
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual((count_posts(), count_posts(1)), (1, 1))
+
+    def test_comments(self):
+        post = self.add_post()
+        self.add_comment(post)
+        comment = self.add_comment(post, reviewed=False)
+        self.assertEqual((count_comments('all'), count_comments('unread')), (2, 1))
+
+        comment.reviewed = True
+        db.session.commit()
+        self.assertEqual((count_comments('all'), count_comments('unread')), (2, 0))
+
+    def test_delete_post_with_comments(self):
+        post = self.add_post()
+        self.add_comment(post, reviewed=False)
+        self.assertEqual((count_comments('all'), count_comments('unread')), (1, 1))
+
+        # 评论由数据库级联删除，comment_count 已经过期
+        db.session.expire_all()
+        db.session.delete(Post.query.get(post.id))
+        db.session.commit()
+        self.assertEqual((count_comments('all'), count_comments('unread')), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.dependencies import comment_pages
+from bluelog.extensions import db
+from bluelog.models import RelatedPost
+
+
+class AffectedPagesTestCase(BlogTestCase):
+    """提交后清除的页面"""
+
+    def setUp(self):
+        super(AffectedPagesTestCase, self).setUp()
+        self.app.config['BLUELOG_POST_PER_PAGE'] = 2
+        start = datetime(2020, 3, 1)
+        # 倒序排列时 posts[4] 在首页第 1 页，posts[0] 在第 3 页
+        self.posts = [self.add_post(timestamp=start + timedelta(days=i)) for i in range(5)]
+        patcher = mock.patch('bluelog.dependencies.purge_pages')
+        self.purge_pages = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def purged(self):
+        """返回最近一次提交清除的页面"""
+        return self.purge_pages.call_args[0][0]
+
+    def test_post_edit(self):
+        post = self.posts[0]
+        post.body = '<p>Edited</p>'
+        db.session.commit()
+        pages = self.purged()
+        self.assertFalse(pages.everything)
+        self.assertEqual(pages.paths, {
+            '/post/%d' % post.id: None,
+            '/': {3},
+            '/category/1': {3},
+            '/archive/2020/3': None,
+            '/search': None, '/feed.xml': None, '/atom.xml': None, '/sitemap.xml': None,
+        })
+
+    def test_post_move(self):
+        self.posts[0].timestamp = datetime(2021, 1, 1)
+        db.session.commit()
+        self.assertTrue(self.purged().everything)
+
+    def test_title_purges_related(self):
+        db.session.add(RelatedPost(post_id=self.posts[1].id, related_id=self.posts[0].id,
+                                   score=0.5))
+        db.session.commit()
+        self.posts[0].title = 'Renamed'
+        db.session.commit()
+        self.assertIn('/post/%d' % self.posts[1].id, self.purged().paths)
+
+    def test_comments(self):
+        post = self.posts[4]
+        comment = self.add_comment(post, reviewed=False)
+        self.assertFalse(self.purged())  # 未审核的评论不显示
+
+        comment.reviewed = True
+        db.session.commit()
+        pages = self.purged()
+        self.assertEqual(pages.paths['/post/%d' % post.id], None)
+        self.assertEqual(pages.paths['/'], {1})
+
+    def test_comment_pages(self):
+        pages = comment_pages({self.posts[0].id, self.posts[4].id}, db.session.connection())
+        self.assertEqual(pages.paths['/'], {1, 3})
+        self.assertEqual(set(pages.paths), {'/', '/category/1', '/archive/2020/3',
+                                            '/post/%d' % self.posts[0].id,
+                                            '/post/%d' % self.posts[4].id})
+
+    def test_keyset_pagination(self):
+        self.app.config['BLUELOG_KEYSET_PAGINATION'] = True
+        self.posts[0].body = '<p>Edited</p>'
+        db.session.commit()
+        self.assertIsNone(self.purged().paths['/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import tests.base  # noqa: F401 先导入，设置导入 bluelog 需要的环境变量
+from bluelog import create_app
+from bluelog.counts import count_cache
+from bluelog.dependencies import AffectedPages
+from bluelog.extensions import db
+from bluelog.freeze import (MANIFEST_FILE, QUEUE_FILE, _finish_queue, _take_queue, freeze,
+                            queue_pages)
+from bluelog.models import Admin, Category, Post
+
+
+class FreezeQueueTestCase(unittest.TestCase):
+    """增量生成的页面队列"""
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        with open(os.path.join(self.output, MANIFEST_FILE), 'w') as f:
+            f.write('{}')
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def queue(self, everything=False, **paths):
+        pages = AffectedPages(everything)
+        for path, numbers in paths.items():
+            for page in numbers or (None,):
+                pages.add('/' + path, page)
+        queue_pages(self.output, pages)
+
+    def test_merge(self):
+        self.queue(post=[1, 2])
+        self.queue(post=[3], archive=[])
+        self.queue(archive=[1])
+        self.assertEqual(_take_queue(self.output), {'/post': {1, 2, 3}, '/archive': None})
+
+    def test_everything(self):
+        self.queue(post=[1])
+        self.queue(everything=True)
+        self.assertIsNone(_take_queue(self.output))
+
+    def test_pending_until_finished(self):
+        self.queue(post=[1])
+        self.assertEqual(_take_queue(self.output), {'/post': {1}})
+        # 生成中断时取出的页面保留在 .pending 文件中，和之后追加的页面一起重新处理
+        self.queue(post=[2])
+        self.assertEqual(_take_queue(self.output), {'/post': {1, 2}})
+
+        _finish_queue(self.output)
+        self.assertEqual(_take_queue(self.output), {})
+        self.assertEqual(os.listdir(self.output), [MANIFEST_FILE])
+
+    def test_not_frozen(self):
+        os.remove(os.path.join(self.output, MANIFEST_FILE))
+        self.queue(post=[1])
+        self.assertFalse(os.path.exists(os.path.join(self.output, QUEUE_FILE)))
+
+
+class IncrementalFreezeTestCase(unittest.TestCase):
+    """修改文章后增量生成只重新渲染受影响的页面
+
+    worker 进程使用自己的连接，所以数据库使用临时目录中的 SQLite 文件。
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'build')
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            self.directory, 'bluelog.sqlite')
+        self.app.config['BLUELOG_FREEZE_DIR'] = self.output
+        self.context = self.app.test_request_context()
+        self.context.push()
+        db.create_all()
+        db.session.add(Admin(username='admin', blog_title='Blog', blog_sub_title='Sub',
+                             name='Admin', about='About'))
+        db.session.add(Category(id=1, name='Default'))
+        for title in ('First', 'Second'):
+            post = Post(title=title, category_id=1)
+            post.set_body('<p>Body</p>')
+            db.session.add(post)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        count_cache.invalidate()
+        shutil.rmtree(self.directory)
+
+    def freeze(self, incremental=False):
+        for stats in freeze(self.output, ['perfect_blue'], 1, incremental=incremental):
+            pass
+        self.assertEqual(stats['errors'], [])
+        return stats
+
+    def read(self, filename):
+        with open(os.path.join(self.output, filename), encoding='utf-8') as f:
+            return f.read()
+
+    def test_incremental(self):
+        full = self.freeze()
+        untouched = os.stat(os.path.join(self.output, 'post', '2', 'index.html')).st_mtime_ns
+
+        post = Post.query.get(1)
+        post.title = 'Changed'
+        db.session.commit()
+        self.assertTrue(os.path.exists(os.path.join(self.output, QUEUE_FILE)))
+
+        stats = self.freeze(incremental=True)
+        self.assertLess(stats['pages'], full['pages'])
+        self.assertIn('Changed', self.read(os.path.join('post', '1', 'index.html')))
+        self.assertIn('Changed', self.read('index.html'))
+        self.assertEqual(os.stat(os.path.join(self.output, 'post', '2', 'index.html')).st_mtime_ns,
+                         untouched)
+        self.assertFalse(os.path.exists(os.path.join(self.output, QUEUE_FILE + '.pending')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.counts import comment_filters, count_comments, count_threads
+from bluelog.extensions import db
+from bluelog.models import Comment, Post
+from bluelog.moderation import approve_comments, delete_comments, select_comments
+
+
+class ModerationTestCase(BlogTestCase):
+    """批量审核和删除后，文章的评论计数和计数缓存与数据库一致"""
+
+    def setUp(self):
+        super(ModerationTestCase, self).setUp()
+        self.first, self.second = self.add_post(), self.add_post()
+        root = self.add_comment(self.first)
+        reply = self.add_comment(self.first, replied=root, reviewed=False)
+        self.add_comment(self.first, replied=reply, from_admin=True)
+        self.add_comment(self.first, reviewed=False)
+        self.add_comment(self.second, reviewed=False)
+        self.root = root.id
+        self.fill_cache()
+        patcher = mock.patch('bluelog.moderation.purge_pages')
+        self.purge_pages = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fill_cache(self):
+        for filter_rule in comment_filters:
+            count_comments(filter_rule)
+        for post in (self.first, self.second):
+            count_threads(post.id)
+
+    def assertConsistent(self):
+        db.session.expire_all()
+        for filter_rule, query in comment_filters.items():
+            self.assertEqual(count_comments(filter_rule), query().count(), filter_rule)
+        for post in Post.query:
+            comments = Comment.query.filter_by(post_id=post.id)
+            reviewed = comments.filter_by(reviewed=True)
+            self.assertEqual((post.comment_count, post.reviewed_comment_count),
+                             (comments.count(), reviewed.count()))
+            self.assertEqual(count_threads(post.id), reviewed.filter_by(replied_id=None).count())
+
+    def test_select_requires_condition(self):
+        with self.assertRaises(ValueError):
+            select_comments()
+        with self.assertRaises(ValueError):
+            select_comments(filter_rule='missing', post_id=1)
+
+    def test_approve(self):
+        self.assertEqual(approve_comments(post_id=self.first.id), 2)
+        self.assertConsistent()
+        self.assertEqual(count_comments('unread'), 1)
+        self.assertIn('/post/%d' % self.first.id, self.purge_pages.call_args[0][0].paths)
+        self.assertEqual(approve_comments(post_id=self.first.id), 0)
+
+    def test_approve_all_unread(self):
+        self.assertEqual(approve_comments(filter_rule='unread'), 3)
+        self.assertConsistent()
+
+    def test_delete_with_replies(self):
+        self.assertEqual(delete_comments(ids=[self.root]), 3)
+        self.assertConsistent()
+        self.assertEqual(Comment.query.count(), 2)
+
+    def test_delete_unread(self):
+        self.assertEqual(delete_comments(filter_rule='unread'), 4)  # 包括未审核回复的已审核回复
+        self.assertConsistent()
+        self.assertEqual([c.id for c in Comment.query], [self.root])
+
+
+if __name__ == '__main__':
+    unittest.main()
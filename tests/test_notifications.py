@@ -0,0 +1,66 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.extensions import db
+from bluelog.models import Notification
+from bluelog.notifications import send_digests
+
+
+class DigestTestCase(BlogTestCase):
+    """摘要邮件的取走、超时重新取走和发送队列满时的释放"""
+
+    def setUp(self):
+        super(DigestTestCase, self).setUp()
+        self.post = self.add_post()
+        patcher = mock.patch('bluelog.notifications.send_mail', return_value=True)
+        self.send_mail = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def notify(self, recipient, minutes=30, claimed_minutes=None):
+        """添加一条 minutes 分钟前的提醒，claimed_minutes 不为 None 时表示已经被其他进程取走"""
+        now = datetime.utcnow()
+        claimed = claimed_minutes is not None
+        db.session.add(Notification(
+            recipient=recipient, kind='comment', post_id=self.post.id,
+            timestamp=now - timedelta(minutes=minutes),
+            claim='other' if claimed else None,
+            claimed_at=now - timedelta(minutes=claimed_minutes) if claimed else None))
+        db.session.commit()
+
+    def recipients(self):
+        return sorted(args[1]['to'] for args in self.send_mail.call_args_list)
+
+    def test_window(self):
+        self.notify('old@example.com')
+        self.notify('new@example.com', minutes=1)
+        self.assertEqual(send_digests(600), 1)
+        self.assertEqual(self.recipients(), ['old@example.com'])
+        self.assertEqual([n.recipient for n in Notification.query], ['new@example.com'])
+
+    def test_reclaim(self):
+        self.app.config['BLUELOG_DIGEST_CLAIM_TIMEOUT'] = 600
+        self.notify('stale@example.com', claimed_minutes=20)
+        self.notify('busy@example.com', claimed_minutes=1)
+        self.assertEqual(send_digests(0), 1)
+        # 取走超时的提醒属于已经退出的进程，重新发送；其他进程刚取走的不处理
+        self.assertEqual(self.recipients(), ['stale@example.com'])
+        self.assertEqual([(n.recipient, n.claim) for n in Notification.query],
+                         [('busy@example.com', 'other')])
+
+    def test_dropped(self):
+        self.notify('a@example.com')
+        self.send_mail.return_value = False  # 发送队列已满
+        self.assertEqual(send_digests(0), 0)
+        db.session.expire_all()
+        self.assertEqual([(n.recipient, n.claim) for n in Notification.query],
+                         [('a@example.com', None)])
+
+        self.send_mail.return_value = True
+        self.assertEqual(send_digests(0), 1)
+        self.assertEqual(Notification.query.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from datetime import datetime
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.models import Post
+from bluelog.pagination import KeysetPagination, decode_cursor, encode_cursor
+
+
+class CursorTestCase(unittest.TestCase):
+    """游标的编码和解码"""
+
+    def test_round_trip(self):
+        timestamp = datetime(2020, 5, 17, 8, 30, 1, 123456)
+        self.assertEqual(decode_cursor(encode_cursor(timestamp, 42)), (timestamp, 42))
+
+    def test_invalid_cursor(self):
+        for cursor in ('', 'not-a-cursor', encode_cursor(datetime(2020, 1, 1), 1)[:-3], '中'):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class KeysetPaginationTestCase(BlogTestCase):
+    """时间相同的文章按 id 排序，翻页时不重复也不遗漏"""
+
+    def setUp(self):
+        super(KeysetPaginationTestCase, self).setUp()
+        same = datetime(2020, 1, 1)
+        self.ids = [self.add_post(timestamp=timestamp).id for timestamp in
+                    (datetime(2019, 1, 1), same, same, same, same, datetime(2021, 1, 1))]
+        # 倒序：时间较新的在前，时间相同时 id 较大的在前
+        self.expected = [self.ids[5], self.ids[4], self.ids[3], self.ids[2], self.ids[1], self.ids[0]]
+
+    def page(self, **cursors):
+        return KeysetPagination(Post.query, Post, 2, **cursors)
+
+    def test_forward_and_backward(self):
+        pages, cursor = [], None
+        while True:
+            pagination = self.page(after=cursor and decode_cursor(cursor))
+            pages.append([post.id for post in pagination.items])
+            cursor = pagination.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(pages, [self.expected[0:2], self.expected[2:4], self.expected[4:6]])
+        self.assertFalse(pagination.has_next)
+
+        back = []
+        cursor = pagination.prev_cursor
+        while cursor is not None:
+            pagination = self.page(before=decode_cursor(cursor))
+            back.append([post.id for post in pagination.items])
+            cursor = pagination.prev_cursor
+        self.assertEqual(back, [self.expected[2:4], self.expected[0:2]])
+        self.assertFalse(pagination.has_prev)
+
+    def test_total(self):
+        self.assertIsNone(self.page().total)
+        pagination = KeysetPagination(Post.query, Post, 2, with_total=True)
+        self.assertEqual(pagination.total, len(self.ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
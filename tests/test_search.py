@@ -0,0 +1,46 @@
+import unittest
+
+from tests.base import BlogTestCase  # 先导入，设置导入 bluelog 需要的环境变量
+from bluelog.extensions import db
+from bluelog.search import search_posts, tokenize
+
+
+class TokenizeTestCase(unittest.TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Flask 博客系统'), ['flask', '博客', '客系', '系统'])
+        self.assertEqual(tokenize('单'), ['单'])
+
+
+class SearchTestCase(BlogTestCase):
+    """BM25 排序和写入后的索引更新"""
+
+    def search(self, q):
+        return [post.id for post in search_posts(q, 1, 10).items]
+
+    def test_ranking(self):
+        once = self.add_post(title='Notes', body='<p>python and other words here</p>')
+        twice = self.add_post(title='Notes', body='<p>python python and other words</p>')
+        title = self.add_post(title='Python', body='<p>some other words here too</p>')
+        self.add_post(title='Unrelated', body='<p>nothing to see</p>')
+        # 标题中的词按 TITLE_WEIGHT 次计算，排在正文中出现两次的文章前面
+        self.assertEqual(self.search('python'), [title.id, twice.id, once.id])
+        self.assertEqual(self.search('missing'), [])
+
+    def test_update_and_delete(self):
+        post = self.add_post(title='Python', body='<p>body</p>')
+        other = self.add_post(title='Other', body='<p>python</p>')
+        self.assertEqual(self.search('python'), [post.id, other.id])
+
+        post.title = 'Ruby'
+        db.session.commit()
+        self.assertEqual(self.search('python'), [other.id])
+        self.assertEqual(self.search('ruby'), [post.id])
+
+        db.session.delete(other)
+        db.session.commit()
+        self.assertEqual(self.search('python'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()